@@ -0,0 +1,67 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from utm_no import url_handler
+from utm_no.clean import Cleaner, ENCODING, line_chunks
+
+
+class TestClean(unittest.TestCase):
+    TEXT = "".join(
+        f"line {n} see https://example.com/{n}?utm_source=x&id={n} or "
+        f"example.com/{n}?a=b\r\n" if n % 3 else f"nothing on line {n}\n"
+        for n in range(500))
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_line_chunks(self):
+        chunks = list(line_chunks(io.StringIO(self.TEXT, newline=""), 1000))
+        self.assertEqual("".join(chunks), self.TEXT)
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith("\n"))
+
+    def test_pool_keeps_order(self):
+        out = io.StringIO(newline="")
+        with Cleaner(jobs=2, chunk_size=500, count_urls=True) as cleaner:
+            self.assertTrue(cleaner.clean(io.StringIO(self.TEXT, newline=""), out))
+        self.assertEqual(out.getvalue(), url_handler.fix_text(self.TEXT))
+        self.assertEqual(cleaner.stats["urls"], 666)
+        self.assertGreater(cleaner.stats["chunks"], 20)
+
+    def test_in_place(self):
+        path = os.path.join(self.tmp.name, "log.txt")
+        with open(path, "w", **ENCODING) as fp:
+            fp.write(self.TEXT)
+        os.chmod(path, 0o640)
+        with Cleaner(jobs=1) as cleaner:
+            self.assertTrue(cleaner.clean_in_place(path))
+            self.assertFalse(cleaner.clean_in_place(path))
+        with open(path, **ENCODING) as fp:
+            self.assertEqual(fp.read(), url_handler.fix_text(self.TEXT))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.tmp.name), ["log.txt"])
+
+    def test_command_line(self):
+        # and without GTK anywhere near it
+        script = ("import sys; from utm_no import clean; r = clean.main(); "
+                  "assert 'gi' not in sys.modules; sys.exit(r)")
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(
+            [sys.executable, "-c", script, "--stats", "-"],
+            input="a https://x.com/?utm_source=1&a=2 \xff b\n".encode("utf-8"),
+            capture_output=True, cwd=package_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.decode("utf-8"), "a https://x.com/?a=2 \xff b\n")
+        self.assertIn(b"1 URLs", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
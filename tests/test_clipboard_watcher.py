@@ -0,0 +1,378 @@
+import concurrent.futures
+import unittest
+
+from utm_no.clipboard_watcher import Budget, ClipboardWatcher
+
+
+class FakeLoop:
+    "Enough of GLib's main loop for ClipboardWatcher, with a hand-wound clock"
+    def __init__(self):
+        self.now = 0
+        self._sources = {}
+        self._next_id = 1
+
+    def timeout_add(self, ms, fn, *args):
+        self._next_id += 1
+        self._sources[self._next_id] = (self.now + ms, ms, fn, args)
+        return self._next_id
+
+    def idle_add(self, fn, *args):
+        return self.timeout_add(0, fn, *args)
+
+    def source_remove(self, source_id):
+        del self._sources[source_id]
+
+    def run(self, ms=0):
+        "Run everything due in the next ms milliseconds"
+        until = self.now + ms
+        while True:
+            due = [(source[0], sid) for sid, source in self._sources.items()
+                   if source[0] <= until]
+            if not due:
+                break
+            when, sid = min(due)
+            self.now = max(self.now, when)
+            _, ms, fn, args = self._sources.pop(sid)
+            if fn(*args):  # returning True means "call me again", as in GLib
+                self._sources[sid] = (self.now + max(ms, 1), ms, fn, args)
+        self.now = until
+
+
+class FakeClipboard:
+    "A clipboard that fires owner-change like GTK does, but synchronously"
+    def __init__(self, loop):
+        self.loop = loop
+        self.text = None
+        self.html = None
+        self.owner_change = None
+        self.requests = 0
+
+    def copy(self, text):
+        self.text = text
+        if self.owner_change:
+            self.owner_change()
+
+    def set_text(self, text, length):
+        self.html = None  # the text is all there is, now
+        self.copy(text)
+
+    def request_text(self, callback, data):
+        self.requests += 1
+        self.loop.idle_add(lambda: callback(self, self.text, data))
+
+    def request_contents(self, target, callback, data):
+        selection = FakeSelectionData(self.html.encode("utf-8") if self.html else b"")
+        self.loop.idle_add(lambda: callback(self, selection, data))
+
+
+class FakeSelectionData:
+    def __init__(self, data):
+        self.data = data
+
+    def get_length(self):
+        return len(self.data) if self.data else -1
+
+    def get_data(self):
+        return self.data
+
+
+class FakeOwner:
+    "Owns the clipboard the way the indicator's ClipboardOwner does"
+    def __init__(self, clipboard):
+        self.clipboard = clipboard
+
+    def set(self, text, html):
+        self.clipboard.html = html
+        self.clipboard.copy(text)
+
+
+class ManualExecutor:
+    "An executor whose jobs run only when you call run_pending()"
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        self.pending.append((future, fn, args))
+        return future
+
+    def run_pending(self):
+        pending, self.pending = self.pending, []
+        for future, fn, args in pending:
+            future.set_result(fn(*args))
+
+
+class TestClipboardWatcher(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.clipboard = FakeClipboard(self.loop)
+        self.executor = ManualExecutor()
+        self.handled = []
+        self.watcher = ClipboardWatcher(
+            self.clipboard, self.handled.append, self.loop, self.executor, settle_ms=50)
+        self.clipboard.owner_change = self.watcher.owner_changed
+
+    def burst(self, text, times=4, gap=5):
+        for _ in range(times):
+            self.clipboard.copy(text)
+            self.loop.run(gap)
+
+    def test_burst_handled_once(self):
+        self.burst("hello")
+        self.assertEqual(self.handled, [])  # not settled yet
+        self.loop.run(100)
+        self.assertEqual(self.handled, ["hello"])
+        self.assertEqual(self.clipboard.requests, 1)
+
+    def test_once_per_distinct_text(self):
+        for text in ["a", "a", "b", "b", "a"]:
+            self.burst(text)
+            self.loop.run(100)
+        self.assertEqual(self.handled, ["a", "b", "a"])
+
+    def test_only_settled_text(self):
+        for text in ["a", "b", "c"]:
+            self.clipboard.copy(text)
+            self.loop.run(10)
+        self.loop.run(100)
+        self.assertEqual(self.handled, ["c"])
+
+    def test_own_changes_not_reprocessed(self):
+        self.watcher.handle = lambda text: self.watcher.replace_text(text.upper())
+        self.burst("hello")
+        self.loop.run(100)
+        self.assertEqual(self.clipboard.text, "HELLO")
+        self.watcher.handle = self.handled.append
+        self.burst("HELLO", times=3)  # the echoes of our own set_text
+        self.loop.run(100)
+        self.assertEqual(self.handled, [])
+
+    def test_worker(self):
+        results = []
+        self.watcher.handle = lambda text: self.watcher.run_in_worker(
+            str.upper, text, then=results.append)
+        self.burst("hello")
+        self.loop.run(100)
+        self.assertEqual(results, [])  # worker hasn't run yet
+        self.executor.run_pending()
+        self.loop.run(0)
+        self.assertEqual(results, ["HELLO"])
+
+    def test_stale_worker_result_dropped(self):
+        results = []
+        self.watcher.handle = lambda text: self.watcher.run_in_worker(
+            str.upper, text, then=results.append)
+        self.burst("first")
+        self.loop.run(100)
+        self.clipboard.copy("second")  # while the worker's busy with "first"
+        self.executor.run_pending()
+        self.loop.run(100)
+        self.executor.run_pending()
+        self.loop.run(0)
+        self.assertEqual(results, ["SECOND"])
+
+    def test_same_text_again_while_working(self):
+        # an app announcing the copy again while the worker's still busy
+        # with it: that result's dropped, so the text has to be seen again
+        results = []
+        self.watcher.handle = lambda text: self.watcher.run_in_worker(
+            str.upper, text, then=results.append)
+        self.burst("https://e.com/?utm_source=x")
+        self.loop.run(100)
+        self.burst("https://e.com/?utm_source=x")
+        self.loop.run(100)
+        self.executor.run_pending()
+        self.loop.run(0)
+        self.assertEqual(results, ["HTTPS://E.COM/?UTM_SOURCE=X"])
+        self.burst("https://e.com/?utm_source=x")  # and once that's back, it's done
+        self.loop.run(100)
+        self.assertEqual(self.executor.pending, [])
+
+    def test_same_text_again_while_slicing(self):
+        self.now = 0
+        self.watcher.clock = lambda: self.now
+        steps, results = [], []
+        self.watcher.handle = lambda text: self.watcher.run_in_slices(
+            self.sliced(steps, 200, 5), then=results.append)
+        self.burst("a", times=1)
+        self.loop.run(60)
+        self.assertTrue(steps)  # under way
+        self.assertEqual(results, [])
+        self.burst("a", times=1)  # the stale slices stop before this is read
+        self.loop.run(500)
+        self.assertEqual(results, ["done"])
+
+    def sliced(self, steps_taken, count, each_ms):
+        "A job of count steps, each taking each_ms on the pretend clock"
+        for n in range(count):
+            self.now += each_ms / 1000
+            steps_taken.append(n)
+            yield
+        return "done"
+
+    def test_slices(self):
+        self.now = 0
+        self.watcher.clock = lambda: self.now
+        self.watcher.slice_ms = 10
+        steps, results = [], []
+        self.watcher.run_in_slices(self.sliced(steps, 12, 3), then=results.append)
+        self.loop.run(0)
+        self.assertEqual(steps, [0, 1, 2, 3])  # 12ms, just past the 10ms budget
+        self.assertEqual(results, [])
+        self.loop.run(10)
+        self.assertEqual(len(steps), 12)
+        self.assertEqual(results, ["done"])
+
+    def test_slices_cancelled(self):
+        self.now = 0
+        self.watcher.clock = lambda: self.now
+        steps, results = [], []
+        self.watcher.run_in_slices(self.sliced(steps, 100, 5), then=results.append)
+        self.loop.run(0)
+        self.clipboard.copy("something else")
+        self.loop.run(10)
+        self.assertLess(len(steps), 100)
+        self.assertEqual(results, [])
+
+    def test_forget(self):
+        self.burst("a")
+        self.loop.run(100)
+        self.watcher.forget()
+        self.burst("a")
+        self.loop.run(100)
+        self.assertEqual(self.handled, ["a", "a"])
+
+
+class TestClipboardWatcherHtml(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.clipboard = FakeClipboard(self.loop)
+        self.handled = []
+        self.watcher = ClipboardWatcher(
+            self.clipboard, lambda *args: self.handled.append(args), self.loop,
+            ManualExecutor(), settle_ms=50, html_target="text/html",
+            owner=FakeOwner(self.clipboard))
+        self.clipboard.owner_change = self.watcher.owner_changed
+
+    def test_html(self):
+        self.clipboard.html = "<b>hello</b>"
+        self.clipboard.copy("hello")
+        self.loop.run(100)
+        self.clipboard.html = None
+        self.clipboard.copy("bye")
+        self.loop.run(100)
+        self.assertEqual(self.handled, [("hello", "<b>hello</b>"), ("bye", None)])
+
+    def test_same_text_different_html(self):
+        # a link labelled "here", copied from two different pages
+        for html in ['<a href="https://a.com/?utm_source=x">here</a>',
+                     '<a href="https://b.com/?utm_source=y">here</a>',
+                     '<a href="https://b.com/?utm_source=y">here</a>']:
+            self.clipboard.html = html
+            self.clipboard.copy("here")
+            self.loop.run(100)
+        self.assertEqual([html for _, html in self.handled], [
+            '<a href="https://a.com/?utm_source=x">here</a>',
+            '<a href="https://b.com/?utm_source=y">here</a>'])
+
+    def test_own_changes_not_reprocessed(self):
+        self.watcher.replace_text("text", "<i>html</i>")
+        self.loop.run(100)
+        self.watcher.replace_text("plain")  # the HTML's gone with this one
+        self.loop.run(100)
+        self.assertEqual(self.handled, [])
+
+    def test_changed_while_fetching_html(self):
+        asked = []
+        self.clipboard.request_contents = lambda target, callback, data: asked.append(
+            (callback, data))
+        self.clipboard.copy("a")
+        self.loop.run(100)
+        self.clipboard.copy("b")  # before the HTML of "a" arrives
+        callback, data = asked.pop()
+        callback(self.clipboard, FakeSelectionData(b"<b>a</b>"), data)
+        self.assertEqual(self.handled, [])
+        self.loop.run(100)
+        self.assertEqual(asked[0][1], (self.watcher.generation, "b"))
+
+    def test_replace_both(self):
+        self.watcher.replace_text("text", "<i>html</i>")
+        self.assertEqual((self.clipboard.text, self.clipboard.html), ("text", "<i>html</i>"))
+        self.loop.run(100)
+        self.assertEqual(self.handled, [])  # our own copy
+        self.watcher.replace_text("plain")
+        self.assertEqual(self.clipboard.text, "plain")
+
+
+class TestBudget(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.budget = Budget(50, clock=lambda: self.now)
+
+    def test_budget(self):
+        self.assertTrue(self.budget.allow())
+        self.budget.spend(0.04)
+        self.assertTrue(self.budget.allow())
+        self.budget.spend(0.11)  # 150ms: three seconds' worth
+        self.assertFalse(self.budget.allow())
+        self.assertAlmostEqual(self.budget.retry_ms(), 2000, delta=1)
+        self.now = 1.9
+        self.assertFalse(self.budget.allow())
+        self.now = 2.01
+        self.assertTrue(self.budget.allow())
+        self.now = 100
+        self.assertAlmostEqual(self.budget.level, 0.0495)  # not drained until asked
+        self.budget.allow()
+        self.assertEqual(self.budget.level, 0)
+
+    def test_timed(self):
+        self.assertEqual(self.budget.timed(sum)([1, 2]), 3)
+        self.assertGreater(self.budget.level, 0)
+
+
+class TestClipboardWatcherPrimary(unittest.TestCase):
+    "As the indicator uses it for the PRIMARY selection"
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.clipboard = FakeClipboard(self.loop)
+        self.handled = []
+        self.budget = Budget(50, clock=lambda: self.loop.now / 1000)
+        self.watcher = ClipboardWatcher(
+            self.clipboard, self.handled.append, self.loop, ManualExecutor(), settle_ms=300,
+            prefilter=lambda text: "?" in text, budget=self.budget)
+        self.clipboard.owner_change = self.watcher.owner_changed
+
+    def test_drag(self):
+        # selecting more and more of a line, a character at a time
+        line = "see https://example.com/?utm_source=x for more"
+        for end in range(1, len(line)):
+            self.clipboard.copy(line[:end])
+            self.loop.run(16)
+        self.loop.run(1000)
+        self.assertEqual(self.handled, [line[:-1]])
+        self.assertEqual(self.clipboard.requests, 1)
+
+    def test_prefilter(self):
+        for text in ["nothing", "https://example.com/?q=1", "nothing"]:
+            self.clipboard.copy(text)
+            self.loop.run(1000)
+        self.assertEqual(self.handled, ["https://example.com/?q=1"])
+
+    def test_budget(self):
+        self.budget.spend(0.2)  # four seconds' worth
+        self.clipboard.copy("a?1")
+        self.loop.run(1000)
+        self.clipboard.copy("a?2")  # the deferred look picks up this one
+        self.loop.run(2000)
+        self.assertEqual(self.handled, [])
+        self.loop.run(1000)
+        self.assertEqual(self.handled, ["a?2"])
+
+    def test_worker_time_spent(self):
+        self.watcher.run_in_worker(lambda: sum(range(100000)), then=self.handled.append)
+        self.watcher.executor.run_pending()
+        self.assertGreater(self.budget.level, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+from tests.test_clipboard_watcher import FakeLoop
+from utm_no.panel_icon import IconAnimation, IconCache
+
+
+class TestIconCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.svg = os.path.join(self.tmp.name, "panel-eyes-left.svg")
+        self.other_svg = os.path.join(self.tmp.name, "panel-eyes-left-wink.svg")
+        for path in (self.svg, self.other_svg):
+            with open(path, "w") as fp:
+                fp.write("<svg/>")
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.renders = []
+        self.cache = IconCache(self.cache_dir, 22, self.render)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def render(self, svg_path, png_path, size):
+        self.renders.append((svg_path, size))
+        with open(png_path, "w") as fp:
+            fp.write(f"png of {svg_path} at {size}")
+
+    def test_rendered_once(self):
+        png = self.cache.get(self.svg)
+        self.assertTrue(png.startswith(self.cache_dir) and png.endswith(".png"))
+        self.assertEqual(IconCache(self.cache_dir, 22, self.render).get(self.svg), png)
+        self.assertEqual(self.renders, [(self.svg, 22)])
+
+    def test_changed(self):
+        old = self.cache.get(self.svg)
+        other = self.cache.get(self.other_svg)
+        with open(self.svg, "w") as fp:
+            fp.write("<svg></svg>")  # a new version of the icon
+        new = self.cache.get(self.svg)
+        self.assertNotEqual(new, old)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted(os.path.basename(p) for p in (new, other)))
+        self.assertNotEqual(IconCache(self.cache_dir, 44, self.render).get(self.svg), new)
+        self.assertEqual(len(self.renders), 4)
+
+    def test_render_fails(self):
+        def broken(svg_path, png_path, size):
+            raise ValueError("no SVG loader")
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(IconCache(self.cache_dir, 22, broken).get(self.svg), self.svg)
+
+
+class TestIconAnimation(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.events = []
+        self.animation = IconAnimation(
+            ["a", "b", "c"], show=self.events.append, begin=lambda: self.events.append("begin"),
+            end=lambda: self.events.append("end"), loop=self.loop, frame_ms=100)
+
+    def test_plays(self):
+        self.animation.play()
+        self.assertTrue(self.animation.playing)
+        self.loop.run(1000)
+        self.assertEqual(self.events, ["a", "begin", "b", "c", "end"])
+        self.assertFalse(self.animation.playing)
+
+    def test_restarts(self):
+        self.animation.play()
+        self.loop.run(150)
+        self.animation.play()  # a second copy, mid-animation
+        self.loop.run(1000)
+        self.assertEqual(self.events, ["a", "begin", "b", "a", "b", "c", "end"])
+        self.assertEqual(len(self.loop._sources), 0)
+
+    def test_stop(self):
+        self.animation.play()
+        self.animation.stop()
+        self.loop.run(1000)
+        self.assertEqual(self.events, ["a", "begin", "end"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from utm_no.redirect_cache import RedirectCache
+
+
+class TestRedirectCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "sub", "redirects.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make(self, **kwargs):
+        kwargs.setdefault("clock", lambda: self.now)
+        return RedirectCache(**kwargs)
+
+    def test_get_put(self):
+        cache = self.make()
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", "A")
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache["a"], "A")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.stats(),
+                         {"entries": 1, "hits": 2, "misses": 1, "evictions": 0})
+
+    def test_eviction_order(self):
+        cache = self.make(max_entries=3)
+        for url in "abc":
+            cache.put(url, url.upper())
+        cache.get("a")  # a is now the most recently used, b the least
+        cache.put("d", "D")
+        self.assertNotIn("b", cache)
+        cache.put("e", "E")  # and now c is the least recently used
+        self.assertNotIn("c", cache)
+        self.assertEqual([cache.get(u) for u in "ade"], ["A", "D", "E"])
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(len(cache), 3)
+
+    def test_expiry(self):
+        cache = self.make(ttl=100)
+        cache.put("a", "A")
+        self.now += 99
+        self.assertEqual(cache.get("a"), "A")
+        self.now += 2
+        self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_failures(self):
+        cache = self.make(failure_ttl=10)
+        cache.put_failure("a")
+        self.assertIs(cache.get("a"), RedirectCache.FAILED)
+        self.assertNotIn("a", cache)
+        with self.assertRaises(KeyError):
+            cache["a"]
+        self.now += 11
+        self.assertIsNone(cache.get("a"))
+
+    def test_persistence(self):
+        cache = self.make(path=self.path, batch_size=2)
+        def saved():
+            with sqlite3.connect(self.path) as db:
+                return db.execute("SELECT COUNT(*) FROM redirects").fetchone()[0]
+        cache.put("a", "A")
+        self.assertEqual(saved(), 0)  # not a full batch yet
+        cache.put("b", "B")
+        self.assertEqual(saved(), 2)
+        cache.put("c", "C")
+        cache.put_failure("f")
+        cache.flush()
+        again = self.make(path=self.path)
+        self.assertEqual([again.get(u) for u in "abc"], ["A", "B", "C"])
+        self.assertIs(again.get("f"), RedirectCache.FAILED)
+
+    def test_persisted_expiry_and_eviction(self):
+        cache = self.make(path=self.path, ttl=100, max_entries=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        cache.put("c", "C")  # evicts a, from disk too
+        cache.flush()
+        self.now += 101
+        cache.put("d", "D")
+        cache.flush()
+        again = self.make(path=self.path, max_entries=2)
+        self.assertEqual([again.get(u) for u in "abcd"], [None, None, None, "D"])
+
+    def test_loads_lazily(self):
+        cache = self.make(path=self.path)
+        cache.put("a", "A")
+        cache.flush()
+        again = self.make(path=self.path)
+        self.assertFalse(again._loaded)
+        self.assertEqual(again.get("a"), "A")
+        self.assertTrue(again._loaded)
+
+    def test_clear(self):
+        cache = self.make(path=self.path)
+        cache.put("a", "A")
+        cache.flush()
+        cache.clear()
+        self.assertIsNone(self.make(path=self.path).get("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import time
+import unittest
+
+from utm_no import url_handler
+from utm_no.rich_text import decode_html, fix_html, fix_html_steps, iter_url_attributes
+
+
+class TestIterUrlAttributes(unittest.TestCase):
+    def values(self, html):
+        return [(html[start:end], quote) for start, end, quote in iter_url_attributes(html)]
+
+    def test_quoting(self):
+        self.assertEqual(
+            self.values('<a href="one">x</a><img SRC=\'two\' alt="three"><a href=four>'
+                        '<a\nclass="x"\nhref = "five" /><a data-href="six">'),
+            [("one", '"'), ("two", "'"), ("four", ""), ("five", '"')])
+
+    def test_not_markup(self):
+        self.assertEqual(
+            self.values('<!-- <a href="comment"> --><script>"<a href=\'script\'>"</script>'
+                        '<STYLE>a[href="style"]{}</style><textarea><a href="textarea"></textarea>'
+                        '<p title=\'<a href="attr">\'>Text about href="text"</p><a href="real">'),
+            [("real", '"')])
+
+    def test_broken(self):
+        self.assertEqual(self.values('<a href="unterminated'), [])
+        self.assertEqual(self.values('<a = "x" href="y"'), [("y", '"')])
+        self.assertEqual(self.values('<!-- never closed <a href="x">'), [])
+        self.assertEqual(self.values('<script><a href="x">'), [])
+        self.assertEqual(self.values('< a href="x"> a < b <a'), [])
+
+
+class TestFixHtml(unittest.TestCase):
+    def test_fix(self):
+        html = ('<p class=x>See <a href="https://a.com/?v=1&amp;utm_source=tw&amp;b=2">'
+                'https://a.com/?v=1&amp;utm_source=tw</a> and '
+                "<img src='https://i.com/p.png?fbclid=1'> <a href=https://c.com/?gclid=1&v=2>c</a></p>")
+        self.assertEqual(
+            fix_html(html),
+            '<p class=x>See <a href="https://a.com/?v=1&amp;b=2">'
+            'https://a.com/?v=1&amp;utm_source=tw</a> and '
+            "<img src='https://i.com/p.png'> <a href=https://c.com/?v=2>c</a></p>")
+
+    def test_unchanged(self):
+        for html in ["<p>no links</p>", '<a href="https://a.com/?v=1">a</a>',
+                     '<a href="data:text/html,?utm_source=1">', '<a href="#?utm_source=1">']:
+            self.assertIs(fix_html(html), html)
+
+    def test_relative(self):
+        self.assertEqual(fix_html('<a href="/page?utm_medium=x&id=3">'), '<a href="/page?id=3">')
+
+    def test_tco(self):
+        url_handler.REDIRECT_CACHE.put("https://t.co/abc", 'https://example.com/"quoted"')
+        self.addCleanup(url_handler.REDIRECT_CACHE.clear)
+        html = '<a href="https://t.co/abc">x</a>'
+        self.assertIs(fix_html(html), html)
+        self.assertEqual(fix_html(html, handle_tco=True),
+                         '<a href="https://example.com/&quot;quoted&quot;">x</a>')
+        url_handler.REDIRECT_CACHE.put("https://t.co/def", "https://example.com/?utm_source=x")
+        self.assertEqual(fix_html('<a href="https://t.co/def">x</a>', handle_tco=True),
+                         '<a href="https://example.com/">x</a>')
+
+    def test_steps(self):
+        html = "".join(f'<p>{"x" * 100}<a href="https://a.com/?n={n}&utm_x=1">{n}</a></p>'
+                       for n in range(2000))
+        steps = fix_html_steps(html, step_size=10000)
+        count = 0
+        while True:
+            try:
+                next(steps)
+            except StopIteration as done:
+                fixed = done.value
+                break
+            count += 1
+        self.assertGreater(count, 20)
+        self.assertEqual(fixed, html.replace("&utm_x=1", ""))
+
+    def test_big_page_linear(self):
+        # a page of nothing but unclosed tags and attributes is no slower,
+        # per character, than a small one
+        def taken(repeat):
+            html = '<a title="?" href="x?utm_a=1" ' * repeat
+            started = time.perf_counter()
+            fix_html(html)
+            return (time.perf_counter() - started) / repeat
+        taken(100)
+        self.assertLess(taken(100000), taken(1000) * 5)
+
+
+class TestDecodeHtml(unittest.TestCase):
+    def test_decode(self):
+        self.assertEqual(decode_html("<b>é</b>".encode("utf-8")), "<b>é</b>")
+        self.assertEqual(decode_html("<b>é</b>".encode("utf-16")), "<b>é</b>")
+        self.assertEqual(decode_html(b"<b>\xff</b>"), "<b>�</b>")
+
+
+if __name__ == "__main__":
+    unittest.main()
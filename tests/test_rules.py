@@ -0,0 +1,142 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from utm_no import url_handler
+from utm_no.rules import (
+    domain_keys, host_of, load, RuleSet)
+
+
+EXAMPLE_RULES = {
+    "providers": {
+        "globalRules": {
+            "urlPattern": ".*",
+            "rules": ["(?:%3F)?utm(?:_[a-z_]*)?", "(?:%3F)?ga_[a-z_]+"],
+            "exceptions": ["^https?:\\/\\/[^/]+/[^/]+/[^/]+/-/merge_requests/new.*"]
+        },
+        "amazon": {
+            "urlPattern": "^https?:\\/\\/(?:[a-z0-9-]+\\.)*?amazon(?:\\.[a-z]{2,}){1,}",
+            "rules": ["p[fd]_rd_[a-z]*", "qid", "sr", "srs", "__mk_[a-z]{1,3}_[a-z]{1,3}"],
+            "referralMarketing": ["tag"],
+            "rawRules": ["\\/ref=[^/?]*"],
+            "exceptions": ["^https?:\\/\\/(?:[a-z0-9-]+\\.)*?amazon(?:\\.[a-z]{2,}){1,}\\/gp\\/.*?(?:redirector.html|cart|signin).*$"]
+        },
+        "youtube": {
+            "urlPattern": "^https?:\\/\\/(?:[a-z0-9-]+\\.)*?(?:youtube\\.com|youtu\\.be)",
+            "rules": ["feature", "gclid", "kw", "si"]
+        },
+        "twitter": {
+            "urlPattern": "^https?:\\/\\/(?:[a-z0-9-]+\\.)*?twitter.com",
+            "rules": ["(?:ref_?)?src", "s", "cn", "ref_url", "t"]
+        },
+        "oddball": {
+            "urlPattern": "^https?:\\/\\/[^/]*odd[^/]*\\/",
+            "rules": ["oddity"]
+        }
+    }
+}
+
+
+class TestRules(unittest.TestCase):
+    def setUp(self):
+        self.rules = RuleSet.from_clearurls(EXAMPLE_RULES)
+
+    def test_domain_keys(self):
+        providers = EXAMPLE_RULES["providers"]
+        self.assertIsNone(domain_keys(providers["globalRules"]["urlPattern"]))
+        self.assertEqual(domain_keys(providers["amazon"]["urlPattern"]), ["amazon.*"])
+        self.assertEqual(domain_keys(providers["youtube"]["urlPattern"]),
+                         ["com.youtube", "be.youtu"])
+        self.assertEqual(domain_keys(providers["twitter"]["urlPattern"]), ["com.twitter"])
+        self.assertIsNone(domain_keys(providers["oddball"]["urlPattern"]))
+        self.assertEqual(domain_keys("^https?:\\/\\/(?:www\\.)?example\\.org\\/a"), ["org.example"])
+        self.assertEqual(domain_keys("^https?:\\/\\/example\\.org$"), ["org.example"])
+        self.assertIsNone(domain_keys("^https?:\\/\\/google\\.(?:com|de)"))
+        self.assertIsNone(domain_keys("^https?:\\/\\/twitter.com.*"))
+
+    def test_host_of(self):
+        self.assertEqual(host_of("https://a:b@WWW.Example.com:80/x?y#z"), "www.example.com")
+        self.assertEqual(host_of("example.com/path"), "example.com")
+        self.assertEqual(host_of("http://[::1]:8000/"), "[::1]")
+
+    def test_providers_for(self):
+        def names(url):
+            return [p.name for p in self.rules.providers_for(url)]
+        self.assertEqual(names("https://www.amazon.co.uk/dp/1?qid=1"), ["globalRules", "amazon"])
+        self.assertEqual(names("https://youtu.be/abc?si=1"), ["globalRules", "youtube"])
+        self.assertEqual(names("https://m.youtube.com/watch?v=1"), ["globalRules", "youtube"])
+        self.assertEqual(names("https://notyoutube.com/"), ["globalRules"])
+        self.assertEqual(names("https://example.com/?si=1"), ["globalRules"])
+        self.assertEqual(names("https://very.odd.example/"), ["globalRules", "oddball"])
+        self.assertEqual(names("https://www.amazon.de/gp/cart/view.html"), ["globalRules"])
+
+    def test_matcher(self):
+        class Nothing:
+            def match(self, key):
+                return False
+        nothing = Nothing()
+        youtube = self.rules.matcher_for("https://youtube.com/watch?v=1&si=2", nothing)
+        self.assertTrue(youtube.match("si"))
+        self.assertTrue(youtube.match("SI"))
+        self.assertTrue(youtube.match("utm_source"))
+        self.assertFalse(youtube.match("v"))
+        self.assertFalse(youtube.match("sid"))  # rules match the whole key
+        elsewhere = self.rules.matcher_for("https://example.com/?si=2", nothing)
+        self.assertFalse(elsewhere.match("si"))
+        self.assertIs(self.rules.matcher_for("https://example.com/", nothing),
+                      self.rules.matcher_for("https://example.org/", nothing))
+
+    def test_raw_rules(self):
+        self.assertEqual(self.rules.apply_raw_rules("https://amazon.com/dp/1/ref=abc?x=1"),
+                         "https://amazon.com/dp/1?x=1")
+        self.assertEqual(self.rules.apply_raw_rules("https://example.com/dp/1/ref=abc"),
+                         "https://example.com/dp/1/ref=abc")
+
+    def test_lazy_compile(self):
+        self.rules.providers_for("https://youtube.com/")
+        amazon = self.rules.providers[1]
+        self.assertEqual(amazon.name, "amazon")
+        self.assertNotIn("url_regex", vars(amazon))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "data.min.json")
+            cache_dir = os.path.join(tmp, "cache")
+            with open(path, "w") as fp:
+                json.dump(EXAMPLE_RULES, fp)
+            first = load(path, cache_dir)
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, "rules-index.json")))
+            again = load(path, cache_dir)
+            self.assertEqual(again.as_dict(), first.as_dict())
+            # change the ruleset; the cache mustn't be used
+            changed = dict(EXAMPLE_RULES, providers={"youtube": EXAMPLE_RULES["providers"]["youtube"]})
+            with open(path, "w") as fp:
+                json.dump(changed, fp)
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+            self.assertEqual([p.name for p in load(path, cache_dir).providers], ["youtube"])
+
+
+    def test_fix_url(self):
+        url_handler.set_rules(self.rules)
+        try:
+            self.assertEqual(url_handler.fix_url("https://www.youtube.com/watch?v=1&si=abc"),
+                             "https://www.youtube.com/watch?v=1")
+            self.assertEqual(url_handler.fix_url("https://example.com/watch?v=1&si=abc"),
+                             "https://example.com/watch?v=1&si=abc")
+            self.assertEqual(
+                url_handler.fix_url("https://amazon.co.uk/dp/1/ref=x?tag=a&qid=2&fbclid=3&k=v"),
+                "https://amazon.co.uk/dp/1?k=v")
+            self.assertEqual(url_handler.fix_text("see https://amazon.com/dp/1/ref=x here"),
+                             "see https://amazon.com/dp/1 here")
+            unchanged = "https://example.com/a?b=c"
+            self.assertIs(url_handler.fix_url(unchanged), unchanged)
+        finally:
+            url_handler.set_rules(None)
+        self.assertEqual(url_handler.fix_url("https://youtu.be/1?si=abc"),
+                         "https://youtu.be/1?si=abc")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from utm_no import url_handler
+from utm_no.service import Client, Service, ServiceError
+
+
+class TestService(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "utm_no.sock")
+        self.service = Service(self.path).start()
+        self.client = Client(self.path, timeout=10)
+
+    def tearDown(self):
+        self.client.close()
+        self.service.close()
+        self.tmp.cleanup()
+
+    def test_fix(self):
+        self.assertEqual(self.client.fix_url("https://a.com/?utm_source=x&v=1"), "https://a.com/?v=1")
+        self.assertEqual(self.client.fix_text("see https://a.com/?fbclid=1 ok"), "see https://a.com/ ok")
+        self.assertEqual(self.client.call("fix_urls", urls=["https://a.com/?gclid=1", "b"]),
+                         ["https://a.com/", "b"])
+        self.assertEqual(self.client.call("ping"), "pong")
+        self.assertEqual(self.client.call("stats")["requests"], 5)  # counting this one
+
+    def test_pipeline(self):
+        calls = [("fix_url", {"url": f"https://a.com/?n={n}&utm_x=1"}) for n in range(500)]
+        results = self.client.pipeline(calls, window=200)
+        self.assertEqual(results, [f"https://a.com/?n={n}" for n in range(500)])
+
+    def test_raw_pipelining(self):
+        # all in one go, answered in order
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(self.path)
+            sock.sendall(b'{"id": 1, "method": "ping"}\n\nnonsense\n'
+                         b'{"id": "x", "method": "fix_url", "params": {"url": 3}}\n'
+                         b'{"id": 2, "method": "fix_url", "params": {"url": "https://a.com/?utm_a=1"}}\n')
+            sock.shutdown(socket.SHUT_WR)
+            lines = sock.makefile("rb").read().splitlines()
+        responses = [json.loads(line) for line in lines]
+        self.assertEqual(responses[0], {"id": 1, "result": "pong"})
+        self.assertIsNone(responses[1]["id"])
+        self.assertIn("not a JSON request", responses[1]["error"])
+        self.assertEqual(responses[2], {"id": "x", "error": "url should be a string"})
+        self.assertEqual(responses[3], {"id": 2, "result": "https://a.com/"})
+
+    def test_errors(self):
+        with self.assertRaisesRegex(ServiceError, "no such method 'explode'"):
+            self.client.call("explode")
+        with self.assertRaisesRegex(ServiceError, "urls should be a list"):
+            self.client.call("fix_urls", urls="https://a.com/")
+        self.assertEqual(self.client.call("ping"), "pong")  # still connected
+
+    def test_socket(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        with self.assertRaisesRegex(OSError, "already serving"):
+            Service(self.path)
+
+    def test_stale_socket(self):
+        self.client.close()
+        self.service.server.server_close()  # as if it had died, leaving the socket
+        self.assertTrue(os.path.exists(self.path))
+        self.service.close()
+        self.service = Service(self.path).start()
+        self.client = Client(self.path, timeout=10)
+        self.assertEqual(self.client.call("ping"), "pong")
+
+    def test_not_a_socket(self):
+        path = os.path.join(self.tmp.name, "precious.txt")
+        with open(path, "w") as fp:
+            fp.write("keep me")
+        with self.assertRaisesRegex(OSError, "isn't a socket"):
+            Service(path)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), "keep me")
+
+    def test_tco(self):
+        url_handler.REDIRECT_CACHE.put("https://t.co/abc", "https://example.com/landed")
+        self.addCleanup(url_handler.REDIRECT_CACHE.clear)
+        # only looked up if the service allows it
+        self.assertEqual(self.client.fix_url("https://t.co/abc", tco=True), "https://t.co/abc")
+        self.service.allow_tco = True
+        self.assertEqual(self.client.fix_url("https://t.co/abc"), "https://t.co/abc")
+        self.assertEqual(self.client.fix_url("https://t.co/abc", tco=True),
+                         "https://example.com/landed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+from unittest import mock
+
+from utm_no import url_handler
+from utm_no.stats import STATS, Histogram, Profiler, Stats, report
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 0.1)
+        # bucket tops: 50ms is under 2**16us
+        self.assertEqual(histogram.percentile(0.5), 2 ** 16 / 1e6)
+        self.assertEqual(histogram.percentile(0.99), 0.1)  # no more than the max
+        self.assertEqual(Histogram().percentile(0.5), 0.0)
+
+    def test_as_dict(self):
+        histogram = Histogram()
+        histogram.add(0)
+        histogram.add(0.0015)
+        self.assertEqual(histogram.as_dict()["buckets"], {"<1us": 1, "<2048us": 1})
+        self.assertEqual(histogram.as_dict()["mean_ms"], 0.75)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stats = Stats(enabled=True, clock=self.clock)
+
+    def test_disabled(self):
+        stats = Stats(clock=self.clock)
+        stats.count("texts")
+        started = stats.start()
+        self.assertIsNone(started)
+        stats.stop("scan", started)
+        self.assertEqual(stats.snapshot()["counters"], {})
+        self.assertEqual(stats.snapshot()["timers"], {})
+        self.assertEqual(report(stats.snapshot()), "Statistics are turned off (UTM_NO_STATS=0).")
+
+    def test_counts_and_timings(self):
+        self.stats.count("texts")
+        self.stats.count("urls", 3)
+        started = self.stats.start()
+        self.clock.now += 0.002
+        self.stats.stop("scan", started)
+        snapshot = json.loads(json.dumps(self.stats.snapshot()))
+        self.assertEqual(snapshot["counters"], {"texts": 1, "urls": 3})
+        self.assertEqual(snapshot["timers"]["scan"]["count"], 1)
+        self.assertEqual(snapshot["timers"]["scan"]["max_ms"], 2.0)
+        self.assertIn("scan: 1, ", report(snapshot))
+        self.stats.reset()
+        self.assertEqual(self.stats.snapshot()["counters"], {})
+
+    def test_url_handler(self):
+        with mock.patch.object(url_handler, "STATS", self.stats):
+            url_handler._fix_text("see https://example.com/?utm_source=x and https://example.org/")
+            url_handler._fix_text("nothing here")
+        counters = self.stats.snapshot()["counters"]
+        self.assertEqual(counters["texts fixed"], 2)
+        self.assertEqual(counters["texts skipped by prefilter"], 1)
+        self.assertEqual(counters["urls seen"], 2)
+        self.assertEqual(counters["urls changed"], 1)
+        self.assertEqual(set(self.stats.snapshot()["timers"]), {"scan", "rewrite"})
+
+    def test_off_by_default(self):
+        self.assertEqual(STATS.enabled, os.environ.get("UTM_NO_STATS") == "1")
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = Profiler(os.path.join(tmp, "utm_no.prof"))
+            self.assertEqual(profiler.call(url_handler.fix_text, "https://a.com/?utm_x=1"),
+                             "https://a.com/")
+            # something else already being profiled just runs
+            self.assertEqual(profiler.call(profiler.call, sum, [1, 2]), 3)
+            profiler.dump()
+            functions = {name for _, _, name in pstats.Stats(profiler.path).stats}
+            self.assertIn("fix_text", functions)
+
+    def test_from_environment(self):
+        with mock.patch.dict(os.environ, {"UTM_NO_PROFILE": ""}):
+            self.assertIsNone(Profiler.from_environment())
+        with mock.patch.dict(os.environ, {"UTM_NO_PROFILE": "/tmp/x.prof"}):
+            self.assertEqual(Profiler.from_environment().path, "/tmp/x.prof")
+
+
+if __name__ == "__main__":
+    unittest.main()
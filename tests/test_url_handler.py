@@ -0,0 +1,745 @@
+import io
+import sys
+import threading
+import time
+import unittest
+
+from utm_no.redirect_server import RedirectServer
+from utm_no import url_handler
+from utm_no.redirect_cache import RedirectCache
+from utm_no.url_handler import (
+    FixTextMemo, MAX_REDIRECTS, PREFILTER_STATS, PrefixMatcher, REDIRECT_CACHE,
+    STRIP_URL_QUERY_ELEMENTS_STARTS, URL_REGEX, _fix_text, contains_tco, find_urls,
+    fix_text, fix_text_steps, fix_text_stream, fix_url, fix_urls, follow_redirects,
+    is_url, iter_text_chunks, iter_url_spans, might_need_fixing, resolve_redirects,
+    scan, set_strip_prefixes, strip_query, walk_redirects)
+
+
+class TestIsUrl(unittest.TestCase):
+    def test_nope(self):
+        self.assertFalse(is_url(None))
+        self.assertFalse(is_url("lol"))
+        self.assertFalse(is_url(9))
+        self.assertFalse(is_url("http"))
+        self.assertFalse(is_url("pants://example.com"))
+        self.assertFalse(is_url("hppp://example.com"))
+
+    def test_yep(self):
+        self.assertTrue(is_url("http://example.com"))
+        self.assertTrue(is_url("https://example.com"))
+        self.assertTrue(is_url("https://example.com?lol=1"))
+        self.assertTrue(is_url("https://kryogenix.org/days"))
+        self.assertTrue(is_url("http://example.com/a/b?utm_source=haha"))
+        self.assertTrue(is_url("https://google.com"))
+        self.assertTrue(is_url("https://nope.museum?param=123#frag1"))
+        self.assertTrue(is_url("https://nope.museum:8000?param=123#frag1"))
+        self.assertTrue(is_url("https://a:b@nope.museum:8000?param=123#frag1"))
+
+class TestFixUrl(unittest.TestCase):
+    def test_simple(self):
+        self.assertEqual(fix_url("lol"), "lol")
+        self.assertEqual(fix_url(None), None)
+
+    def test_unchanged(self):
+        self.assertEqual(fix_url("https://kryogenix.org/"),
+                         "https://kryogenix.org/")
+        self.assertEqual(fix_url("http://kryogenix.org/"),
+                         "http://kryogenix.org/")
+        self.assertEqual(fix_url("https://kryogenix.org/?untouched"),
+                         "https://kryogenix.org/?untouched")
+        self.assertEqual(fix_url("https://kryogenix.org/?untouched=ok"),
+                         "https://kryogenix.org/?untouched=ok")
+        self.assertEqual(fix_url("https://kryogenix.org/?a=1&b=2"),
+                         "https://kryogenix.org/?a=1&b=2")
+
+    def test_changed(self):
+        self.assertEqual(fix_url("https://kryogenix.org/?utm_source=bye"),
+                         "https://kryogenix.org/")
+        self.assertEqual(fix_url("https://kryogenix.org/?utm_source=bye&a=1"),
+                         "https://kryogenix.org/?a=1")
+        self.assertEqual(fix_url("https://kryogenix.org/?utm_source=bye&utm_media=banner"),
+                         "https://kryogenix.org/")
+        self.assertEqual(fix_url("https://kryogenix.org/?srcid=12345"),
+                         "https://kryogenix.org/")
+        # TrackerZapper's amusing test :-)
+        self.assertEqual(fix_url("https://www.youtube.com/watch?v=dQw4w9WgXcQ&s=never&fbclid=gunna&gclid=give&gclsrc=you&utm_content=up&utm_term=never&utm_campaign=gunna&utm_medium=let&utm_source=you&utm_id=down&_ga=never&mc_cid=gunna&mc_eid=run&_bta_tid=around&_bta_c=and&trk_contact=desert&trk_msg=you&trk_module=never&trk_sid=gunna&gdfms=make&gdftrk=you&gdffi=cry&_ke=never&redirect_log_mongo_id=gunna&redirect_mongo_id=say&sb_referer_host=goodbye&mkwid=never&pcrid=gunna&ef_id=tell&s_kwcid=a&msclkid=lie&dm_i=and&epik=hurt&pk_campaign=you"),
+                         "https://www.youtube.com/watch?v=dQw4w9WgXcQ&s=never")
+
+    def test_tricks(self):
+        self.assertEqual(fix_url("https://kryogenix.org/utm_source=bye/?a=1"),
+                         "https://kryogenix.org/utm_source=bye/?a=1")
+        self.assertEqual(fix_url("https://kryogenix.org/?a=1#utm_source=bye"),
+                         "https://kryogenix.org/?a=1#utm_source=bye")
+        self.assertEqual(fix_url("https://kryogenix.org/#x?utm_source=bye"),
+                         "https://kryogenix.org/#x?utm_source=bye")
+
+    def test_verbatim(self):
+        # kept params aren't decoded and re-encoded, or reordered
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?q=a%20b+c&utm_source=x&z=%7E"),
+            "https://kryogenix.org/?q=a%20b+c&z=%7E")
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?b=2&a=1&utm_source=x&b=3"),
+            "https://kryogenix.org/?b=2&a=1&b=3")
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?flag&utm_source=x&empty="),
+            "https://kryogenix.org/?flag&empty=")
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?utm_source=x&a=1#frag"),
+            "https://kryogenix.org/?a=1#frag")
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?utm_source=x#frag"),
+            "https://kryogenix.org/#frag")
+
+    def test_semicolons(self):
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?a=1;utm_source=x;b=2"),
+            "https://kryogenix.org/?a=1;b=2")
+        self.assertEqual(
+            fix_url("https://kryogenix.org/?utm_source=x;a=1&b=2"),
+            "https://kryogenix.org/?a=1&b=2")
+
+
+class TestFixUrls(unittest.TestCase):
+    URLS = ["https://kryogenix.org/?utm_source=x", "https://example.com/",
+            "https://kryogenix.org/?utm_source=x", "https://t.co/abc?amp=1",
+            "https://example.com/?a=1&fbclid=2", "https://t.co/abc?amp=1", ""]
+
+    def tearDown(self):
+        REDIRECT_CACHE.clear()
+
+    def test_same_as_fix_url(self):
+        expected = [fix_url(url) for url in self.URLS]
+        self.assertEqual(fix_urls(self.URLS), expected)
+        self.assertEqual(fix_urls(iter(self.URLS)), expected)
+        lazy = fix_urls(iter(self.URLS), lazy=True)
+        self.assertNotIsInstance(lazy, list)
+        self.assertEqual(list(lazy), expected)
+        self.assertEqual(fix_urls([]), [])
+
+    def test_tco(self):
+        REDIRECT_CACHE["https://t.co/abc?amp=1"] = "https://kryogenix.org/"
+        expected = [fix_url(url, handle_tco=True) for url in self.URLS]
+        self.assertEqual(expected[3], "https://kryogenix.org/")
+        self.assertEqual(fix_urls(self.URLS, handle_tco=True), expected)
+        self.assertEqual(list(fix_urls(self.URLS, handle_tco=True, lazy=True)), expected)
+
+    def test_once_each(self):
+        calls = []
+        original = url_handler.fix_url
+        url_handler.fix_url = lambda url: calls.append(url) or original(url)
+        try:
+            fix_urls(self.URLS * 10)
+            self.assertEqual(sorted(calls), sorted(set(self.URLS)))
+            calls.clear()
+            list(fix_urls(self.URLS * 10, lazy=True))
+            self.assertEqual(sorted(calls), sorted(set(self.URLS)))
+        finally:
+            url_handler.fix_url = original
+
+
+class TestStripQuery(unittest.TestCase):
+    def test_strip(self):
+        self.assertEqual(strip_query("a=1&utm_source=2"), "a=1")
+        self.assertEqual(strip_query("utm_source=2"), "")
+        self.assertEqual(strip_query("a=1&&utm_source=2&b"), "a=1&b")
+
+    def test_same_object(self):
+        query = "a=1&b=2&&c"
+        self.assertIs(strip_query(query), query)
+        self.assertIs(strip_query(""), "")
+
+    def test_matcher(self):
+        self.assertEqual(strip_query("a=1&b=2", PrefixMatcher(["a"])), "b=2")
+
+
+class TestPrefixMatcher(unittest.TestCase):
+    def test_match(self):
+        m = PrefixMatcher(["utm_", "ref", "fbclid"])
+        self.assertTrue(m.match("utm_source"))
+        self.assertTrue(m.match("ref"))
+        self.assertTrue(m.match("referrer"))
+        self.assertTrue(m.match("fbclid"))
+        self.assertFalse(m.match("utm"))
+        self.assertFalse(m.match("re"))
+        self.assertFalse(m.match(""))
+        self.assertFalse(m.match("a_utm_source"))
+
+    def test_empty(self):
+        self.assertFalse(PrefixMatcher([]).match("utm_source"))
+
+    def test_agrees_with_startswith(self):
+        m = PrefixMatcher(STRIP_URL_QUERY_ELEMENTS_STARTS)
+        for k in ["utm_source", "utm-x", "_ga", "_gab", "gclid", "v", "s",
+                  "page", "hsa_cam", "spm", "otc", "ot", "mc_eid", "x_utm"]:
+            self.assertEqual(
+                m.match(k),
+                any(k.startswith(b) for b in STRIP_URL_QUERY_ELEMENTS_STARTS),
+                k)
+
+    def test_set_strip_prefixes(self):
+        original = STRIP_URL_QUERY_ELEMENTS_STARTS
+        try:
+            set_strip_prefixes(original + ["lol_"])
+            self.assertEqual(fix_url("https://kryogenix.org/?lol_a=1&b=2"),
+                             "https://kryogenix.org/?b=2")
+        finally:
+            set_strip_prefixes(original)
+        self.assertEqual(fix_url("https://kryogenix.org/?lol_a=1&b=2"),
+                         "https://kryogenix.org/?lol_a=1&b=2")
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_nothing_to_do(self):
+        self.assertFalse(might_need_fixing(""))
+        self.assertFalse(might_need_fixing("plain prose, no links"))
+        self.assertFalse(might_need_fixing("https://kryogenix.org/?a=1&b=2"))
+        self.assertFalse(might_need_fixing("x = a if b else c; utm_source()"))
+        self.assertFalse(might_need_fixing("https://t.co/abcde"))
+
+    def test_something_to_do(self):
+        self.assertTrue(might_need_fixing("https://kryogenix.org/?utm_source=x"))
+        self.assertTrue(might_need_fixing("https://kryogenix.org/?a=1&fbclid=2"))
+        self.assertTrue(might_need_fixing("https://kryogenix.org/?utm%5Fsource=x"))
+        self.assertTrue(might_need_fixing("https://t.co/abcde", handle_tco=True))
+
+    def test_same_object(self):
+        text = "here is some text with https://kryogenix.org/?a=1 in it"
+        self.assertIs(fix_text(text), text)
+        url = "https://kryogenix.org/days"
+        self.assertIs(fix_url(url), url)
+
+    def test_escaped_key(self):
+        self.assertEqual(fix_url("https://kryogenix.org/?utm%5Fsource=x&a=1"),
+                         "https://kryogenix.org/?a=1")
+
+
+class TestExtractUrl(unittest.TestCase):
+    def test_simple(self):
+        self.assertEqual(URL_REGEX.findall("https://kryogenix.org"),
+                         ["https://kryogenix.org"])
+        self.assertEqual(URL_REGEX.findall("Testing https://kryogenix.org for urls"),
+                         ["https://kryogenix.org"])
+
+    def test_complex_urls(self):
+        self.assertEqual(URL_REGEX.findall("""
+        This is https://a:b@kryogenix.org:80/lol?a=b#frag1 here
+        """),
+                         ["https://a:b@kryogenix.org:80/lol?a=b#frag1"])
+
+    def test_multiple_urls(self):
+        self.assertEqual(URL_REGEX.findall("""
+        You can go to https://kryogenix.org/days or
+        http://example.com/a/b?utm_source=haha
+        or https://google.com or https://nope.museum?param=123#frag1 or
+        any other place you fancy
+        """),
+                         [
+                         "https://kryogenix.org/days",
+                         "http://example.com/a/b?utm_source=haha",
+                         "https://google.com",
+                         "https://nope.museum?param=123#frag1"
+                         ])
+
+class TestUrlScanner(unittest.TestCase):
+    SAME_AS_REGEX = [
+        "https://kryogenix.org",
+        "Testing https://kryogenix.org for urls",
+        "This is https://a:b@kryogenix.org:80/lol?a=b#frag1 here",
+        "See [the docs](https://example.com/a?utm_source=1) now.",
+        "(see https://en.wikipedia.org/wiki/Foo_(bar)).",
+        "Visit example.com, or kryogenix.org/days! Or nope.museum",
+        "mail me at bob@example.com or bob@example.com/ please",
+        "HTTPS://EXAMPLE.COM/?utm_source=1",
+        '<a href="https://x.com/?a=1&amp;utm_source=2">x</a>',
+        "at 10:30:45, get ftp://x.org/y or https:x or http:/one",
+        "'https://x.com/q?a=b', \"https://x.com/q?c=d\"; «https://x.com/»",
+        "a.b.c.co.uk.x a--b.com.uk-c.ac. a..b.com/path:",
+        "first:\nhttps://t.co/abcde,\nsecond: https://t.co/fghij,\ndone",
+        "https://at.co/123, https://no.t.co/123, t.co/123, all no",
+        "xhttps://example.com/ and foo.comhttps://x.com/y",
+        "http://x/(a)(b)c http://x/(a http://x/()) http://x/( y)",
+        "<http://x.com/a> {http://x.com/b} [http://x.com/c]",
+    ]
+
+    def test_same_as_regex(self):
+        for text in self.SAME_AS_REGEX:
+            self.assertEqual(find_urls(text), URL_REGEX.findall(text), text)
+
+    def test_extract_url_cases(self):
+        for text in ["https://kryogenix.org",
+                     "Testing https://kryogenix.org for urls",
+                     """
+        This is https://a:b@kryogenix.org:80/lol?a=b#frag1 here
+        """, """
+        You can go to https://kryogenix.org/days or
+        http://example.com/a/b?utm_source=haha
+        or https://google.com or https://nope.museum?param=123#frag1 or
+        any other place you fancy
+        """]:
+            self.assertEqual(
+                list(iter_url_spans(text)),
+                [mo.span() for mo in URL_REGEX.finditer(text)])
+
+    def assertFast(self, text, budget=1.0):
+        started = time.perf_counter()
+        find_urls(text)
+        self.assertLess(time.perf_counter() - started, budget)
+
+    def test_adversarial(self):
+        # each of these takes URL_REGEX seconds, or forever
+        self.assertFast("http://x/" + "((a)" * 50000 + "!" * 50000)
+        self.assertFast(":a(" * 50000)
+        self.assertFast("a." * 100000 + "x")
+        self.assertFast("http://x/" + "(" * 100000)
+        self.assertFast("http://x/(" * 20000)
+        self.assertFast("@a.com" * 50000)
+
+    def test_linear(self):
+        # doubling the input shouldn't much more than double the time
+        def timed(text):
+            started = time.perf_counter()
+            find_urls(text)
+            return time.perf_counter() - started
+        small = min(timed(":a(" * 10000) for _ in range(3))
+        large = min(timed(":a(" * 40000) for _ in range(3))
+        self.assertLess(large, small * 8)
+
+
+class TestScan(unittest.TestCase):
+    def test_result(self):
+        text = "Go to https://t.co/abcde or https://kryogenix.org/?utm_source=x ok"
+        scanned = scan(text)
+        self.assertEqual(scanned.urls, ["https://t.co/abcde",
+                                        "https://kryogenix.org/?utm_source=x"])
+        self.assertEqual([text[a:b] for a, b in scanned.spans], scanned.urls)
+        self.assertEqual([s.netloc for s in scanned.splits],
+                         ["t.co", "kryogenix.org"])
+        self.assertTrue(scanned.has_tco)
+        self.assertFalse(scanned.is_single_url)
+        self.assertEqual(fix_text(text, scanned=scanned),
+                         "Go to https://t.co/abcde or https://kryogenix.org/ ok")
+
+    def test_single_url(self):
+        self.assertTrue(scan("https://kryogenix.org/?a=1").is_single_url)
+        self.assertTrue(scan("  https://kryogenix.org/?a=1\n").is_single_url)
+        self.assertFalse(scan("https://kryogenix.org/ lol").is_single_url)
+        self.assertFalse(scan("https://a.com https://b.com").is_single_url)
+        self.assertFalse(scan("").is_single_url)
+        self.assertFalse(scan("nope").has_tco)
+
+    def test_splits_are_lazy(self):
+        scanned = scan("https://kryogenix.org/?a=1")
+        self.assertIsNone(scanned._splits)
+        self.assertFalse(scanned.has_tco)  # no t.co in text; no parse needed
+        self.assertIsNone(scanned._splits)
+
+    def test_spans_are_lazy(self):
+        scanned = scan("nothing to see here")
+        self.assertIsNone(scanned._spans)
+        self.assertFalse(scanned.has_tco)  # no t.co in text; no walk needed
+        self.assertIsNone(scanned._spans)
+        self.assertEqual(scanned.urls, [])
+
+
+class TestFixTextMemo(unittest.TestCase):
+    def test_remembers(self):
+        memo = FixTextMemo()
+        text = "go to https://kryogenix.org/?utm_source=x now"
+        self.assertIsNone(memo.get(text))
+        fixed = memo.fix_text(text)
+        self.assertEqual(fixed, "go to https://kryogenix.org/ now")
+        self.assertEqual(memo.get(text), fixed)
+        self.assertIsNone(memo.get(text, handle_tco=True))
+        self.assertEqual(memo.hits, 1)
+
+    def test_echo(self):
+        memo = FixTextMemo()
+        fixed = memo.fix_text("https://kryogenix.org/?utm_source=x")
+        echo = "".join(list(fixed))  # a new but equal string, as from the clipboard
+        self.assertIs(memo.get(echo), echo)
+
+    def test_unchanged_not_kept(self):
+        memo = FixTextMemo()
+        text = "nothing to see here"
+        self.assertIs(memo.fix_text(text), text)
+        self.assertIs(memo.get(text), text)
+        self.assertEqual(memo.bytes, sys.getsizeof(text))  # just the text
+
+    def test_peek(self):
+        memo = FixTextMemo(max_entries=2)
+        text = "go to https://kryogenix.org/?utm_source=x now"
+        self.assertIsNone(memo.peek(text))
+        fixed = memo.fix_text(text)
+        self.assertEqual(memo.peek(text), fixed)
+        self.assertIs(memo.peek(fixed), fixed)
+        self.assertEqual((memo.hits, memo.misses), (0, 1))  # just fix_text's get
+        # and peeking doesn't keep the text from being the next to go
+        memo.put("https://example.com/", False, "https://example.com/")
+        self.assertIsNone(memo.peek(text))
+
+    def test_hash_collision(self):
+        class Colliding(str):
+            def __hash__(self):
+                return 42
+        memo = FixTextMemo()
+        first = Colliding("https://kryogenix.org/?utm_source=x")
+        second = Colliding("https://example.com/?fbclid=y")
+        self.assertEqual(hash(first), hash(second))
+        memo.fix_text(first)
+        self.assertIsNone(memo.get(second))
+        self.assertEqual(memo.fix_text(second), "https://example.com/")
+
+    def test_failed_lookup_not_kept(self):
+        memo = FixTextMemo()
+        self.addCleanup(REDIRECT_CACHE.clear)
+        REDIRECT_CACHE.put_failure("https://t.co/abc")  # the network's down
+        text = "see https://t.co/abc and https://kryogenix.org/?utm_source=x"
+        fixed = memo.fix_text(text, handle_tco=True)
+        self.assertEqual(fixed, "see https://t.co/abc and https://kryogenix.org/")
+        self.assertIsNone(memo.get(text, handle_tco=True))
+        REDIRECT_CACHE.clear()
+        REDIRECT_CACHE.put("https://t.co/abc", "https://example.com/")  # and it's back
+        self.assertEqual(memo.fix_text(text, handle_tco=True),
+                         "see https://example.com/ and https://kryogenix.org/")
+        self.assertIsNotNone(memo.get(text, handle_tco=True))
+
+    def test_output_is_fixed_point(self):
+        memo = FixTextMemo()
+        self.addCleanup(REDIRECT_CACHE.clear)
+        REDIRECT_CACHE.put("https://t.co/abc", "https://example.com/?utm_source=twitter&a=1")
+        text = "see https://t.co/abc now"
+        fixed = fix_text(text, True)
+        self.assertEqual(fixed, "see https://example.com/?a=1 now")
+        self.assertEqual(fix_text(fixed, True), fixed)
+        self.assertEqual(memo.fix_text(text, True), fixed)
+        self.assertIs(memo.get(fixed, True), fixed)  # the echo, rightly unchanged
+        resolved = "see https://example.com/?utm_source=twitter&a=1 now"
+        self.assertEqual(memo.fix_text(resolved, True), fixed)
+        # a t.co link that's still a t.co link after MAX_REDIRECTS hops
+        REDIRECT_CACHE.put("https://t.co/def", "https://t.co/ghi")
+        self.assertEqual(memo.fix_text("https://t.co/def", True), "https://t.co/ghi")
+        self.assertIsNone(memo.get("https://t.co/ghi", True))
+
+    def test_rules_change(self):
+        memo = FixTextMemo()
+        url = "https://kryogenix.org/?lol_a=1"
+        self.assertEqual(memo.fix_text(url), url)
+        original = STRIP_URL_QUERY_ELEMENTS_STARTS
+        try:
+            set_strip_prefixes(original + ["lol_"])
+            self.assertIsNone(memo.get(url))
+            self.assertEqual(memo.fix_text(url), "https://kryogenix.org/")
+        finally:
+            set_strip_prefixes(original)
+
+    def test_evicts_by_count(self):
+        memo = FixTextMemo(max_entries=4)
+        texts = [f"https://kryogenix.org/{n}?utm_source=x" for n in range(3)]
+        for text in texts:
+            memo.fix_text(text)  # two entries each: the text and its output
+        self.assertEqual(len(memo._entries), 4)
+        self.assertIsNone(memo.get(texts[0]))
+        self.assertIsNotNone(memo.get(texts[2]))
+
+    def test_evicts_by_size(self):
+        big = "x " * 5000 + "https://kryogenix.org/?utm_source=x"
+        memo = FixTextMemo(max_bytes=sys.getsizeof(big) * 4)  # a text, its output, and its echo
+        for n in range(5):
+            memo.fix_text(f"{n} {big}")
+        self.assertLessEqual(memo.bytes, memo.max_bytes)
+        self.assertIsNone(memo.get(f"0 {big}"))
+        self.assertIsNotNone(memo.get(f"4 {big}"))
+        huge = FixTextMemo(max_bytes=100)
+        self.assertEqual(huge.fix_text(big), big.replace("?utm_source=x", ""))
+        self.assertIsNone(huge.get(big))
+
+
+class TestFixText(unittest.TestCase):
+    def test_simple(self):
+        self.assertEqual(fix_text("""
+            here is unchanged text
+        """),
+                         """
+            here is unchanged text
+        """)
+        self.assertEqual(fix_text("""
+            here is unchanged text with an unchanged url https://kryogenix.org
+        """),
+                         """
+            here is unchanged text with an unchanged url https://kryogenix.org
+        """)
+        self.assertEqual(fix_text("""
+            here is unchanged multiline text
+            with an unchanged url
+            https://kryogenix.org
+            right here
+        """),
+                         """
+            here is unchanged multiline text
+            with an unchanged url
+            https://kryogenix.org
+            right here
+        """)
+
+    def test_changed(self):
+        self.assertEqual(fix_text("""
+            here is unchanged multiline text
+            with a changed url
+            https://kryogenix.org?utm_source=no
+            right here
+        """),
+                         """
+            here is unchanged multiline text
+            with a changed url
+            https://kryogenix.org
+            right here
+        """)
+        self.assertEqual(fix_text("""
+            here is unchanged multiline text
+            with a changed url
+            https://kryogenix.org?utm_source=no&a=1
+            right here
+        """),
+                         """
+            here is unchanged multiline text
+            with a changed url
+            https://kryogenix.org?a=1
+            right here
+        """)
+
+    def test_with_tco(self):
+        self.assertEqual(
+            fix_text(
+                "Go to https://t.co/pyzgkqT1xH?amp=1 for victory",
+                handle_tco=True
+            ),
+            "Go to https://www.ietf.org/id/draft-schoen-intarea-unicast-127-00.html for victory"
+        )
+        self.assertEqual(
+            fix_text(
+                "Go to https://kryogenix.org for victory",
+                handle_tco=True
+            ),
+            "Go to https://kryogenix.org for victory"
+        )
+        self.assertNotEqual(
+            fix_text(
+                "Go to https://kryogenix.org for victory",
+                handle_tco=True
+            ),
+            "Go to https://kryogenix.org/ for victory" # extra slash: redirect NOT followed
+        )
+
+
+class TestFixTextStream(unittest.TestCase):
+    TEXT = "\n".join(TestUrlScanner.SAME_AS_REGEX + [
+        "You can go to https://kryogenix.org/days?utm_source=x or",
+        "http://example.com/a/b?utm_source=haha&a=1;fbclid=2 and\tsee",
+        "  https://kryogenix.org/?gclid=1\r\nhttps://x.com/(a)?utm_medium=2 "
+    ]) * 3
+
+    def test_same_as_fix_text(self):
+        expected = fix_text(self.TEXT)
+        self.assertNotEqual(expected, self.TEXT)
+        for size in [1, 2, 3, 7, 16, 64, 1000, 100000]:
+            self.assertEqual("".join(fix_text_stream(self.TEXT, chunk_size=size)),
+                             expected, size)
+
+    def test_sources(self):
+        expected = fix_text(self.TEXT)
+        self.assertEqual("".join(fix_text_stream(io.StringIO(self.TEXT), chunk_size=50)),
+                         expected)
+        pieces = [self.TEXT[i:i + 13] for i in range(0, len(self.TEXT), 13)]
+        self.assertEqual("".join(fix_text_stream(iter(pieces))), expected)
+        self.assertEqual(list(fix_text_stream("")), [])
+
+    def test_chunks_cut_at_spaces(self):
+        chunks = list(iter_text_chunks(self.TEXT, chunk_size=40))
+        self.assertEqual("".join(chunks), self.TEXT)
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks[:-1]:
+            self.assertIn(chunk[-1], " \n\t\r")
+
+    def test_no_spaces(self):
+        text = "x" * 100 + "https://x.com/?utm_source=1" + "y" * 100
+        chunks = list(iter_text_chunks(text + " tail", chunk_size=10))
+        self.assertEqual(chunks, [text + " ", "tail"])
+
+    def test_long_text(self):
+        original = url_handler.STREAM_CHUNK_SIZE
+        url_handler.STREAM_CHUNK_SIZE = 64
+        checked = PREFILTER_STATS["checked"]
+        try:
+            self.assertEqual(fix_text(self.TEXT), "".join(
+                _fix_text(line) for line in self.TEXT.splitlines(True)))
+            self.assertGreater(PREFILTER_STATS["checked"] - checked, 50)  # a chunk at a time
+            unchanged = "nothing to see at https://x.com/?a=1 here\n" * 20
+            self.assertIs(fix_text(unchanged), unchanged)
+        finally:
+            url_handler.STREAM_CHUNK_SIZE = original
+
+
+    def run_steps(self, steps):
+        taken = 0
+        while True:
+            try:
+                next(steps)
+            except StopIteration as done:
+                return taken, done.value
+            taken += 1
+
+    def test_steps(self):
+        taken, fixed = self.run_steps(fix_text_steps(self.TEXT, chunk_size=100))
+        self.assertGreater(taken, 10)
+        self.assertEqual(fixed, fix_text(self.TEXT))
+        unchanged = "nothing to see here\n" * 20
+        self.assertIs(self.run_steps(fix_text_steps(unchanged, chunk_size=10))[1], unchanged)
+
+
+class TestContainsTco(unittest.TestCase):
+    def test_simple_yes(self):
+        self.assertTrue(contains_tco("https://t.co/abcde"))
+        self.assertTrue(contains_tco("http://t.co/abcde"))
+        self.assertTrue(contains_tco("This text contains https://t.co/abcde and others"))
+        self.assertTrue(contains_tco("first: https://t.co/abcde, second: https://t.co/fghij, done"))
+        self.assertTrue(contains_tco("first:\nhttps://t.co/abcde,\nsecond: https://t.co/fghij,\ndone"))
+
+    def test_simple_no(self):
+        self.assertFalse(contains_tco(""))
+        self.assertFalse(contains_tco("Nope"))
+        self.assertFalse(contains_tco("This text contains https://kryogenix.org and others"))
+        self.assertFalse(contains_tco("https://at.co/123, https://no.t.co/123, t.co/123, all no"))
+
+
+class TestResolveRedirects(unittest.TestCase):
+    def setUp(self):
+        REDIRECT_CACHE.clear()
+
+    def tearDown(self):
+        REDIRECT_CACHE.clear()
+
+    def test_parallel(self):
+        with RedirectServer(delay=0.3) as server:
+            urls = [f"{server.base}/go/{n}" for n in range(8)]
+            started = time.perf_counter()
+            resolved = resolve_redirects(urls)
+            taken = time.perf_counter() - started
+        self.assertEqual(resolved, {
+            f"{server.base}/go/{n}": f"{server.base}/landed/{n}" for n in range(8)})
+        self.assertLess(taken, 8 * 0.3 / 2)  # much quicker than one at a time
+
+    def test_duplicates_and_cache(self):
+        with RedirectServer(delay=0) as server:
+            url = f"{server.base}/go/a"
+            self.assertEqual(resolve_redirects([url, url]),
+                             {url: f"{server.base}/landed/a"})
+            self.assertEqual(resolve_redirects([url]),
+                             {url: f"{server.base}/landed/a"})
+            self.assertEqual(server.requests, [("HEAD", "/go/a")])
+
+    def test_failure_leaves_url_alone(self):
+        with RedirectServer(delay=0) as server:
+            port = server.httpd.server_address[1]
+        dead = f"http://127.0.0.1:{port}/go/gone"
+        self.assertEqual(resolve_redirects([dead]), {dead: dead})
+        # and it's remembered, so we don't keep trying
+        self.assertIs(REDIRECT_CACHE.get(dead), RedirectCache.FAILED)
+        self.assertEqual(follow_redirects(dead), dead)
+
+    def test_fix_text_with_resolved(self):
+        self.assertEqual(
+            fix_url("https://t.co/abc?amp=1", handle_tco=True,
+                    redirects={"https://t.co/abc?amp=1": "https://kryogenix.org/"}),
+            "https://kryogenix.org/")
+        REDIRECT_CACHE["https://t.co/abc?amp=1"] = "https://kryogenix.org/"
+        REDIRECT_CACHE["https://t.co/def"] = "https://example.com/?utm_source=x"
+        self.assertEqual(
+            fix_text("a https://t.co/abc?amp=1 b https://t.co/def?utm_source=z",
+                     handle_tco=True),
+            "a https://kryogenix.org/ b https://example.com/")
+        self.assertEqual(fix_urls(["https://t.co/def"], handle_tco=True),
+                         ["https://example.com/"])
+
+
+class TestWalkRedirects(unittest.TestCase):
+    def test_stops_at_destination(self):
+        with RedirectServer(delay=0, landing_size=1000000) as server:
+            self.assertEqual(walk_redirects(f"{server.base}/go/a"),
+                             f"{server.base}/landed/a")
+        # only one request made, and no page downloaded
+        self.assertEqual(server.requests, [("HEAD", "/go/a")])
+        self.assertEqual(server.bytes_sent, 0)
+
+    def test_chain(self):
+        with RedirectServer(delay=0) as server:
+            self.assertEqual(
+                walk_redirects(f"{server.base}/chain/3/a", shorteners={"127.0.0.1"}),
+                f"{server.base}/landed/a")
+        self.assertEqual([path for method, path in server.requests], [
+            "/chain/3/a", "/chain/2/a", "/chain/1/a", "/chain/0/a", "/landed/a"])
+        self.assertEqual(server.bytes_sent, 0)
+        self.assertEqual(len(server.connections), 1)  # kept alive
+
+    def test_hop_limit(self):
+        with RedirectServer(delay=0) as server:
+            self.assertEqual(
+                walk_redirects(f"{server.base}/chain/50/a", shorteners={"127.0.0.1"}),
+                f"{server.base}/chain/{50 - MAX_REDIRECTS}/a")
+
+    def test_no_head(self):
+        with RedirectServer(delay=0) as server:
+            self.assertEqual(walk_redirects(f"{server.base}/nohead/a"),
+                             f"{server.base}/landed/a")
+        self.assertEqual(server.requests,
+                         [("HEAD", "/nohead/a"), ("GET", "/nohead/a")])
+
+    def test_not_a_redirect(self):
+        with RedirectServer(delay=0) as server:
+            url = f"{server.base}/landed/a"
+            self.assertEqual(walk_redirects(url), url)
+
+    def made_once(self, make):
+        "What make() gives eight threads which all call it at once"
+        start = threading.Barrier(8)
+        made = []
+
+        def first_lookup():
+            start.wait()
+            made.append(make())
+
+        threads = [threading.Thread(target=first_lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(made), 8)
+        return made
+
+    def test_one_session(self):
+        url_handler._lookup_session = None
+        sessions = self.made_once(url_handler.lookup_session)
+        self.assertTrue(all(session is sessions[0] for session in sessions))
+
+    def test_one_executor(self):
+        old_executor = url_handler._lookup_executor
+        url_handler._lookup_executor = None
+        executors = self.made_once(url_handler.lookup_executor)
+        self.assertTrue(all(executor is executors[0] for executor in executors))
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+
+class TestFollowRedirects(unittest.TestCase):
+    def test_examples(self):
+        self.assertEqual(
+            follow_redirects("https://t.co/pyzgkqT1xH?amp=1"),
+            "https://www.ietf.org/id/draft-schoen-intarea-unicast-127-00.html")
+        self.assertEqual(
+            follow_redirects("https://kryogenix.org"), "https://kryogenix.org/")
+        self.assertEqual(
+            follow_redirects("https://kryogenix.org/"), "https://kryogenix.org/")
+
+
+if __name__ == "__main__":
+    unittest.main()
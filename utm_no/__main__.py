@@ -2,14 +2,19 @@
 import sys
 import os
 import gi
-import json
-import codecs
+import signal
 import logging
+import concurrent.futures
 
 from . import url_handler
+from .clipboard_watcher import Budget, ClipboardWatcher
+from .settings import DEFAULTS, Settings
+from . import stats
+from . import panel_icon
+from . import rich_text
 
 gi.require_version('Gtk', '3.0')
-from gi.repository import GObject, Gtk, GLib, GdkPixbuf, Gdk, Gio
+from gi.repository import GObject, Gtk, GLib, Gdk
 
 gi.require_version('AppIndicator3', '0.1')
 from gi.repository import AppIndicator3 as AppIndicator
@@ -47,10 +52,53 @@ if sv:
     APP_VERSION = f"{sv} (snap)"
 
 
+PANEL_ICONS = {
+    "panel_eyes_closed_icon": "panel-eyes-full-closed.svg",
+    "panel_eyes_left_icon": "panel-eyes-left.svg",
+    "panel_eyes_right_icon": "panel-eyes-right.svg",
+    "panel_eyes_half_right_icon": "panel-eyes-half-right.svg",
+    "panel_disabled_icon": "panel-eyes-disabled.svg",
+}
+
 LOGLEVEL = os.environ.get('LOGLEVEL', 'WARNING').upper()
 logging.basicConfig(level=LOGLEVEL)
 
 
+class ClipboardOwner:
+    """Offers the plain text and the HTML of a copy on the clipboard
+    together, which Gtk.Clipboard.set_text can't: an invisible widget owns
+    the selection, and hands over whichever one is asked for."""
+
+    TEXT_TARGETS = ["UTF8_STRING", "text/plain;charset=utf-8", "text/plain", "STRING", "TEXT"]
+    TEXT, HTML = 1, 2
+
+    def __init__(self):
+        self.text = self.html = None
+        self.widget = Gtk.Invisible()
+        self.widget.selection_add_target(
+            Gdk.SELECTION_CLIPBOARD, Gdk.Atom.intern("text/html", False), self.HTML)
+        for target in self.TEXT_TARGETS:
+            self.widget.selection_add_target(
+                Gdk.SELECTION_CLIPBOARD, Gdk.Atom.intern(target, False), self.TEXT)
+        self.widget.connect("selection-get", self.selection_get)
+        self.widget.connect("selection-clear-event", self.selection_clear)
+
+    def set(self, text, html):
+        self.text, self.html = text, html
+        if not Gtk.selection_owner_set(self.widget, Gdk.SELECTION_CLIPBOARD, Gdk.CURRENT_TIME):
+            logging.warning("Couldn't take ownership of the clipboard to put the cleaned copy on it")
+
+    def selection_get(self, widget, selection_data, info, time):
+        if info == self.HTML:
+            selection_data.set(selection_data.get_target(), 8, self.html.encode("utf-8"))
+        else:
+            selection_data.set_text(self.text, -1)
+
+    def selection_clear(self, widget, event):
+        self.text = self.html = None  # someone else has copied something
+        return False
+
+
 class UTMNOIndicator(GObject.GObject):
     def __init__(self):
         global APP_VERSION
@@ -74,11 +122,8 @@ class UTMNOIndicator(GObject.GObject):
                 logging.error(f"Tried to read /.flatpak-info but failed", e)
         if not icon_path:
             icon_path = local_icon_path
-        self.panel_eyes_closed_icon = os.path.abspath(os.path.join(icon_path, "panel-eyes-full-closed.svg"))
-        self.panel_eyes_left_icon = os.path.abspath(os.path.join(icon_path, "panel-eyes-left.svg"))
-        self.panel_eyes_right_icon = os.path.abspath(os.path.join(icon_path, "panel-eyes-right.svg"))
-        self.panel_eyes_half_right_icon = os.path.abspath(os.path.join(icon_path, "panel-eyes-half-right.svg"))
-        self.panel_disabled_icon = os.path.abspath(os.path.join(icon_path, "panel-eyes-disabled.svg"))
+        for attr, filename in PANEL_ICONS.items():
+            setattr(self, attr, os.path.abspath(os.path.join(icon_path, filename)))
         self.app_icon = os.path.abspath(os.path.join(local_icon_path, "utm_no.svg"))
 
         self.ind = AppIndicator.Indicator.new(
@@ -86,6 +131,12 @@ class UTMNOIndicator(GObject.GObject):
             AppIndicator.IndicatorCategory.HARDWARE)
         self.ind.set_status(AppIndicator.IndicatorStatus.ACTIVE)
         self.ind.set_title(APP_NAME)
+        self.animation = panel_icon.IconAnimation(
+            self.animation_frames(),
+            show=lambda icon: self.ind.set_attention_icon_full(icon, f"{APP_NAME} altering clipboard"),
+            begin=lambda: self.ind.set_status(AppIndicator.IndicatorStatus.ATTENTION),
+            end=lambda: self.ind.set_status(AppIndicator.IndicatorStatus.ACTIVE),
+            loop=GLib)
 
         self.menu = Gtk.Menu()
         self.ind.set_menu(self.menu)
@@ -102,6 +153,17 @@ class UTMNOIndicator(GObject.GObject):
         # self.mtco.show() # don't show this menu item unless we've already asked about using it
         self.menu.append(self.mtco)
 
+        self.mprimary = Gtk.CheckMenuItem.new_with_mnemonic("Clean _middle-click selection too")
+        self.mprimary.set_active(False)  # set first so we don't call the handler
+        self.mprimary.connect("toggled", self.toggle_primary, None)
+        self.mprimary.show()
+        self.menu.append(self.mprimary)
+
+        mstats = Gtk.MenuItem.new_with_mnemonic("_Statistics")
+        mstats.connect("activate", self.show_stats, None)
+        mstats.show()
+        self.menu.append(mstats)
+
         mabout = Gtk.MenuItem.new_with_mnemonic("_About")
         mabout.connect("activate", self.show_about, None)
         mabout.show()
@@ -112,60 +174,137 @@ class UTMNOIndicator(GObject.GObject):
         mquit.show()
         self.menu.append(mquit)
 
+        # scanning, fixing and t.co lookups all happen in the worker, so
+        # the main loop (and the menu) never waits on them
+        self.worker = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="utm_no-worker")
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        # the text/html version of a copy (from a browser, say) is cleaned too,
+        # and put back alongside the plain text
+        self.watcher = ClipboardWatcher(
+            clipboard, self.handleText, GLib, self.worker,
+            html_target=Gdk.Atom.intern("text/html", False), owner=ClipboardOwner())
         clipboard.connect('owner-change', self.clipboardChanged)
-        # don't monitor PRIMARY selection, the middle-click clipboard
-        # primary = Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY)
-        # primary.connect('owner-change', clipboardChanged)
+        # the PRIMARY selection, the middle-click clipboard, changes on every
+        # mouse drag, so it's only watched if asked for (see toggle_primary),
+        # and then only texts which have stopped changing, might have
+        # something to clean, and fit in the budget are looked at. It shares
+        # FIX_TEXT_MEMO with the clipboard, so nothing's cleaned twice
+        self.primary = Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY)
+        self.primary_handler = None
+        primary_settings = DEFAULTS["primary"]
+        self.primary_watcher = ClipboardWatcher(
+            self.primary, self.handlePrimary, GLib, self.worker,
+            settle_ms=primary_settings["settle_ms"], prefilter=self.primary_worth_a_look,
+            budget=Budget(primary_settings["budget_ms"]))
 
         self.fix_urls_in_text = True # hardcode this on for now; we fix URLs within copied text
-        GLib.idle_add(self.load_config)
+        self.settings = Settings(self.get_cache_file(), GLib)
+        self.max_text_size = self.settings["max_text_size"]
+        url_handler.REDIRECT_CACHE.set_path(
+            os.path.join(GLib.get_user_cache_dir(), "utm_no", "redirects.sqlite"))
+        # timings are cheap enough at our rate of a few copies a minute
+        if os.environ.get("UTM_NO_STATS") != "0":
+            stats.STATS.enabled = True
+        self.profiler = stats.Profiler.from_environment()
+        self.service = None
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.dump_stats)
+        # the settings are read, and the site rules loaded, in the worker
+        # (so before any clipboard text is looked at there)
+        self.worker.submit(self.load_config)
+        # the SVGs are used until they've been rendered to PNGs
+        self.worker.submit(self.render_icons, local_icon_path, self.panel_icon_size())
 
     def get_cache_file(self):
         return os.path.join(GLib.get_user_config_dir(), "utm_no.json")
 
     def serialise(self, *args, **kwargs):
-        # yeah, yeah, supposed to use Gio's async file stuff here. But it was
-        # writing corrupted files, and I have no idea why; probably the Python
-        # var containing the data was going out of scope or something. Anyway,
-        # we're only storing a small JSON file, so life's too short to hammer
-        # on this; we'll write with Python and take the hit.
-        fp = codecs.open(self.get_cache_file(), encoding="utf8", mode="w")
-        data = {
-            "enabled": self.mpaused.get_active(),
-            "tco": {
-                "enabled": self.mtco.get_active(),
-                "asked": self.mtco.get_visible()
-            }
-        }
-        json.dump(data, fp, indent=2)
-        fp.close()
-        logging.debug(f"Serialised {data}")
+        # this only notes the change; the settings object writes the file
+        # (all of it, atomically) once things have been quiet for a moment,
+        # in its own thread, so toggling the menu never waits on the disk
+        self.settings.update(
+            enabled=self.mpaused.get_active(),
+            tco={"enabled": self.mtco.get_active(), "asked": self.mtco.get_visible()},
+            primary={"enabled": self.mprimary.get_active()})
+
+    def load_rules(self, path, cache_dir):
+        "Runs in the worker, before any clipboard text does"
+        if not os.path.exists(path):
+            return
+        from . import rules
+        try:
+            url_handler.set_rules(rules.load(path, cache_dir))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Couldn't load site rules from {path} ({e}), so not using them")
 
     def load_config(self):
-        f = Gio.File.new_for_path(self.get_cache_file())
-        f.load_contents_async(None, self.finish_loading_history)
-
-    def finish_loading_history(self, f, res):
+        "Runs in the worker; the settings are applied back on the main loop"
+        data = self.settings.read()
+        GLib.idle_add(self.finish_loading_config, data)
+        # site-specific rules, if there's a ClearURLs ruleset where they say
+        path = os.path.join(GLib.get_user_config_dir(), data["rules"]["path"])
+        self.load_rules(path, os.path.join(GLib.get_user_cache_dir(), "utm_no"))
+
+    def finish_loading_config(self, data):
+        # setting the widgets fires their toggled handlers, which would save
+        # the settings as they are half way through (with t.co not yet
+        # shown as asked about, say), so that's switched off while we do it
+        with self.settings.applying(data):
+            if data["tco"]["asked"]: self.mtco.show()
+            if data["tco"]["enabled"]: self.mtco.set_active(True)
+            self.primary_watcher.settle_ms = data["primary"]["settle_ms"]
+            self.primary_watcher.budget = Budget(data["primary"]["budget_ms"])
+            self.mprimary.set_active(data["primary"]["enabled"])
+            self.mpaused.set_active(data["enabled"])
+        self.max_text_size = data["max_text_size"]
+        url_handler.REDIRECT_CACHE.max_entries = data["redirect_cache"]["max_entries"]
+        url_handler.REDIRECT_CACHE.ttl = data["redirect_cache"]["ttl"]
+        if data["service"]["enabled"]:
+            self.start_service(data["service"]["path"])
+
+    def start_service(self, path):
+        from .service import Service
         try:
-            success, contents, _ = f.load_contents_finish(res)
-        except GLib.Error as e:
-            logging.warning(
-                f"couldn't restore settings (error: {e}), so assuming they're blank")
-            contents = "{}"
+            self.service = Service(path, allow_tco=self.mtco.get_active()).start()
+        except OSError as e:
+            logging.warning(f"Couldn't start the cleaning service ({e})")
 
-        try:
-            data = json.loads(contents)
-        except Exception as e:
-            logging.warning(
-                f"Warning: settings file seemed to be invalid json (error: {e}), so assuming blank")
-            data = {}
-        self.mpaused.set_active(data.get("enabled", True))
-        tco = data.get("tco", {})
-        if tco.get("asked", False): self.mtco.show()
-        if tco.get("enabled", False): self.mtco.set_active(True)
-
-    def show_ask_tco_dialogue(self, clipboard, text):
+    def panel_icon_size(self):
+        display = Gdk.Display.get_default()
+        scale = max([display.get_monitor(n).get_scale_factor()
+                     for n in range(display.get_n_monitors())] or [1])
+        return panel_icon.PANEL_ICON_SIZE * scale
+
+    @staticmethod
+    def render_icon(svg_path, png_path, size):
+        from gi.repository import GdkPixbuf
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(svg_path, size, size)
+        pixbuf.savev(png_path, "png", [], [])
+
+    def render_icons(self, local_icon_path, size):
+        "Runs in the worker; the PNGs are switched to back on the main loop"
+        cache = panel_icon.IconCache(
+            os.path.join(GLib.get_user_cache_dir(), "utm_no", "icons"), size, self.render_icon)
+        icons = {attr: cache.get(os.path.join(local_icon_path, filename))
+                 for attr, filename in PANEL_ICONS.items()}
+        logging.debug(f"Panel icons at {size}px, {cache.rendered} newly rendered")
+        GLib.idle_add(self.use_rendered_icons, icons)
+
+    def use_rendered_icons(self, icons):
+        for attr, path in icons.items():
+            setattr(self, attr, path)
+        self.animation.frames = self.animation_frames()
+        self.toggle_enabled(self.mpaused, save=False)
+
+    def animation_frames(self):
+        return [
+            self.panel_eyes_right_icon,
+            self.panel_eyes_half_right_icon,
+            self.panel_eyes_closed_icon,
+            self.panel_eyes_left_icon
+        ]
+
+    def show_ask_tco_dialogue(self, text, html=None):
         dialog = Gtk.MessageDialog(
             flags=0,
             message_type=Gtk.MessageType.QUESTION,
@@ -195,69 +334,218 @@ class UTMNOIndicator(GObject.GObject):
         self.serialise()
         dialog.destroy()
         if response == Gtk.ResponseType.YES:
-            self.handleText(clipboard, text)
-
-    def handleText(self, clipboard, text):
-        if not self.mtco.get_visible() and url_handler.contains_tco(text):
+            self.handleText(text, html)
+
+    def handleText(self, text, html=None):
+        stats.STATS.count("texts copied")
+        if len(text) > self.max_text_size:
+            stats.STATS.count("texts too big")
+            logging.info(
+                f"Leaving clipboard text alone: it's {len(text)} characters long, "
+                f"over the limit of {self.max_text_size}")
+            return
+        if html is not None and len(html) > self.max_text_size:
+            html = None  # clean the text, and let the HTML go
+        handle_tco, asked_tco = self.mtco.get_active(), self.mtco.get_visible()
+        if (len(text) > 2 * url_handler.STREAM_CHUNK_SIZE and self.fix_urls_in_text
+                and not ("t.co" in text and (handle_tco or not asked_tco))):
+            # a huge paste with no t.co links to look up (or ask about) is
+            # pure number-crunching, so do it here a slice at a time
+            # between other main loop work, rather than having the worker
+            # fight the main loop for the interpreter
+            self.watcher.run_in_slices(
+                self.fix_in_slices(text, html), then=self.finish_text)
+            return
+        # settings are read here on the main loop, and the work is done in
+        # the worker, which mustn't touch GTK
+        if self.profiler:
+            self.watcher.run_in_worker(
+                self.profiler.call, self.process_contents, text, html, handle_tco, asked_tco,
+                then=self.finish_text)
+        else:
+            self.watcher.run_in_worker(
+                self.process_contents, text, html, handle_tco, asked_tco, then=self.finish_text)
+
+    def process_contents(self, text, html, handle_tco, asked_tco):
+        """Runs in the worker. process_text, and then the HTML version of
+        the copy, if there is one. Returns (text, what to do, new text,
+        html, new html)"""
+        text, action, new_text = self.process_text(text, handle_tco, asked_tco)
+        new_html = html
+        if html is not None and action == "fixed" and self.fix_urls_in_text:
+            new_html = rich_text.fix_html(html, handle_tco=handle_tco)
+        return text, action, new_text, html, new_html
+
+    def process_text(self, text, handle_tco, asked_tco):
+        "Runs in the worker. Returns (text, what to do, new text)"
+        # seen this exact text before (perhaps it's our own fixed text coming
+        # back round)? Then there's no need to look at it again
+        known = url_handler.FIX_TEXT_MEMO.get(text, handle_tco)
+        if known is text or (known is not None and self.fix_urls_in_text):
+            return text, "fixed", known
+        if len(text) > 2 * url_handler.STREAM_CHUNK_SIZE:
+            return self.process_long_text(text, handle_tco, asked_tco)
+        # nothing fix_text would change, and no t.co link to ask about? Then
+        # there's no need to walk the text for its URLs at all
+        if not url_handler.might_need_fixing(text, handle_tco) and (
+                asked_tco or "t.co" not in text):
+            return text, "fixed" if self.fix_urls_in_text else "leave", text
+        # walk the text once, and ask the result everything we need to know
+        scanned = url_handler.scan(text)
+        if not asked_tco and scanned.has_tco:
             # this is the first time we've copied a t.co address
             # ask about whether to handle them
-            self.show_ask_tco_dialogue(clipboard, text)
-            return
-        handle_tco = self.mtco.get_active()
-        if url_handler.is_url(text.strip()):
+            return text, "ask", None
+        if scanned.is_single_url:
             # if the text is nothing but a URL, handle it always
-            new_text = url_handler.fix_text(text, handle_tco=handle_tco)
+            new_text = url_handler.FIX_TEXT_MEMO.fix_text(text, handle_tco=handle_tco, scanned=scanned)
         elif self.fix_urls_in_text:
             # if the setting is on, process the whole text and handle all URLs within it
-            new_text = url_handler.fix_text(text, handle_tco=handle_tco)
+            new_text = url_handler.FIX_TEXT_MEMO.fix_text(text, handle_tco=handle_tco, scanned=scanned)
         else:
-            return text
-        if new_text == text:
-            return text
+            return text, "leave", text
+        return text, "fixed", new_text
+
+    def process_long_text(self, text, handle_tco, asked_tco):
+        """Like process_text, for a huge paste (a log file, say), which is
+        dealt with a chunk at a time rather than scanned all at once.
+        Something that big is never just a single URL."""
+        if not self.fix_urls_in_text:
+            return text, "leave", text
+        if not asked_tco and "t.co" in text and any(
+                url_handler.contains_tco(piece) for piece in url_handler.iter_text_chunks(text)):
+            return text, "ask", None
+        return text, "fixed", url_handler.FIX_TEXT_MEMO.fix_text(text, handle_tco=handle_tco)
+
+    def fix_in_slices(self, text, html):
+        "process_contents for run_in_slices: a generator which returns its result"
+        new_text = yield from url_handler.fix_text_steps(text)
+        new_html = html
+        if html is not None:
+            new_html = yield from rich_text.fix_html_steps(html)
+        return text, "fixed", new_text, html, new_html
+
+    def handlePrimary(self, text):
+        if len(text) > self.max_text_size:
+            return
+        # t.co links are looked up if that's on, but selecting one is no
+        # reason to pop up the question of whether to
+        self.primary_watcher.run_in_worker(
+            self.process_text, text, self.mtco.get_active(), True, then=self.finish_primary)
 
+    def primary_worth_a_look(self, text):
+        "On the main loop, for every settled PRIMARY selection: a quick no, mostly"
+        handle_tco = self.mtco.get_active()
+        if not url_handler.might_need_fixing(text, handle_tco):
+            return False
+        # already cleaned, here or on the clipboard, and nothing to change?
+        return url_handler.FIX_TEXT_MEMO.peek(text, handle_tco) is not text
+
+    def finish_primary(self, result):
+        text, action, new_text = result
+        if action == "fixed" and new_text != text:
+            stats.STATS.count("primary selections cleaned")
+            self.primary_watcher.replace_text(new_text)
+            logging.debug(f"Overridden primary selection to {repr(new_text)}")
+            self.animate_icon()
+
+    def finish_text(self, result):
+        "Back on the main loop, with what process_contents came up with"
+        text, action, new_text, html, new_html = result
+        if action == "ask":
+            self.show_ask_tco_dialogue(text, html)
+        elif new_text != text or new_html is not html:
+            # the text and the HTML go back together, even if only one changed
+            self.update_clipboard(new_text, new_html)
+
+    def update_clipboard(self, new_text, new_html=None):
         # The text has been changed, set it on the clipboard and flash the icon
-        clipboard.set_text(new_text, -1)
+        stats.STATS.count("clipboard updates")
+        self.watcher.replace_text(new_text, new_html)
         logging.debug(f"Overridden clipboard contents to {repr(new_text)}")
         self.animate_icon()
 
-    def animate_icon(self, step=0):
-        STEPS = [
-            self.panel_eyes_right_icon,
-            self.panel_eyes_half_right_icon,
-            self.panel_eyes_closed_icon,
-            self.panel_eyes_left_icon
-        ]
-        # if we're done, bail without recursively going on to the next step
-        if step >= len(STEPS):
-            self.ind.set_status(AppIndicator.IndicatorStatus.ACTIVE)
-            return
-        self.ind.set_attention_icon_full(STEPS[step], f"{APP_NAME} altering clipboard")
-        if step == 0:
-            self.ind.set_status(AppIndicator.IndicatorStatus.ATTENTION)
-        GLib.timeout_add(150, self.animate_icon, step + 1)
+    def animate_icon(self):
+        # another copy while it's still going starts it over, not a second one
+        self.animation.play()
 
     def clipboardChanged(self, clipboard, owner_change):
-        if not self.mpaused.get_active(): return
+        if not self.mpaused.get_active():
+            self.watcher.invalidate()
+            return
         # This should not infinitely loop, because we don't set the text
-        # unless we changed it, and if we changed it, it won't need
-        # changing again, so we won't set it a second time.
-        if clipboard.wait_is_text_available():
-            data = clipboard.wait_for_text()
-            if data:
-                ndata = data + ""  # cast to string
-                self.handleText(clipboard, ndata)
-
-    def toggle_enabled(self, widget, *args):
+        # unless we changed it, and the watcher knows not to look again at
+        # text that we set.
+        self.watcher.owner_changed()
+
+    def toggle_enabled(self, widget, *args, save=True):
         if widget.get_active():
             self.ind.set_icon_full(self.panel_eyes_closed_icon, f"{APP_NAME} running")
         else:
             self.ind.set_icon_full(self.panel_disabled_icon, f"{APP_NAME} disabled")
-        GLib.idle_add(self.serialise)
+        if save:
+            self.serialise()
+
+    def primaryChanged(self, clipboard, owner_change):
+        if not self.mpaused.get_active():
+            self.primary_watcher.invalidate()
+            return
+        self.primary_watcher.owner_changed()
+
+    def toggle_primary(self, widget, *args):
+        # not even connected unless it's wanted, so it costs nothing then
+        if widget.get_active() and self.primary_handler is None:
+            self.primary_handler = self.primary.connect('owner-change', self.primaryChanged)
+        elif not widget.get_active() and self.primary_handler is not None:
+            self.primary.disconnect(self.primary_handler)
+            self.primary_handler = None
+            self.primary_watcher.invalidate()
+        self.serialise()
 
     def toggle_tco(self, widget, *args):
-        GLib.idle_add(self.serialise)
+        self.watcher.forget()  # so re-copying the same text will look it up
+        self.primary_watcher.forget()
+        if self.service:
+            self.service.allow_tco = widget.get_active()
+        self.serialise()
+
+    def get_stats_file(self):
+        return os.path.join(GLib.get_user_cache_dir(), "utm_no", "stats.json")
+
+    def snapshot_stats(self):
+        snapshot = stats.STATS.snapshot()
+        snapshot["redirect_cache"] = url_handler.REDIRECT_CACHE.stats()
+        snapshot["prefilter"] = dict(url_handler.PREFILTER_STATS)
+        return snapshot
+
+    def dump_stats(self, *args):
+        "On SIGUSR1: kill -USR1 $(pgrep -f utm_no) writes out where the time went"
+        try:
+            stats.dump(self.get_stats_file(), self.snapshot_stats())
+            if self.profiler:
+                self.profiler.dump()
+        except OSError as e:
+            logging.warning(f"Couldn't write statistics ({e})")
+        return True  # keep listening for the signal
+
+    def show_stats(self, *args):
+        dialog = Gtk.MessageDialog(
+            flags=0,
+            message_type=Gtk.MessageType.INFO,
+            buttons=Gtk.ButtonsType.CLOSE,
+            text=f"{APP_NAME} statistics",
+        )
+        dialog.format_secondary_text(stats.report(self.snapshot_stats()))
+        dialog.connect('response', lambda *largs: dialog.destroy())
+        dialog.show()
 
     def quit(self, *args):
+        url_handler.REDIRECT_CACHE.flush()
+        self.settings.flush()
+        if self.service:
+            self.service.close()
+        if self.profiler:
+            self.profiler.dump()
         GLib.timeout_add(100, lambda *args: Gtk.main_quit())
 
     def show_about(self, *args):
@@ -269,6 +557,7 @@ class UTMNOIndicator(GObject.GObject):
         dialog.set_website('https://kryogenix.org/code/utm_no')
         dialog.set_website_label('kryogenix.org/code/utm_no')
         dialog.set_comments("Remove tracking parameters from copied links")
+        from gi.repository import GdkPixbuf  # only the About box needs it
         dialog.set_logo(GdkPixbuf.Pixbuf.new_from_file_at_size(self.app_icon, 64, 64))
         dialog.connect('response', lambda *largs: dialog.destroy())
         dialog.run()
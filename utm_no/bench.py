@@ -0,0 +1,739 @@
+"""Benchmarks for the url_handler hot paths. Run as python3 -m utm_no.bench
+
+With no arguments this times fix_url, fix_text, is_url and contains_tco
+(and fix_html, on the HTML) over generated corpora. Others are there by name, such as
+python3 -m utm_no.bench startup memory (import time and peak memory, in
+fresh interpreters), or prefixes, query, redirects, fix_urls and rules
+(head-to-head comparisons), service (the socket service against a
+process per text) and primary (CPU use while selecting text, if the
+middle-click selection is watched). --save keeps the numbers from a run as a JSON
+baseline and --baseline compares against one, exiting with status 1 if
+anything got worse by more than --threshold."""
+
+import argparse
+import concurrent.futures
+import heapq
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import urllib.parse
+
+from . import rich_text
+from . import rules
+from . import url_handler
+from .clipboard_watcher import SETTLE_MS, Budget, ClipboardWatcher
+from .redirect_server import RedirectServer
+from .service import Client
+
+
+def random_prefixes(count, seed=1):
+    rnd = random.Random(seed)
+    prefixes = set(url_handler.STRIP_URL_QUERY_ELEMENTS_STARTS)
+    while len(prefixes) < count:
+        length = rnd.randint(2, 12)
+        prefixes.add("".join(rnd.choice(string.ascii_lowercase + "_") for _ in range(length)))
+    return sorted(prefixes)
+
+
+def bench_prefix_matcher(sizes=(47, 200, 1000, 5000), number=20):
+    """Compares the old linear startswith() scan with PrefixMatcher as the
+    prefix list grows. The matcher column should stay roughly flat."""
+    keys = ["v", "s", "page", "q", "utm_source", "fbclid", "id", "lang",
+            "t", "list", "index", "pp", "feature", "ab_channel"]
+    print(f"{'prefixes':>8}  {'startswith':>12}  {'matcher':>12}")
+    for size in sizes:
+        prefixes = random_prefixes(size)
+        matcher = url_handler.PrefixMatcher(prefixes)
+
+        def old():
+            for k in keys:
+                any([k.startswith(b) for b in prefixes])
+
+        def new():
+            for k in keys:
+                matcher.match(k)
+
+        told = min(timeit.repeat(old, number=number, repeat=3)) / (number * len(keys))
+        tnew = min(timeit.repeat(new, number=number, repeat=3)) / (number * len(keys))
+        print(f"{size:>8}  {told * 1e6:>10.2f}us  {tnew * 1e6:>10.2f}us")
+
+
+def fix_url_parse_qs(url):
+    "fix_url as it was before span-based rewriting, to compare against"
+    parsed = urllib.parse.urlsplit(url)
+    qs = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+    ok_qs_keys = [k for k in qs.keys() if not url_handler.STRIP_MATCHER.match(k)]
+    if len(ok_qs_keys) == len(qs):
+        return url
+    nqs = dict([(k, qs[k]) for k in ok_qs_keys])
+    parsed = parsed._replace(query=urllib.parse.urlencode(nqs, doseq=True))
+    return urllib.parse.urlunsplit(parsed)
+
+
+def long_query_url(params, seed=1):
+    rnd = random.Random(seed)
+    pairs = []
+    for i in range(params):
+        if i % 5 == 0:
+            key = rnd.choice(["utm_source", "utm_medium", "fbclid", "gclid", "mc_eid"])
+        else:
+            key = "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(1, 8)))
+        value = urllib.parse.quote("".join(rnd.choice(string.ascii_letters + " -_/") for _ in range(rnd.randint(0, 20))))
+        pairs.append(f"{key}={value}")
+    return "https://example.com/path/to/page?" + "&".join(pairs) + "#section"
+
+
+def bench_query_rewrite(sizes=(10, 50, 100, 250), number=200):
+    """Compares parse_qs/urlencode rewriting with the span-based
+    strip_query rewriting on long querystrings."""
+    print(f"{'params':>8}  {'parse_qs':>12}  {'spans':>12}")
+    for size in sizes:
+        url = long_query_url(size)
+        told = min(timeit.repeat(lambda: fix_url_parse_qs(url), number=number, repeat=3)) / number
+        tnew = min(timeit.repeat(lambda: url_handler.fix_url(url), number=number, repeat=3)) / number
+        print(f"{size:>8}  {told * 1e6:>10.1f}us  {tnew * 1e6:>10.1f}us")
+
+
+def bench_redirects(runs=20, landing_size=2 * 1024 * 1024):
+    """Compares a full requests.get() (fresh connection, every hop, whole
+    destination page) with walk_redirects against a local redirect server
+    whose destination page is landing_size bytes."""
+    import requests
+    print(f"{'resolver':>14}  {'per lookup':>12}  {'body bytes':>12}")
+    with RedirectServer(delay=0, landing_size=landing_size) as server:
+        for name, resolve in [
+            ("requests.get", lambda url: requests.get(url).url),
+            ("walk_redirects", url_handler.walk_redirects),
+        ]:
+            sent_before = server.bytes_sent
+            started = time.perf_counter()
+            for n in range(runs):
+                resolve(f"{server.base}/go/{n}")
+            taken = (time.perf_counter() - started) / runs
+            sent = (server.bytes_sent - sent_before) / runs
+            print(f"{name:>14}  {taken * 1e3:>10.2f}ms  {sent:>12.0f}")
+
+
+def bench_fix_urls(count=1000000, distinct=100000, seed=1):
+    """fix_url one at a time against fix_urls, on count URLs drawn from
+    distinct different ones with a long-tailed (Zipf-ish) spread, as in a
+    real bookmark dump or crawl log."""
+    rnd = random.Random(seed)
+    unique = list(dict.fromkeys(random_url(rnd) for _ in range(distinct)))
+    weights = [1 / (rank + 1) for rank in range(len(unique))]
+    urls = rnd.choices(unique, weights, k=count)
+    print(f"{count} URLs, {len(set(urls))} different")
+    print(f"{'':>18}  {'total':>10}  {'per URL':>10}")
+    for name, run in [
+        ("fix_url each", lambda: [url_handler.fix_url(url) for url in urls]),
+        ("fix_urls", lambda: url_handler.fix_urls(urls)),
+        ("fix_urls lazy", lambda: list(url_handler.fix_urls(urls, lazy=True))),
+    ]:
+        started = time.perf_counter()
+        run()
+        taken = time.perf_counter() - started
+        print(f"{name:>18}  {taken:>9.2f}s  {taken / count * 1e6:>8.2f}us")
+
+
+def synthetic_ruleset(providers, seed=1):
+    "A ClearURLs-style ruleset with this many providers, each for its own site"
+    rnd = random.Random(seed)
+    data = {"globalRules": {"urlPattern": ".*", "rules": ["(?:%3F)?utm(?:_[a-z_]*)?"]}}
+    for n in range(providers):
+        site = f"site{n}"
+        params = ["".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(2, 8)))
+                  for _ in range(5)]
+        if n % 2:
+            pattern = f"^https?:\\/\\/(?:[a-z0-9-]+\\.)*?{site}\\.com"
+        else:
+            pattern = f"^https?:\\/\\/(?:[a-z0-9-]+\\.)*?{site}(?:\\.[a-z]{{2,}}){{1,}}"
+        data[site] = {"urlPattern": pattern, "rules": params + [f"{params[0]}_[a-z]+"]}
+    return {"providers": data}
+
+
+def bench_rules(sizes=(10, 100, 1000, 5000), urls_per_size=2000):
+    """fix_url with site rules, indexed by domain against checking every
+    provider's urlPattern for every URL, as the ruleset grows (once the
+    regexes involved are compiled). Also how long indexing takes, and
+    loading the index back from the disk cache."""
+    print(f"{'providers':>9}  {'index':>8}  {'cached':>8}  {'indexed fix_url':>16}  {'linear fix_url':>15}")
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = os.path.join(tmp, f"rules{size}.json")
+            with open(path, "w") as fp:
+                json.dump(synthetic_ruleset(size), fp)
+            started = time.perf_counter()
+            indexed = rules.load(path, tmp)
+            build = time.perf_counter() - started
+            started = time.perf_counter()
+            rules.load(path, tmp)
+            cached = time.perf_counter() - started
+            linear = rules.RuleSet(indexed.providers, {}, list(range(len(indexed.providers))))
+            urls = [f"https://www.site{rnd.randrange(size)}.{rnd.choice(['com', 'co.uk'])}/p?"
+                    f"a=1&utm_source=x&zz=2" for _ in range(urls_per_size)]
+            timings = []
+            for ruleset in (indexed, linear):
+                url_handler.set_rules(ruleset)
+                for url in urls:
+                    url_handler.fix_url(url)  # compile what's needed first
+                started = time.perf_counter()
+                for url in urls:
+                    url_handler.fix_url(url)
+                timings.append((time.perf_counter() - started) / len(urls))
+            url_handler.set_rules(None)
+            print(f"{size:>9}  {build * 1e3:>6.1f}ms  {cached * 1e3:>6.1f}ms  "
+                  f"{timings[0] * 1e6:>14.1f}us  {timings[1] * 1e6:>13.1f}us")
+
+
+WORDS = ("the a of to and in that is was it for on with as be at by this had not "
+         "but from or have an they which one you were all we her she there would "
+         "their will when who him been has more if no out so said what up its about "
+         "than into them can only other new some could time these two may then do "
+         "first any my now such like our over man me even most made after also did "
+         "many before must through back years where much your way well down should "
+         "because each just those people how too little state good very make world").split()
+TRACKERS = ["utm_source=newsletter", "utm_medium=email", "utm_campaign=spring_2024",
+            "fbclid=IwAR2x8kQ0xZ", "gclid=Cj0KCQjw", "mc_eid=a1b2c3", "_hsenc=p2AN",
+            "igshid=MzRlODBiNWFlZA", "si=Gq7UoQ", "utm_content=hero"]
+KEEPERS = ["v=dQw4w9WgXcQ", "page=2", "q=hello+world", "id=1234", "lang=en", "t=42s",
+           "sort=new", "ref=main", "list=PL123", "tab=readme"]
+HOSTS = ["example.com", "www.bbc.co.uk", "kryogenix.org", "github.com", "news.ycombinator.com",
+         "www.youtube.com", "en.wikipedia.org", "t.co", "docs.python.org", "shop.example.ac.uk"]
+
+
+def random_url(rnd):
+    host = rnd.choice(HOSTS)
+    if host == "t.co":
+        return "https://t.co/" + "".join(rnd.choice(string.ascii_letters) for _ in range(10))
+    path = "/".join(rnd.choice(WORDS) for _ in range(rnd.randint(0, 4)))
+    url = f"https://{host}/{path}"
+    params = rnd.sample(KEEPERS, rnd.randint(0, 2)) + rnd.sample(TRACKERS, rnd.randint(0, 3))
+    if params:
+        rnd.shuffle(params)
+        url += "?" + "&".join(params)
+    if rnd.random() < 0.1:
+        url += "#" + rnd.choice(WORDS)
+    return url
+
+
+def sentence(rnd, link_chance=0.0, link=None):
+    words = []
+    for _ in range(rnd.randint(6, 20)):
+        if rnd.random() < link_chance:
+            words.append((link or (lambda u: u))(random_url(rnd)))
+        else:
+            words.append(rnd.choice(WORDS))
+    return " ".join(words).capitalize() + rnd.choice([".", ".", ".", "?", "!"])
+
+
+def corpus_prose(rnd):
+    "Paragraphs of chat or email, with the occasional link"
+    return ["\n".join(sentence(rnd, 0.02) for _ in range(rnd.randint(2, 8)))
+            for _ in range(200)]
+
+
+def corpus_markdown(rnd):
+    "README-ish documents, thick with links"
+    def doc():
+        lines = [f"# {sentence(rnd)}", ""]
+        for _ in range(rnd.randint(10, 30)):
+            kind = rnd.random()
+            if kind < 0.4:
+                lines.append(f"- [{rnd.choice(WORDS)}]({random_url(rnd)})")
+            elif kind < 0.5:
+                lines.append(f"![{rnd.choice(WORDS)}]({random_url(rnd)})")
+            else:
+                lines.append(sentence(rnd, 0.1, lambda u: f"<{u}>"))
+        return "\n".join(lines)
+    return [doc() for _ in range(50)]
+
+
+def corpus_html(rnd):
+    "Page source: tags, attributes and links in href and src"
+    def doc():
+        parts = ["<!DOCTYPE html><html><head><title>Page</title>",
+                 f'<link rel="stylesheet" href="{random_url(rnd)}"></head><body>']
+        for _ in range(rnd.randint(20, 60)):
+            kind = rnd.random()
+            if kind < 0.4:
+                parts.append(f'<p class="x">{sentence(rnd)} <a href="{random_url(rnd)}">{rnd.choice(WORDS)}</a></p>')
+            elif kind < 0.5:
+                parts.append(f'<img src="{random_url(rnd)}" alt="{rnd.choice(WORDS)}">')
+            else:
+                parts.append(f"<div><span>{sentence(rnd)}</span></div>")
+        parts.append("</body></html>")
+        return "\n".join(parts)
+    return [doc() for _ in range(50)]
+
+
+def corpus_logs(rnd):
+    "Web server access logs, a request URL on every line"
+    def line():
+        ip = ".".join(str(rnd.randint(1, 254)) for _ in range(4))
+        url = random_url(rnd)
+        path = url.split("/", 3)[3] if url.count("/") >= 3 else ""
+        return (f'{ip} - - [10/Oct/2024:13:55:36 +0000] "GET /{path} HTTP/1.1" '
+                f'{rnd.choice([200, 200, 304, 404])} {rnd.randint(100, 90000)} '
+                f'"{random_url(rnd)}" "Mozilla/5.0 (X11; Linux x86_64)"')
+    return ["\n".join(line() for _ in range(200)) for _ in range(20)]
+
+
+def corpus_minified_js(rnd):
+    "Minified script: no whitespace to speak of, lots of dots and colons"
+    def doc():
+        parts = []
+        for _ in range(2000):
+            kind = rnd.random()
+            if kind < 0.05:
+                parts.append(f'fetch("{random_url(rnd)}")')
+            elif kind < 0.5:
+                parts.append(f"{rnd.choice(WORDS)}.{rnd.choice(WORDS)}({rnd.choice(WORDS)}:{rnd.randint(0, 99)})")
+            else:
+                parts.append(f"var {rnd.choice(WORDS)}_{rnd.randint(0, 999)}={{a:{rnd.randint(0, 9)},b:[1,2]}}")
+        return ";".join(parts)
+    return [doc() for _ in range(5)]
+
+
+def corpus_big_paste(rnd, size=4 * 1024 * 1024):
+    "A few multi-megabyte pastes of mixed everything"
+    pieces = corpus_prose(rnd) + corpus_markdown(rnd) + corpus_logs(rnd)
+    docs = []
+    for _ in range(2):
+        rnd.shuffle(pieces)
+        doc = "\n\n".join(pieces)
+        docs.append((doc * (size // len(doc) + 1))[:size])
+    return docs
+
+
+CORPORA = {
+    "prose": corpus_prose,
+    "markdown": corpus_markdown,
+    "html": corpus_html,
+    "logs": corpus_logs,
+    "minified_js": corpus_minified_js,
+    "big_paste": corpus_big_paste,
+}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def time_calls(fn, inputs, min_time):
+    """Call fn on every input, over and over for at least min_time seconds
+    (and at least once), timing each call."""
+    latencies = []
+    started = time.perf_counter()
+    rounds = 0
+    while rounds == 0 or time.perf_counter() - started < min_time:
+        for item in inputs:
+            t = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - t)
+        rounds += 1
+    return rounds, latencies
+
+
+def bench_suite(corpora=None, min_time=0.5, seed=1):
+    """Times each hot path over each corpus; returns {"corpus/function":
+    {"calls_s", "p50_us", "p99_us"}}, and "mb_s" and "urls_s" as well for
+    the functions that clean what they're given. fix_url gets the URLs
+    found in the corpus one at a time, the others get whole documents.
+    is_url and contains_tco only answer yes or no, and mostly from the
+    first few characters, so they're measured in calls a second alone."""
+    functions = {
+        "fix_url": url_handler.fix_url,
+        "fix_text": url_handler.fix_text,
+        "is_url": url_handler.is_url,
+        "contains_tco": url_handler.contains_tco,
+        "fix_html": rich_text.fix_html,  # only on the html corpus
+    }
+    predicates = ("is_url", "contains_tco")
+    results = {}
+    print(f"{'benchmark':>26}  {'calls/s':>11}  {'MB/s':>9}  {'URLs/s':>11}  "
+          f"{'p50':>10}  {'p99':>10}")
+    for corpus in corpora or CORPORA:
+        docs = CORPORA[corpus](random.Random(seed))
+        urls = [url for doc in docs for url in url_handler.find_urls(doc)]
+        for name, fn in functions.items():
+            inputs = urls if name == "fix_url" else docs
+            if not inputs or (name == "fix_html" and corpus != "html"):
+                continue
+            rounds, latencies = time_calls(fn, inputs, min_time)
+            taken = sum(latencies)
+            latencies.sort()
+            key = f"{corpus}/{name}"
+            r = results[key] = {
+                "calls_s": len(inputs) * rounds / taken,
+                "p50_us": percentile(latencies, 0.5) * 1e6,
+                "p99_us": percentile(latencies, 0.99) * 1e6,
+            }
+            if name in predicates:
+                throughput = f"{'-':>9}  {'-':>11}"
+            else:
+                size = sum(len(item.encode("utf-8")) for item in inputs) * rounds
+                r["mb_s"] = size / taken / 1e6
+                r["urls_s"] = len(urls) * rounds / taken
+                throughput = f"{r['mb_s']:>9.2f}  {r['urls_s']:>11.0f}"
+            print(f"{key:>26}  {r['calls_s']:>11.0f}  {throughput}  "
+                  f"{r['p50_us']:>8.1f}us  {r['p99_us']:>8.1f}us")
+    return results
+
+
+STARTUP_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import utm_no.%s
+print((time.perf_counter() - started) * 1000, len(sys.modules))
+"""
+
+FIRST_EVENT_SCRIPT = """
+import time
+started = time.perf_counter()
+from utm_no.__main__ import UTMNOIndicator
+from gi.repository import Gdk, GLib, Gtk
+indicator = UTMNOIndicator()
+def first_event(text):
+    print((time.perf_counter() - started) * 1000)
+    Gtk.main_quit()
+indicator.watcher.handle = first_event
+GLib.idle_add(lambda: Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD).set_text("hello", -1))
+GLib.timeout_add(10000, Gtk.main_quit)
+Gtk.main()
+"""
+
+MEMORY_SCRIPT = """
+import random, resource, sys, tracemalloc
+tracemalloc.start()
+if sys.argv[1] == "import":
+    # url_handler on its own, from nothing; not bench, nor the paste
+    import utm_no.url_handler
+    peak = tracemalloc.get_traced_memory()[1]
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, peak // 1024)
+    sys.exit()
+from utm_no import bench, url_handler
+text = "".join(bench.corpus_big_paste(random.Random(1), size=%d))
+tracemalloc.reset_peak()
+before = tracemalloc.get_traced_memory()[0]
+if sys.argv[1] == "fix_text":
+    url_handler.fix_text(text)
+elif sys.argv[1] == "scan":
+    url_handler.scan(text).splits
+elif sys.argv[1] == "stream":
+    for piece in url_handler.fix_text_stream(text):
+        pass
+peak = tracemalloc.get_traced_memory()[1] - before
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, peak // 1024)
+"""
+
+
+def run_python(script, *args):
+    "Runs script in a fresh interpreter which can import utm_no; its stdout"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run([sys.executable, "-c", script, *args],
+                            capture_output=True, text=True, env=env, timeout=60)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "failed")
+    return result.stdout.split()
+
+
+def bench_startup(runs=5):
+    """How long importing url_handler (and clean) takes in a fresh
+    interpreter, and, if there's GTK and a display, how long the indicator
+    takes from starting up to handling its first clipboard change."""
+    results = {}
+    print(f"{'startup':>22}  {'best of ' + str(runs):>10}  {'modules':>8}")
+    for module in ("url_handler", "clean"):
+        times = [run_python(STARTUP_SCRIPT % module) for _ in range(runs)]
+        best = min(float(t[0]) for t in times)
+        results[f"startup/{module}"] = {"import_ms": best, "modules": int(times[0][1])}
+        print(f"{'import ' + module:>22}  {best:>8.1f}ms  {times[0][1]:>8}")
+    try:
+        best = min(float(run_python(FIRST_EVENT_SCRIPT)[0]) for _ in range(runs))
+    except (RuntimeError, IndexError, subprocess.TimeoutExpired) as e:
+        print(f"{'first clipboard event':>22}  skipped ({e})")
+    else:
+        results["startup/first_event"] = {"first_event_ms": best}
+        print(f"{'first clipboard event':>22}  {best:>8.1f}ms")
+    return results
+
+
+def bench_memory(size=8 * 1024 * 1024):
+    """Peak memory, each in a fresh interpreter: just importing url_handler,
+    then fix_text (and a full scan) on a size-character paste, and then
+    fix_text_stream on it. "traced" is what Python allocated beyond the
+    paste itself (for the import, everything it allocated); "rss" is the
+    whole process's high-water mark."""
+    results = {}
+    print(f"{'memory':>22}  {'max rss':>10}  {'traced':>10}")
+    for what in ("import", "scan", "fix_text", "stream"):
+        rss, peak = run_python(MEMORY_SCRIPT % size, what)
+        results[f"memory/{what}"] = {"rss_kb": int(rss), "peak_kb": int(peak)}
+        print(f"{what:>22}  {int(rss) / 1024:>8.1f}MB  {int(peak) / 1024:>8.1f}MB")
+    return results
+
+
+def bench_service(texts=2000, processes=20, seed=1):
+    """Cleaning short texts (a sentence or two with links in) by starting
+    python3 -m utm_no.clean for each, against asking a running
+    python3 -m utm_no.service: one request at a time, and pipelined."""
+    rnd = random.Random(seed)
+    docs = [sentence(rnd, 0.2) for _ in range(2 * texts + processes)]
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = {}
+    print(f"{'':>20}  {'texts/s':>10}  {'p50':>10}")
+
+    def record(name, latencies, taken):
+        latencies.sort()
+        results[f"service/{name}"] = {
+            "texts_s": len(latencies) / taken, "p50_us": percentile(latencies, 0.5) * 1e6}
+        print(f"{name:>20}  {len(latencies) / taken:>10.0f}  "
+              f"{percentile(latencies, 0.5) * 1e3:>8.2f}ms")
+
+    latencies = []
+    for doc in docs[-processes:]:
+        t = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "utm_no.clean"], input=doc, env=env,
+                       capture_output=True, text=True, check=True)
+        latencies.append(time.perf_counter() - t)
+    record("process per text", latencies, sum(latencies))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "utm_no.sock")
+        # its own settings and caches, not the ones of whoever's running this
+        service_env = dict(env, XDG_CONFIG_HOME=tmp, XDG_CACHE_HOME=tmp)
+        service = subprocess.Popen([sys.executable, "-m", "utm_no.service", "--socket", path],
+                                   env=service_env)
+        try:
+            deadline = time.perf_counter() + 10
+            while not os.path.exists(path) and time.perf_counter() < deadline:
+                time.sleep(0.01)
+            with Client(path, timeout=10) as client:
+                latencies = []
+                for doc in docs[:texts]:
+                    t = time.perf_counter()
+                    client.fix_text(doc)
+                    latencies.append(time.perf_counter() - t)
+                record("service, one by one", latencies, sum(latencies))
+                # different texts, so the service's memo doesn't help
+                calls = [("fix_text", {"text": doc}) for doc in docs[texts:2 * texts]]
+                started = time.perf_counter()
+                client.pipeline(calls)
+                taken = time.perf_counter() - started
+                # latency means nothing much here; it's all one round trip
+                record("service, pipelined", [taken / texts] * texts, taken)
+        finally:
+            service.terminate()
+            service.wait()
+    return results
+
+
+class SimulatedLoop:
+    "GLib's main loop, near enough, on a pretend clock, as fast as it'll go"
+    def __init__(self):
+        self.now = 0  # ms
+        self._queue = []
+        self._removed = set()
+        self._ids = 0
+
+    def timeout_add(self, ms, fn, *args):
+        self._ids += 1
+        heapq.heappush(self._queue, (self.now + ms, self._ids, ms, fn, args))
+        return self._ids
+
+    def idle_add(self, fn, *args):
+        return self.timeout_add(0, fn, *args)
+
+    def source_remove(self, source_id):
+        self._removed.add(source_id)
+
+    def run(self):
+        while self._queue:
+            when, source_id, ms, fn, args = heapq.heappop(self._queue)
+            if source_id in self._removed:
+                self._removed.discard(source_id)
+                continue
+            self.now = when
+            if fn(*args):
+                heapq.heappush(self._queue, (self.now + max(ms, 1), source_id, ms, fn, args))
+
+
+class SimulatedSelection:
+    "A selection which changes when told to, and answers straight away"
+    def __init__(self, loop):
+        self.loop = loop
+        self.text = None
+        self.owner_change = lambda: None
+
+    def select(self, text):
+        self.text = text
+        self.owner_change()
+
+    def request_text(self, callback, data):
+        self.loop.idle_add(callback, self, self.text, data)
+
+    def set_text(self, text, length):
+        self.select(text)
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def selection_events(seconds, seed=1):
+    """(ms, selected text) for seconds of someone selecting text with the
+    mouse: drags of a second or three through a long page with links in,
+    the selection growing every frame, with the odd pause mid-drag."""
+    rnd = random.Random(seed)
+    page = "\n".join(sentence(rnd, 0.05) for _ in range(3000))
+    events = []
+    now = 0
+    while now < seconds * 1000:
+        start = rnd.randrange(len(page) - 80000)
+        end = start
+        for _ in range(rnd.randint(60, 180)):
+            end += rnd.randint(20, 400)
+            now += rnd.choice([16] * 8 + [150, 400])
+            events.append((now, page[start:end]))
+        now += rnd.randint(300, 2000)  # let go, read, start another
+    return events
+
+
+def bench_primary(seconds=60):
+    """CPU used while the middle-click (PRIMARY) selection changes all the
+    time, simulated: handling every change as it comes, handling it as the
+    clipboard is (once it's settled for 75ms), and as the indicator does
+    PRIMARY (once it's been still for 300ms, if it gets past the prefilter,
+    within a budget of 50ms a second). The nothing row is the cost of the
+    simulation itself."""
+    events = selection_events(seconds)
+    print(f"{len(events)} selection changes in {seconds}s")
+    print(f"{'':>20}  {'handled':>8}  {'CPU ms/s':>9}  {'of a core':>9}")
+    results = {}
+    for name, settle_ms, primary in [
+        ("nothing", None, False),
+        ("every change", 0, False),
+        ("clipboard settling", SETTLE_MS, False),
+        ("primary mode", 300, True),
+    ]:
+        loop = SimulatedLoop()
+        selection = SimulatedSelection(loop)
+        memo = url_handler.FixTextMemo()
+        handled = []
+        if settle_ms is not None:
+            def handle(text, watcher=None):
+                handled.append(text)
+                watcher.run_in_worker(memo.fix_text, text, then=lambda result: None)
+            budget = prefilter = None
+            if primary:
+                budget = Budget(50, clock=lambda: loop.now / 1000)
+                prefilter = lambda text: (url_handler.might_need_fixing(text)
+                                          and memo.get(text) is not text)
+            watcher = ClipboardWatcher(selection, None, loop, InlineExecutor(),
+                                       settle_ms=settle_ms, prefilter=prefilter, budget=budget)
+            watcher.handle = lambda text: handle(text, watcher)
+            selection.owner_change = watcher.owner_changed
+        for when, text in events:
+            loop.timeout_add(when, selection.select, text)
+        started = time.process_time()
+        loop.run()
+        cpu = (time.process_time() - started) * 1000 / (loop.now / 1000)
+        results[f"primary/{name}"] = {"handled": len(handled), "cpu_ms_s": cpu}
+        print(f"{name:>20}  {len(handled):>8}  {cpu:>9.2f}  {cpu / 10:>8.1f}%")
+    return results
+
+
+HIGHER_IS_BETTER = ("mb_s", "calls_s", "texts_s")
+LOWER_IS_BETTER = ("p50_us", "import_ms", "first_event_ms", "rss_kb", "peak_kb", "cpu_ms_s")
+
+
+def compare(results, baseline, threshold):
+    """Lists the benchmarks which got worse by more than threshold (0.2 is
+    20%) against baseline: throughput down, or latency, startup time or
+    memory up."""
+    regressions = []
+    for key, old in baseline.items():
+        new = results.get(key)
+        if new is None:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            if metric not in old or metric not in new:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = new[metric] < old[metric] / (1 + threshold)
+            else:
+                worse = new[metric] > old[metric] * (1 + threshold)
+            if worse:
+                regressions.append(f"{key}: {metric} {old[metric]:.2f} -> {new[metric]:.2f}")
+    return regressions
+
+
+BENCHES = {
+    "suite": None,  # bench_suite, which takes the command line options
+    "startup": bench_startup,
+    "memory": bench_memory,
+    "prefixes": bench_prefix_matcher,
+    "query": bench_query_rewrite,
+    "redirects": bench_redirects,
+    "fix_urls": bench_fix_urls,
+    "rules": bench_rules,
+    "service": bench_service,
+    "primary": bench_primary,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m utm_no.bench", description=__doc__.split("\n")[0])
+    parser.add_argument("benches", nargs="*", metavar="|".join(BENCHES),
+                        help="which benchmarks to run (default suite)")
+    parser.add_argument("--corpus", action="append", choices=list(CORPORA),
+                        help="only this corpus (may be given more than once)")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="seconds to spend on each benchmark (default %(default)s)")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results with this baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="how much worse counts as a regression (default %(default)s, i.e. 20%%)")
+    args = parser.parse_args(argv)
+    for bench in args.benches:
+        if bench not in BENCHES:
+            parser.error(f"no such benchmark {bench!r}")
+
+    results = {}
+    for i, bench in enumerate(args.benches or ["suite"]):
+        if i:
+            print()
+        if bench == "suite":
+            results.update(bench_suite(args.corpus, args.min_time))
+        else:
+            results.update(BENCHES[bench]() or {})
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "saved": time.time(), "results": results}, fp, indent=2)
+        print(f"Saved baseline to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline} (threshold {args.threshold:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
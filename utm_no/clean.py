@@ -0,0 +1,176 @@
+"""Clean the URLs in files, or stdin, without the indicator (and so without
+GTK): python3 -m utm_no.clean [--in-place] [--stats] [FILE...]
+
+Big inputs are cut into chunks of whole lines which are cleaned in
+parallel across a pool of processes, and written out in the same order."""
+
+import argparse
+import collections
+import concurrent.futures
+import io
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from . import url_handler
+
+CHUNK_SIZE = 1024 * 1024  # characters, give or take a line
+ENCODING = dict(encoding="utf-8", errors="surrogateescape", newline="")
+
+
+def line_chunks(fp, chunk_size=CHUNK_SIZE):
+    """Yields the text of fp in chunks of whole lines, about chunk_size long.
+    A line break is whitespace, so no URL is ever split between chunks."""
+    while True:
+        lines = fp.readlines(chunk_size)
+        if not lines:
+            return
+        yield "".join(lines)
+
+
+def clean_chunk(chunk, handle_tco=False, count_urls=False):
+    "Returns (fixed chunk, Counter of what happened). Runs in the pool."
+    stats = collections.Counter(chunks=1, characters=len(chunk))
+    scanned = None
+    if count_urls:
+        scanned = url_handler.scan(chunk)
+        stats["urls"] = len(scanned.spans)
+    fixed = url_handler.fix_text(chunk, handle_tco=handle_tco, scanned=scanned)
+    if fixed is not chunk:
+        stats["chunks changed"] = 1
+        stats["characters removed"] = len(chunk) - len(fixed)
+    return fixed, stats
+
+
+class Cleaner:
+    """Cleans streams, handing chunks to a process pool (started the first
+    time an input turns out to be more than one chunk long) and adding up
+    what happened in stats."""
+
+    def __init__(self, jobs=None, handle_tco=False, count_urls=False, chunk_size=CHUNK_SIZE):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.handle_tco = handle_tco
+        self.count_urls = count_urls
+        self.chunk_size = chunk_size
+        self.stats = collections.Counter()
+        self._pool = None
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def clean(self, src, dst):
+        """Writes src, cleaned, to dst. Returns True if anything changed."""
+        self.stats["files"] += 1
+        chunks = line_chunks(src, self.chunk_size)
+        first, second = next(chunks, None), next(chunks, None)
+        chunks = itertools.chain(filter(None, [first, second]), chunks)
+        if second is None or self.jobs == 1:
+            # not worth a trip through the pool
+            results = (clean_chunk(chunk, self.handle_tco, self.count_urls) for chunk in chunks)
+        else:
+            results = self._in_pool(chunks)
+        changed = False
+        for fixed, stats in results:
+            dst.write(fixed)
+            self.stats.update(stats)
+            changed = changed or "chunks changed" in stats
+        return changed
+
+    def _in_pool(self, chunks):
+        """Results for chunks, in order, with no more than a couple of
+        chunks per process in flight (so we don't read all of a huge file
+        into memory before writing any of it out)."""
+        pool = self.pool()
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(clean_chunk, chunk, self.handle_tco, self.count_urls))
+            if len(pending) >= 2 * self.jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def clean_in_place(self, path):
+        "Rewrites the file at path, if any of its URLs need cleaning"
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path, **ENCODING) as src, tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=".utm_no-", delete=False, **ENCODING) as dst:
+            try:
+                changed = self.clean(src, dst)
+            except BaseException:
+                os.unlink(dst.name)
+                raise
+        if not changed:
+            os.unlink(dst.name)
+            return False
+        shutil.copymode(path, dst.name)
+        os.replace(dst.name, path)
+        return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m utm_no.clean",
+        description="Remove tracking parameters from the URLs in files (or stdin)")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+                        help="files to clean; with none (or -), read stdin")
+    parser.add_argument("-i", "--in-place", action="store_true",
+                        help="rewrite the files rather than printing them")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="processes to use for big inputs (default: one per CPU)")
+    parser.add_argument("--tco", action="store_true",
+                        help="look up t.co links and replace them with where they go")
+    parser.add_argument("--stats", action="store_true",
+                        help="print a summary of what was done to stderr")
+    args = parser.parse_args(argv)
+    files = args.files or ["-"]
+    if args.in_place and "-" in files:
+        parser.error("can't rewrite stdin in place")
+
+    started = time.perf_counter()
+    status = 0
+    stdout = io.TextIOWrapper(sys.stdout.buffer, **ENCODING)
+    with Cleaner(args.jobs, args.tco, count_urls=args.stats) as cleaner:
+        for name in files:
+            try:
+                if name == "-":
+                    changed = cleaner.clean(io.TextIOWrapper(sys.stdin.buffer, **ENCODING), stdout)
+                elif args.in_place:
+                    changed = cleaner.clean_in_place(name)
+                else:
+                    with open(name, **ENCODING) as src:
+                        changed = cleaner.clean(src, stdout)
+                cleaner.stats["files changed"] += changed
+            except OSError as e:
+                print(f"utm_no.clean: {name}: {e.strerror or e}", file=sys.stderr)
+                status = 1
+        stdout.flush()
+    if args.stats:
+        taken = time.perf_counter() - started
+        stats = cleaner.stats
+        print(f"{stats['files']} files ({stats['files changed']} changed), "
+              f"{stats['chunks']} chunks ({stats['chunks changed']} changed), "
+              f"{stats['characters']} characters, {stats['urls']} URLs, "
+              f"{stats['characters removed']} characters of tracking removed, "
+              f"in {taken:.2f}s ({stats['characters'] / taken / 1e6:.1f}M characters/s)",
+              file=sys.stderr)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
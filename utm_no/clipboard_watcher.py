@@ -0,0 +1,268 @@
+"Turn bursts of clipboard owner-change events into one look at each copy"
+
+import collections
+import logging
+import threading
+import time
+
+from . import rich_text
+from .stats import STATS
+
+SETTLE_MS = 75
+SLICE_MS = 8  # how long each slice of run_in_slices may hold up the main loop
+
+
+class Budget:
+    """A cap on processing time: ms_per_second of it on average, and no
+    more than a second's worth in one go. spend() what was used; allow()
+    says whether there's any left right now, and retry_ms() how long until
+    there will be. Safe to spend from the worker while the main loop asks."""
+
+    def __init__(self, ms_per_second, clock=time.monotonic):
+        self.allowance = ms_per_second / 1000
+        self.clock = clock
+        self.level = 0.0
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _drain(self):
+        now = self.clock()
+        self.level = max(0.0, self.level - (now - self._last) * self.allowance)
+        self._last = now
+
+    def allow(self):
+        with self._lock:
+            self._drain()
+            return self.level < self.allowance
+
+    def spend(self, seconds):
+        with self._lock:
+            self._drain()
+            self.level += seconds
+
+    def retry_ms(self):
+        with self._lock:
+            self._drain()
+            return max(1, int((self.level - self.allowance) / self.allowance * 1000) + 1)
+
+    def timed(self, fn):
+        "fn, but spending however long each call takes"
+        def timed_fn(*args):
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.spend(time.perf_counter() - started)
+        return timed_fn
+
+
+class ClipboardWatcher:
+    """Some apps fire owner-change several times for one copy, and our own
+    set_text fires it again. Call owner_changed() for each of those: once
+    they've stopped coming for settle_ms, the text is fetched with the
+    callback-based request_text (no nested main loops) and, if it's not the
+    same as the last text we saw, passed to handle(text) on the main loop.
+    With an html_target (the text/html atom), that's fetched too, and it's
+    handle(text, html), html being None if the copy didn't have any; then
+    it's the same copy only if the text and the HTML both are.
+    A copy whose work was dropped, or is still going and so will be, as the
+    clipboard changed under it (if only to be announced afresh), doesn't
+    count as seen.
+
+    Slow work goes through run_in_worker(), or run_in_slices() on the main
+    loop itself; either way the result only comes back if the clipboard
+    hasn't changed in the meantime.
+
+    For the PRIMARY selection, which changes all the way through every
+    mouse drag, there's prefilter(text), which says whether a settled text
+    is worth handling at all, and budget, a Budget: while that's spent,
+    handling waits (and then takes whatever the text is by then).
+
+    loop is anything with GLib's timeout_add, source_remove and idle_add,
+    which is GLib itself when running for real; it's a parameter so this
+    can be tested without a display."""
+
+    def __init__(self, clipboard, handle, loop, executor, settle_ms=SETTLE_MS,
+                 slice_ms=SLICE_MS, clock=time.monotonic, html_target=None, owner=None,
+                 prefilter=None, budget=None):
+        self.clipboard = clipboard
+        self.prefilter = prefilter
+        self.budget = budget
+        self.html_target = html_target
+        self.owner = owner  # for replace_text with html; see its docstring
+        self.handle = handle
+        self.loop = loop
+        self.executor = executor
+        self.settle_ms = settle_ms
+        self.slice_ms = slice_ms
+        self.clock = clock
+        self.generation = 0
+        self.last_copy = None
+        self._timer = None
+        self._requested = None
+        self._handing = None  # the copy handle() is being called with
+        self._unfinished = collections.Counter()  # copy -> work on it not yet back
+
+    def owner_changed(self, *args):
+        self.invalidate()
+        if self._timer is not None:
+            self.loop.source_remove(self._timer)
+        self._timer = self.loop.timeout_add(self.settle_ms, self._settled)
+
+    def invalidate(self):
+        "Note that the clipboard has changed, so work in progress is stale"
+        self.generation += 1
+
+    def forget(self):
+        "Look at the next copy even if it's the same as the last one"
+        self.last_copy = None
+
+    def _settled(self):
+        self._timer = None
+        self._requested = STATS.start()
+        self.clipboard.request_text(self._received, self.generation)
+        return False
+
+    def _received(self, clipboard, text, generation):
+        STATS.stop("clipboard wait", self._requested)
+        if generation != self.generation:
+            return  # it changed again while we were asking
+        if not text:
+            return
+        if self.html_target is None:
+            self._consider(text, text)
+            return
+        # the HTML first, as a copy with the same text as the last one can
+        # still have different HTML (a link labelled "here", say)
+        self.clipboard.request_contents(self.html_target, self._received_html, (generation, text))
+
+    def _received_html(self, clipboard, selection_data, data):
+        generation, text = data
+        if generation != self.generation:
+            return
+        html = None
+        if selection_data is not None and selection_data.get_length() > 0:
+            html = rich_text.decode_html(selection_data.get_data())
+        self._consider((text, html), text, html)
+
+    def _consider(self, copy, text, *html):
+        "copy is what a copy is known by: text, or (text, html) with an html_target"
+        if copy == self.last_copy and not self._unfinished[copy]:
+            logging.debug("Clipboard contents are the same as last time, so ignoring them")
+            return
+        if self.prefilter is not None:
+            started = time.perf_counter()
+            worth_it = self.prefilter(text)
+            if self.budget is not None:
+                self.budget.spend(time.perf_counter() - started)
+            if not worth_it:
+                self.last_copy = copy
+                return
+        if self.budget is not None and not self.budget.allow():
+            logging.debug("Over the processing budget, so looking again later")
+            self._timer = self.loop.timeout_add(self.budget.retry_ms(), self._settled)
+            return
+        self.last_copy = copy
+        # so that run_in_worker and run_in_slices know what they're working on
+        self._handing = copy
+        try:
+            self.handle(text, *html)
+        finally:
+            self._handing = None
+
+    def _started_on(self, copy):
+        if copy is not None:
+            self._unfinished[copy] += 1
+
+    def _done_with(self, copy, dropped=False):
+        if copy is None:
+            return
+        self._unfinished[copy] -= 1
+        if not self._unfinished[copy]:
+            del self._unfinished[copy]
+        if dropped and copy == self.last_copy and not self._unfinished[copy]:
+            self.last_copy = None  # it was never dealt with
+
+    def run_in_worker(self, fn, *args, then):
+        """Run fn(*args) in the worker, then call then(result) on the main
+        loop; but only if the clipboard hasn't changed since."""
+        generation = self.generation
+        copy = self._handing
+        started = STATS.start()
+        if self.budget is not None:
+            fn = self.budget.timed(fn)
+        self._started_on(copy)
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(
+            lambda f: self.loop.idle_add(self._finished, generation, f, then, started, copy))
+
+    def _finished(self, generation, future, then, started=None, copy=None):
+        # from handing it to the worker to having the answer on the main loop
+        STATS.stop("worker", started)
+        if generation != self.generation:
+            logging.debug("Clipboard changed while working on it, so dropping the result")
+            self._done_with(copy, dropped=True)
+            return False
+        self._done_with(copy)
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.warning(f"Couldn't process clipboard text: {e}")
+            return False
+        then(result)
+        return False
+
+    def run_in_slices(self, steps, then):
+        """Run the generator steps on the main loop, a slice at a time: each
+        idle callback takes steps until slice_ms has gone by, so the menu and
+        the icon keep going in between. When it's finished, call then() with
+        what it returned; but if the clipboard changes first, give up."""
+        generation = self.generation
+        copy = self._handing
+        self._started_on(copy)
+        self.loop.idle_add(self._slice, generation, steps, then, copy)
+
+    def _slice(self, generation, steps, then, copy=None):
+        started = STATS.start()
+        next_slice = self._next_slice
+        if self.budget is not None:
+            next_slice = self.budget.timed(next_slice)
+        dropped = generation != self.generation
+        more = False
+        try:
+            more = next_slice(generation, steps, then)
+            return more
+        finally:
+            STATS.stop("main loop slice", started)
+            if not more:
+                self._done_with(copy, dropped)
+
+    def _next_slice(self, generation, steps, then):
+        if generation != self.generation:
+            logging.debug("Clipboard changed while working on it, so stopping")
+            steps.close()
+            return False
+        deadline = self.clock() + self.slice_ms / 1000
+        try:
+            while self.clock() < deadline:
+                next(steps)
+        except StopIteration as done:
+            then(done.value)
+            return False
+        except Exception as e:
+            logging.warning(f"Couldn't process clipboard text: {e}")
+            return False
+        return True  # more to do, next time the loop's idle
+
+    def replace_text(self, text, html=None):
+        """Put text on the clipboard, without then going on to process it
+        again. With html, both go on together, through owner.set(text, html)
+        (the clipboard's own set_text can only offer the one)."""
+        if self.owner is None:
+            html = None
+        # what we're about to put there, as the echo of it will be seen
+        self.last_copy = text if self.html_target is None else (text, html)
+        if html is not None:
+            self.owner.set(text, html)
+        else:
+            self.clipboard.set_text(text, -1)
@@ -0,0 +1,109 @@
+"""The panel icon: its frames rendered once to PNGs at the panel's size, so
+the panel isn't rasterising SVGs every frame, and the animation played
+when the clipboard's been cleaned. Nothing here needs GTK itself; the
+indicator passes in the renderer and GLib."""
+
+import hashlib
+import logging
+import os
+
+FRAME_MS = 150
+PANEL_ICON_SIZE = 22  # pixels, before any HiDPI scaling
+
+
+class IconCache:
+    """PNGs of SVG icons at one size, in cache_dir. Each is named for the
+    SVG's name and its mtime, file size and the pixel size, so an updated
+    icon (or a new panel size) gets rendered afresh; the old renders of
+    that icon are tidied away when it is.
+
+    render(svg_path, png_path, size) does the drawing; the indicator's
+    uses GdkPixbuf. If it fails, get() hands back the SVG instead."""
+
+    def __init__(self, cache_dir, size, render):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.render = render
+        self.rendered = 0
+
+    def png_path(self, svg_path):
+        stat = os.stat(svg_path)
+        key = hashlib.sha1(
+            f"{stat.st_mtime_ns}:{stat.st_size}:{self.size}".encode()).hexdigest()[:12]
+        name = os.path.splitext(os.path.basename(svg_path))[0]
+        return os.path.join(self.cache_dir, f"{name}-{self.size}px-{key}.png")
+
+    def get(self, svg_path):
+        "The path of a PNG of svg_path, rendering it if it's not there yet"
+        try:
+            png_path = self.png_path(svg_path)
+            if os.path.exists(png_path):
+                return png_path
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = png_path + ".tmp"
+            self.render(svg_path, temp_path, self.size)
+            os.replace(temp_path, png_path)
+            self.rendered += 1
+        except Exception as e:
+            logging.warning(f"Couldn't render {svg_path} at {self.size}px ({e}), so using it as is")
+            return svg_path
+        self._remove_old_renders(png_path)
+        return png_path
+
+    def _remove_old_renders(self, png_path):
+        prefix = os.path.basename(png_path).rsplit("-", 2)[0] + "-"
+        for name in os.listdir(self.cache_dir):
+            if (name.startswith(prefix) and name.endswith(".png")
+                    and name != os.path.basename(png_path)
+                    and name[len(prefix):].count("-") == 1):  # not another icon's
+                try:
+                    os.unlink(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+
+class IconAnimation:
+    """Plays frames one after another, frame_ms apart, with one timer. Asking
+    it to play() while it's already going starts it again from the first
+    frame on the timer it's got, rather than running two at once; so a
+    burst of copies is one longer animation.
+
+    show(frame) puts a frame up, begin() is called as it starts and end()
+    when it's done. loop is anything with GLib's timeout_add and
+    source_remove, which is GLib itself when running for real."""
+
+    def __init__(self, frames, show, begin, end, loop, frame_ms=FRAME_MS):
+        self.frames = frames
+        self.show = show
+        self.begin = begin
+        self.end = end
+        self.loop = loop
+        self.frame_ms = frame_ms
+        self.step = 0
+        self._timer = None
+
+    @property
+    def playing(self):
+        return self._timer is not None
+
+    def play(self):
+        self.step = 0
+        self.show(self.frames[0])
+        if self._timer is None:
+            self.begin()
+            self._timer = self.loop.timeout_add(self.frame_ms, self._tick)
+
+    def _tick(self):
+        self.step += 1
+        if self.step >= len(self.frames):
+            self._timer = None
+            self.end()
+            return False
+        self.show(self.frames[self.step])
+        return True
+
+    def stop(self):
+        if self._timer is not None:
+            self.loop.source_remove(self._timer)
+            self._timer = None
+            self.end()
@@ -0,0 +1,170 @@
+"Remember where redirecting (t.co) URLs end up, in memory and on disk"
+
+import collections
+import logging
+import os
+import threading
+import time
+
+
+class RedirectCache:
+    """A least-recently-used cache of url -> destination, holding at most
+    max_entries URLs, each for ttl seconds. Failed lookups are remembered
+    too (for the shorter failure_ttl) so we don't hammer a site that's down.
+
+    If given a path, it's backed by an sqlite file there: that's read the
+    first time the cache is used, and changes are written back in batches
+    of batch_size (and by flush()), so the same links aren't looked up
+    again every session."""
+
+    FAILED = object()  # what get() returns for a URL that recently failed
+
+    def __init__(self, path=None, max_entries=2000, ttl=7 * 24 * 3600,
+                 failure_ttl=5 * 60, batch_size=20, clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.batch_size = batch_size
+        self.clock = clock
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()  # url -> (destination, expires)
+        self._pending = {}  # url -> (destination, expires), or None to delete
+        self._loaded = False
+        self._db = None
+        self._lock = threading.RLock()
+
+    def set_path(self, path):
+        "Back the cache with an sqlite file at path, from now on"
+        with self._lock:
+            self.flush()
+            if self._db:
+                self._db.close()
+                self._db = None
+            self.path = path
+            self._loaded = False
+
+    def _connect(self):
+        # sqlite3 is imported when first wanted, not at startup
+        import sqlite3
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS redirects "
+                "(url TEXT PRIMARY KEY, destination TEXT, expires REAL, stored REAL)")
+        return self._db
+
+    def _load(self):
+        self._loaded = True
+        if not self.path:
+            return
+        import sqlite3
+        try:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM redirects WHERE expires < ?", (self.clock(),))
+            rows = db.execute(
+                "SELECT url, destination, expires FROM redirects "
+                "ORDER BY stored DESC LIMIT ?", (self.max_entries,)).fetchall()
+        except sqlite3.Error as e:
+            logging.warning(f"Couldn't read redirect cache {self.path} ({e}), so starting empty")
+            return
+        # oldest first, so the most recently stored are the last evicted
+        for url, destination, expires in reversed(rows):
+            self._entries[url] = (destination, expires)
+        logging.debug(f"Loaded {len(rows)} cached redirects from {self.path}")
+
+    def get(self, url):
+        """Where url goes, or RedirectCache.FAILED if looking it up failed
+        recently, or None if we don't know."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self._entries.get(url)
+            if entry is not None and entry[1] < self.clock():
+                del self._entries[url]
+                self._pending[url] = None
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(url)
+            return self.FAILED if entry[0] is None else entry[0]
+
+    def put(self, url, destination):
+        self._store(url, destination, self.ttl)
+
+    def put_failure(self, url):
+        self._store(url, None, self.failure_ttl)
+
+    def _store(self, url, destination, ttl):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = (destination, self.clock() + ttl)
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            self._pending[url] = entry
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._pending[evicted] = None
+                self.evictions += 1
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        "Write any unsaved changes to disk"
+        with self._lock:
+            if not self.path or not self._pending:
+                self._pending.clear()
+                return
+            pending, self._pending = self._pending, {}
+            stored = self.clock()
+            import sqlite3
+            try:
+                db = self._connect()
+                with db:
+                    db.executemany(
+                        "DELETE FROM redirects WHERE url = ?",
+                        [(url,) for url, entry in pending.items() if entry is None])
+                    db.executemany(
+                        "INSERT OR REPLACE INTO redirects VALUES (?, ?, ?, ?)",
+                        [(url, entry[0], entry[1], stored)
+                         for url, entry in pending.items() if entry is not None])
+            except sqlite3.Error as e:
+                logging.warning(f"Couldn't save redirect cache {self.path} ({e})")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+            self._loaded = True
+            if self.path:
+                with self._connect() as db:
+                    db.execute("DELETE FROM redirects")
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    # so it can be used like the plain dict it replaces
+    def __contains__(self, url):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self._entries.get(url)
+            return entry is not None and entry[0] is not None and entry[1] >= self.clock()
+
+    def __getitem__(self, url):
+        destination = self.get(url)
+        if destination is None or destination is self.FAILED:
+            raise KeyError(url)
+        return destination
+
+    def __setitem__(self, url, destination):
+        self.put(url, destination)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,75 @@
+"A local stand-in for t.co, for the tests and benchmarks"
+
+import http.server
+import threading
+import time
+
+
+class RedirectServer:
+    """A local stand-in for t.co, for tests. Use it as a context manager.
+        /go/NAME redirects (after delay seconds) to /landed/NAME
+        /chain/N/NAME redirects N more times before going to /landed/NAME
+        /nohead/NAME refuses HEAD, but GET redirects to /landed/NAME
+        /landed/NAME is a page landing_size bytes long
+    and anything else fails. It keeps a note of the requests it's had,
+    the connections they came in on, and how many body bytes it's sent."""
+    def __init__(self, delay=0.2, landing_size=11):
+        self.delay = delay
+        self.requests = []
+        self.connections = set()
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.respond(with_body=False)
+
+            def do_GET(self):
+                self.respond(with_body=True)
+
+            def send(self, status, location=None, body=b"", with_body=True):
+                self.send_response(status)
+                if location:
+                    self.send_header("Location", location)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(body)
+                    server.bytes_sent += len(body)
+
+            def respond(self, with_body):
+                server.requests.append((self.command, self.path))
+                server.connections.add(self.client_address)
+                parts = self.path.split("/")
+                if parts[1] == "go":
+                    time.sleep(server.delay)
+                    self.send(301, "/landed/" + parts[2])
+                elif parts[1] == "chain" and int(parts[2]) > 0:
+                    self.send(302, f"/chain/{int(parts[2]) - 1}/{parts[3]}")
+                elif parts[1] == "chain":
+                    self.send(301, "/landed/" + parts[3])
+                elif parts[1] == "nohead" and not with_body:
+                    self.send(405)
+                elif parts[1] == "nohead":
+                    self.send(301, "/landed/" + parts[2], b"moved", with_body)
+                elif parts[1] == "landed":
+                    self.send(200, None, b"x" * server.landing_size, with_body)
+                else:
+                    self.send(500)
+
+            def log_message(self, *args):
+                pass
+
+        self.landing_size = landing_size
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,140 @@
+"""Clean the text/html version of a copy, which browsers and mail clients
+put on the clipboard alongside the plain text: its links (href) and
+embeds (src) carry the same tracking parameters.
+
+This is not an HTML parser. It walks the document once, tag to tag,
+finds the values of href and src attributes, and splices cleaned URLs
+into the original by offset; everything else, down to the whitespace and
+the attribute quoting, is left exactly as it was."""
+
+import re
+import urllib.parse
+
+from . import url_handler
+
+URL_ATTRIBUTES = frozenset(("href", "src"))
+# elements whose contents are text, not markup, up to their closing tag
+RAW_TEXT_ELEMENTS = frozenset(("script", "style", "textarea", "title", "xmp", "noscript"))
+STEP_SIZE = 32 * 1024  # characters of HTML between yields, in fix_html_steps
+
+_TAG_START = re.compile(r"<(?:!--|[a-zA-Z])")
+_TAG_NAME = re.compile(r"[a-zA-Z][^\s/>]*")
+# the next attribute in a start tag, or the > that ends it
+_ATTRIBUTE = re.compile(
+    r"""[\s/]*(?:(?P<close>>)|(?P<name>[^\s/>=]+)"""
+    r"""(?:\s*=\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<uq>[^\s>"'][^\s>]*)))?)""")
+_RAW_TEXT_END = {name: re.compile(f"</{name}", re.IGNORECASE) for name in RAW_TEXT_ELEMENTS}
+_NOT_WEB = ("data:", "javascript:", "mailto:", "#")
+_QUOTE_ESCAPES = {'"': ("\"", "&quot;"), "'": ("'", "&#39;")}
+
+
+def iter_url_attributes(html):
+    """Yields (start, end, quote) for the value of every href and src
+    attribute in html: html[start:end] is the value as written, without
+    its quotes, and quote is the quote character it's in (or "")."""
+    pos = 0
+    length = len(html)
+    while pos < length:
+        tag = _TAG_START.search(html, pos)
+        if not tag:
+            return
+        if html.startswith("<!--", tag.start()):
+            end = html.find("-->", tag.end())
+            pos = length if end < 0 else end + 3
+            continue
+        name = _TAG_NAME.match(html, tag.start() + 1)
+        pos = name.end()
+        while pos < length:
+            attribute = _ATTRIBUTE.match(html, pos)
+            if attribute is None:
+                pos += 1  # a stray = or quote; skip it
+                continue
+            pos = attribute.end()
+            if attribute.group("close"):
+                break
+            if attribute.group("name").lower() not in URL_ATTRIBUTES:
+                continue
+            for group, quote in (("dq", '"'), ("sq", "'"), ("uq", "")):
+                if attribute.group(group) is not None:
+                    yield attribute.start(group), attribute.end(group), quote
+                    break
+        raw_text_end = _RAW_TEXT_END.get(name.group().lower())
+        if raw_text_end:
+            end = raw_text_end.search(html, pos)
+            pos = length if end is None else end.start()
+
+
+def _url_in(value):
+    "The URL an attribute value stands for; all we decode is &amp;"
+    return value.replace("&amp;", "&") if "&amp;" in value else value
+
+
+def _written_as(url, value, quote):
+    "url, escaped the way value was, to go back into its attribute"
+    if "&amp;" in value:
+        url = url.replace("&", "&amp;")
+    if quote:
+        url = url.replace(*_QUOTE_ESCAPES[quote])
+    return url
+
+
+def fix_html_steps(html, handle_tco=False, step_size=STEP_SIZE):
+    """fix_html as a generator, which yields every step_size characters or
+    so of the document, for ClipboardWatcher.run_in_slices. What it
+    returns, at StopIteration, is the fixed HTML; the very same object if
+    there was nothing to fix."""
+    if not url_handler.might_need_fixing(html, handle_tco):
+        return html
+    values = []
+    next_yield = step_size
+    for start, end, quote in iter_url_attributes(html):
+        value = html[start:end]
+        if value.lower().startswith(_NOT_WEB):
+            continue
+        url = _url_in(value)
+        if "?" in url or (handle_tco and "t.co" in url) or (
+                url_handler.RULES is not None and url_handler.RULES.has_raw_rules):
+            values.append((start, end, quote, value, url))
+        if start > next_yield:
+            next_yield = start + step_size
+            yield
+    redirects = None
+    if handle_tco:
+        redirects = url_handler.resolve_redirects(
+            url_handler.fix_url(url) for _, _, _, _, url in values
+            if urllib.parse.urlsplit(url).netloc == "t.co")
+    pieces = []
+    done_up_to = 0
+    for count, (start, end, quote, value, url) in enumerate(values, 1):
+        fixed = url_handler.fix_url(url, handle_tco, redirects=redirects)
+        if fixed != url:
+            pieces.append(html[done_up_to:start])
+            pieces.append(_written_as(fixed, value, quote))
+            done_up_to = end
+        if count % 1000 == 0:
+            yield
+    if not pieces:
+        return html
+    pieces.append(html[done_up_to:])
+    return "".join(pieces)
+
+
+def fix_html(html, handle_tco=False):
+    """Cleans the href and src URLs in html.
+    If handle_tco is True, t.co links are looked up (blockingly, all at
+    once in parallel), so call it from a worker thread in that case.
+    Returns the very same html object if there was nothing to fix."""
+    steps = fix_html_steps(html, handle_tco)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+def decode_html(data):
+    """The text of a text/html clipboard target. Firefox offers it as
+    UTF-16, with a byte order mark; everyone else, UTF-8."""
+    if data[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return data.decode("utf-16", errors="replace")
+    return data.decode("utf-8", errors="replace")
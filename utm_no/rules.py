@@ -0,0 +1,251 @@
+"""Site-specific rules, from a ClearURLs-style ruleset (data.min.json from
+https://github.com/ClearURLs/Rules): which parameters to strip from which
+sites, on top of url_handler's global list of prefixes.
+
+There may be thousands of providers in a ruleset, so they're indexed by
+the domain in their urlPattern, and a URL only has its own host's rules
+(and the global ones) checked against it. Regexes are compiled the first
+time they're needed, and the index is cached on disk, so startup doesn't
+pay for rules that are never used."""
+
+import functools
+import json
+import logging
+import os
+import re
+import tempfile
+
+INDEX_FORMAT = 1  # bump when the cached index changes shape
+
+# how ClearURLs urlPatterns begin: a scheme, and then perhaps any subdomain
+_PATTERN_START = re.compile(
+    r"\^?https\?:(?:\\/|/){2}(?P<sub>\(\?:\[a-z0-9-\]\+\\\.\)\*\??|\(\?:www\\\.\)\?)?")
+_PATTERN_LITERAL = re.compile(r"(?:[a-z0-9-]|\\\.|\.(?![*+?{]))+")
+_PATTERN_ANY_TLD = re.compile(r"\(\?:\\\.\[a-z\]\{2,\}\)(?:\{1,\}|\+)")
+_PATTERN_HOST_END = re.compile(r"$|\$|/|\\/|:|\\:|\(\?:\\?/")
+
+
+def domain_keys(url_pattern):
+    """The index keys for a ClearURLs urlPattern, or None if it's not one we
+    can make sense of (those are checked against every URL instead).
+    "com.youtube" is youtube.com, and its subdomains; "amazon.*" is amazon
+    with any TLD after it (amazon.de, amazon.co.uk)."""
+    start = _PATTERN_START.match(url_pattern)
+    if not start:
+        return None
+    pos = start.end()
+    if url_pattern.startswith("(?:", pos):
+        # (?:youtube\.com|youtu\.be)
+        end = url_pattern.find(")", pos)
+        alternatives = url_pattern[pos + 3:end].split("|")
+        pos = end + 1
+    else:
+        literal = _PATTERN_LITERAL.match(url_pattern, pos)
+        if not literal:
+            return None
+        alternatives = [literal.group()]
+        pos = literal.end()
+    domains = []
+    for alternative in alternatives:
+        literal = _PATTERN_LITERAL.fullmatch(alternative)
+        if not literal:
+            return None
+        domains.append(alternative.replace("\\.", ".").strip("."))
+    if _PATTERN_ANY_TLD.match(url_pattern, pos):
+        return [f"{domain}.*" for domain in domains]
+    if not _PATTERN_HOST_END.match(url_pattern, pos):
+        return None  # amazon\.(?:com|de) and the like
+    return [".".join(reversed(domain.split("."))) for domain in domains]
+
+
+def host_keys(host):
+    "Every key in the index which might hold rules for host"
+    labels = host.split(".")
+    keys = [".".join(reversed(labels[i:])) for i in range(len(labels))]
+    # amazon.*, www.amazon.*, amazon.co.* ... for any-TLD patterns
+    for i in range(len(labels)):
+        for j in range(i + 1, len(labels)):
+            keys.append(".".join(labels[i:j]) + ".*")
+    return keys
+
+
+def host_of(url):
+    "The lowercased host of url (scheme optional), without a urlsplit"
+    start = url.find("://")
+    start = 0 if start < 0 else start + 3
+    end = len(url)
+    for stop in "/?#":
+        found = url.find(stop, start, end)
+        if found >= 0:
+            end = found
+    host = url[start:end]
+    host = host[host.rfind("@") + 1:]
+    if host.startswith("["):
+        return host[:host.find("]") + 1].lower()
+    return host.partition(":")[0].lower()
+
+
+class Provider:
+    "One ClearURLs provider. Its regexes are compiled when first wanted."
+
+    def __init__(self, name, url_pattern, rules=(), raw_rules=(), exceptions=()):
+        self.name = name
+        self.url_pattern = url_pattern
+        self.rules = list(rules)
+        self.raw_rules = list(raw_rules)
+        self.exceptions = list(exceptions)
+
+    @classmethod
+    def from_clearurls(cls, name, data):
+        # referral marketing parameters are stripped too: they're tracking
+        return cls(name, data.get("urlPattern", ""),
+                   data.get("rules", []) + data.get("referralMarketing", []),
+                   data.get("rawRules", []), data.get("exceptions", []))
+
+    def as_list(self):
+        return [self.name, self.url_pattern, self.rules, self.raw_rules, self.exceptions]
+
+    @functools.cached_property
+    def url_regex(self):
+        return re.compile(self.url_pattern, re.IGNORECASE)
+
+    @functools.cached_property
+    def param_regex(self):
+        if not self.rules:
+            return None
+        return re.compile("|".join(f"(?:{rule})" for rule in self.rules), re.IGNORECASE)
+
+    @functools.cached_property
+    def raw_regex(self):
+        if not self.raw_rules:
+            return None
+        return re.compile("|".join(f"(?:{rule})" for rule in self.raw_rules), re.IGNORECASE)
+
+    @functools.cached_property
+    def exception_regex(self):
+        if not self.exceptions:
+            return None
+        return re.compile("|".join(f"(?:{e})" for e in self.exceptions), re.IGNORECASE)
+
+    def applies_to(self, url):
+        if not self.url_regex.search(url):
+            return False
+        return not (self.exception_regex and self.exception_regex.search(url))
+
+
+class RuleMatcher:
+    """A PrefixMatcher, plus the parameter rules of some providers: what
+    strip_query wants as its matcher."""
+
+    def __init__(self, prefix_matcher, providers):
+        self.prefix_matcher = prefix_matcher
+        self.regexes = [p.param_regex for p in providers if p.param_regex]
+
+    def match(self, key):
+        if self.prefix_matcher.match(key):
+            return True
+        return any(regex.fullmatch(key) for regex in self.regexes)
+
+
+class RuleSet:
+    """Providers, indexed by domain. providers_for(url) is the ones which
+    apply to url; most URLs only look at a handful."""
+
+    def __init__(self, providers, index, unindexed):
+        self.providers = providers
+        self.index = index  # key (see domain_keys) -> [provider number]
+        self.unindexed = unindexed  # [provider number], checked for every URL
+        self.has_raw_rules = any(p.raw_rules for p in providers)
+        self._candidates = functools.lru_cache(maxsize=4096)(self._candidates_for_host)
+        self._matchers = functools.lru_cache(maxsize=1024)(self._matcher_for_providers)
+
+    @classmethod
+    def from_providers(cls, providers):
+        index = {}
+        unindexed = []
+        for number, provider in enumerate(providers):
+            keys = domain_keys(provider.url_pattern)
+            if keys is None:
+                unindexed.append(number)
+                continue
+            for key in keys:
+                index.setdefault(key, []).append(number)
+        return cls(providers, index, unindexed)
+
+    @classmethod
+    def from_clearurls(cls, data):
+        return cls.from_providers([
+            Provider.from_clearurls(name, provider)
+            for name, provider in data.get("providers", {}).items()])
+
+    def _candidates_for_host(self, host):
+        numbers = set(self.unindexed)
+        for key in host_keys(host):
+            numbers.update(self.index.get(key, ()))
+        return tuple(sorted(numbers))
+
+    def _applying(self, url):
+        return tuple(n for n in self._candidates(host_of(url))
+                     if self.providers[n].applies_to(url))
+
+    def providers_for(self, url):
+        return [self.providers[n] for n in self._applying(url)]
+
+    def _matcher_for_providers(self, prefix_matcher, numbers):
+        return RuleMatcher(prefix_matcher, [self.providers[n] for n in numbers])
+
+    def matcher_for(self, url, prefix_matcher):
+        """A matcher for url's querystring keys: prefix_matcher plus the
+        rules of every provider which applies to url."""
+        numbers = tuple(n for n in self._applying(url) if self.providers[n].rules)
+        if not numbers:
+            return prefix_matcher
+        return self._matchers(prefix_matcher, numbers)
+
+    def apply_raw_rules(self, url):
+        "url, less anything the providers' rawRules cut out of it"
+        for provider in self.providers_for(url):
+            if provider.raw_regex:
+                url = provider.raw_regex.sub("", url)
+        return url
+
+    def as_dict(self):
+        return {"providers": [p.as_list() for p in self.providers],
+                "index": self.index, "unindexed": self.unindexed}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([Provider(*p) for p in data["providers"]], data["index"], data["unindexed"])
+
+
+def load(path, cache_dir=None):
+    """Reads the ClearURLs-style ruleset at path. With a cache_dir, the
+    built index is kept there and used next time, for as long as the
+    ruleset file's mtime and size are still the same."""
+    stat = os.stat(path)
+    source = {"path": os.path.abspath(path), "mtime_ns": stat.st_mtime_ns,
+              "size": stat.st_size, "format": INDEX_FORMAT}
+    cache_path = cache_dir and os.path.join(cache_dir, "rules-index.json")
+    if cache_path:
+        try:
+            with open(cache_path, encoding="utf-8") as fp:
+                cached = json.load(fp)
+            if cached.get("source") == source:
+                logging.debug(f"Using cached rule index {cache_path}")
+                return RuleSet.from_dict(cached)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Not using cached rule index {cache_path} ({e})")
+    with open(path, encoding="utf-8") as fp:
+        ruleset = RuleSet.from_clearurls(json.load(fp))
+    logging.debug(f"Indexed {len(ruleset.providers)} providers from {path}, "
+                  f"{len(ruleset.unindexed)} of them unindexed")
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    "w", encoding="utf-8", dir=cache_dir, delete=False) as fp:
+                json.dump(dict(ruleset.as_dict(), source=source), fp)
+            os.replace(fp.name, cache_path)
+        except OSError as e:
+            logging.warning(f"Couldn't save rule index to {cache_path} ({e})")
+    return ruleset
@@ -0,0 +1,282 @@
+"""Clean URLs for other programs, over a Unix socket, so they needn't start
+a Python of their own for each one: python3 -m utm_no.service runs it
+headless, or the indicator runs it if "service" is enabled in its settings.
+
+The protocol is newline-delimited JSON. Each line sent is a request,
+    {"id": 1, "method": "fix_text", "params": {"text": "...", "tco": false}}
+and each gets one line back, in the order they were sent, either
+    {"id": 1, "result": "..."} or {"id": 1, "error": "what went wrong"}
+A client may send as many requests as it likes before reading any of the
+answers. The methods are fix_text (params text), fix_url (url), fix_urls
+(urls, a list), stats and ping. t.co links are only looked up if the
+request asks for it with "tco": true and the service allows it.
+
+Every client shares the service's rules, its FIX_TEXT_MEMO and its
+REDIRECT_CACHE, so the second person to ask about a link gets the answer
+straight away."""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+
+from . import url_handler
+from .stats import STATS
+
+MAX_REQUEST_SIZE = 64 * 1024 * 1024  # bytes in one request line
+PIPELINE_WINDOW = 64  # requests Client.pipeline sends before reading answers
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "utm_no.sock")
+    return os.path.join(tempfile.gettempdir(), f"utm_no-{os.getuid()}.sock")
+
+
+class ServiceError(Exception):
+    "A request the service couldn't do; the message is what it said"
+
+
+class Service:
+    """Answers requests on the Unix socket at path, a thread per client.
+    allow_tco says whether clients may have t.co links looked up; the
+    indicator keeps it in step with its menu. Use start() and close(), or
+    serve_forever() to run it in this thread."""
+
+    def __init__(self, path=None, allow_tco=False):
+        self.path = path or default_socket_path()
+        self.allow_tco = allow_tco
+        self.requests = 0
+        self._thread = None
+        service = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                service.handle_connection(self.request)
+
+        self._remove_stale_socket()
+        old_umask = os.umask(0o177)  # the socket is for this user only
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+
+    def _remove_stale_socket(self):
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            # not ours to remove; someone's file, or a symlink to who knows what
+            raise OSError(f"{self.path} is there and isn't a socket, so not serving on it")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except OSError:
+            os.unlink(self.path)  # left over from a service that's gone
+        else:
+            raise OSError(f"utm_no is already serving on {self.path}")
+        finally:
+            probe.close()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="utm_no-service", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        logging.info(f"Cleaning URLs for anyone who asks on {self.path}")
+        self.server.serve_forever()
+
+    def close(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread = None
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def handle_connection(self, sock):
+        """Answer requests from sock until it closes. Everything that's
+        arrived is answered in one send, so a client which pipelines its
+        requests gets its answers in batches too."""
+        pending = bytearray()
+        while True:
+            data = sock.recv(256 * 1024)
+            if not data:
+                return
+            pending += data
+            if b"\n" not in data:
+                if len(pending) > MAX_REQUEST_SIZE:
+                    sock.sendall(self.response(None, error="request too long") + b"\n")
+                    return
+                continue
+            lines = pending.split(b"\n")
+            pending = bytearray(lines.pop())
+            sock.sendall(b"".join(self.respond(line) + b"\n" for line in lines if line.strip()))
+
+    def respond(self, line):
+        "The response line (without its newline) for a request line"
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+        except (ValueError, AttributeError) as e:
+            return self.response(None, error=f"not a JSON request ({e})")
+        try:
+            return self.response(request_id, self.call(request.get("method"),
+                                                       request.get("params") or {}))
+        except (ServiceError, TypeError, ValueError) as e:
+            return self.response(request_id, error=str(e))
+        except Exception as e:
+            logging.warning(f"Service request {request_id} failed ({e})")
+            return self.response(request_id, error=f"failed ({e})")
+
+    def response(self, request_id, result=None, error=None):
+        if error is not None:
+            return json.dumps({"id": request_id, "error": error}).encode("utf-8")
+        return json.dumps({"id": request_id, "result": result}).encode("utf-8")
+
+    def call(self, method, params):
+        self.requests += 1
+        STATS.count("service requests")
+        handle_tco = bool(params.get("tco")) and self.allow_tco
+        if method == "fix_text":
+            return url_handler.FIX_TEXT_MEMO.fix_text(_string(params, "text"), handle_tco)
+        if method == "fix_url":
+            return url_handler.fix_url(_string(params, "url"), handle_tco)
+        if method == "fix_urls":
+            urls = params.get("urls")
+            if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+                raise ServiceError("urls should be a list of strings")
+            return url_handler.fix_urls(urls, handle_tco)
+        if method == "stats":
+            return dict(STATS.snapshot(), requests=self.requests,
+                        redirect_cache=url_handler.REDIRECT_CACHE.stats())
+        if method == "ping":
+            return "pong"
+        raise ServiceError(f"no such method {method!r}")
+
+
+def _string(params, name):
+    value = params.get(name)
+    if not isinstance(value, str):
+        raise ServiceError(f"{name} should be a string")
+    return value
+
+
+class Client:
+    """Talks to a Service. call() sends one request and waits for the
+    answer; pipeline() sends a lot of them without waiting in between."""
+
+    def __init__(self, path=None, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path or default_socket_path())
+        self.file = self.sock.makefile("rb")
+        self._ids = itertools.count(1)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _result(self):
+        line = self.file.readline()
+        if not line:
+            raise ServiceError("the service hung up")
+        response = json.loads(line)
+        if "error" in response:
+            raise ServiceError(response["error"])
+        return response["result"]
+
+    def call(self, method, **params):
+        return self.pipeline([(method, params)])[0]
+
+    def pipeline(self, calls, window=PIPELINE_WINDOW):
+        """The results of calls, a list of (method, params). Sends window
+        requests at a time, so neither end's socket buffer fills up with
+        answers nobody's reading yet."""
+        results = []
+        for start in range(0, len(calls), window):
+            batch = calls[start:start + window]
+            self.sock.sendall(b"".join(
+                json.dumps({"id": next(self._ids), "method": method, "params": params}
+                           ).encode("utf-8") + b"\n"
+                for method, params in batch))
+            results.extend(self._result() for _ in batch)
+        return results
+
+    def fix_text(self, text, tco=False):
+        return self.call("fix_text", text=text, tco=tco)
+
+    def fix_url(self, url, tco=False):
+        return self.call("fix_url", url=url, tco=tco)
+
+
+def main(argv=None):
+    from .settings import Settings
+    parser = argparse.ArgumentParser(
+        prog="python3 -m utm_no.service",
+        description="Clean URLs for other programs over a Unix socket, without the indicator")
+    parser.add_argument("--socket", metavar="PATH", default=default_socket_path(),
+                        help="where to listen (default %(default)s)")
+    parser.add_argument("--tco", action="store_true",
+                        help="let clients have t.co links looked up, even if the settings say not")
+    args = parser.parse_args(argv)
+
+    config_dir = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    cache_dir = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "utm_no")
+    # the indicator's settings, rules and redirect cache
+    settings = Settings(os.path.join(config_dir, "utm_no.json"), None).load()
+    url_handler.REDIRECT_CACHE.max_entries = settings["redirect_cache"]["max_entries"]
+    url_handler.REDIRECT_CACHE.ttl = settings["redirect_cache"]["ttl"]
+    url_handler.REDIRECT_CACHE.set_path(os.path.join(cache_dir, "redirects.sqlite"))
+    rules_path = os.path.join(config_dir, settings["rules"]["path"])
+    if os.path.exists(rules_path):
+        from . import rules
+        try:
+            url_handler.set_rules(rules.load(rules_path, cache_dir))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Couldn't load site rules from {rules_path} ({e}), so not using them")
+
+    try:
+        service = Service(args.socket, allow_tco=args.tco or settings["tco"]["enabled"])
+    except OSError as e:
+        print(f"utm_no.service: {e}", file=sys.stderr)
+        return 1
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        url_handler.REDIRECT_CACHE.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
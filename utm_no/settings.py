@@ -0,0 +1,181 @@
+"Keep the indicator's settings in a JSON file, written safely and not too often"
+
+import contextlib
+import copy
+import json
+import logging
+import os
+import tempfile
+
+SAVE_DELAY_MS = 500
+
+DEFAULTS = {
+    "enabled": True,
+    "tco": {
+        "enabled": False,
+        "asked": False,
+    },
+    # clipboard text longer than this many characters is left alone
+    "max_text_size": 64 * 1024 * 1024,
+    "redirect_cache": {
+        "max_entries": 2000,
+        "ttl": 7 * 24 * 3600,
+    },
+    "rules": {
+        # a ClearURLs-style ruleset; relative paths are from the config dir
+        "path": "utm_no/clearurls.json",
+    },
+    "primary": {
+        # clean the middle-click selection too; it changes all through
+        # every drag, so it's only looked at once it's been still for
+        # settle_ms, and gets no more than budget_ms a second of cleaning
+        "enabled": False,
+        "settle_ms": 300,
+        "budget_ms": 50,
+    },
+    "service": {
+        # clean URLs for other programs over a Unix socket (see service.py);
+        # an empty path means the default, in $XDG_RUNTIME_DIR
+        "enabled": False,
+        "path": "",
+    },
+}
+
+
+def merged(defaults, data):
+    "defaults, overridden by whatever's in data, sections and all"
+    result = copy.deepcopy(defaults)
+    for key, value in data.items():
+        if isinstance(result.get(key), dict) and isinstance(value, dict):
+            result[key] = merged(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def write_atomically(path, contents):
+    """Write contents to path such that, crash when we may, path holds
+    either all of the old contents or all of the new: write a temporary
+    file alongside, fsync it, and rename it over the top."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".utm_no-settings-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(contents)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    try:
+        # and make the rename itself stick
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass  # not every filesystem lets you fsync a directory
+
+
+class Settings:
+    """The settings, as a dict (see DEFAULTS) backed by the JSON file at
+    path. update() changes them and arranges for them to be saved once
+    there have been no more changes for delay_ms; saving happens in a
+    background thread, so the main loop never waits on the disk. Call
+    flush() on the way out to save anything still waiting.
+
+    loop is anything with GLib's timeout_add and source_remove, which is
+    GLib itself when running for real."""
+
+    def __init__(self, path, loop, delay_ms=SAVE_DELAY_MS, defaults=DEFAULTS):
+        self.path = path
+        self.loop = loop
+        self.delay_ms = delay_ms
+        self.defaults = defaults
+        self.data = copy.deepcopy(defaults)
+        self.writes = 0
+        self._timer = None
+        self._writer = None
+        self._last_save = None
+        self._applying = False
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def read(self):
+        """The settings in the file, with defaults for anything missing.
+        Blocking, but it's a small file; and it doesn't change self.data."""
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                return merged(self.defaults, json.load(fp))
+        except FileNotFoundError:
+            return copy.deepcopy(self.defaults)
+        except (OSError, ValueError) as e:
+            logging.warning(
+                f"Couldn't read settings from {self.path} ({e}), so using the defaults")
+            return copy.deepcopy(self.defaults)
+
+    def load(self):
+        self.data = self.read()
+        return self.data
+
+    @contextlib.contextmanager
+    def applying(self, data):
+        """Make data the settings, and ignore update()s until the with
+        block's done: they're just the widgets catching up with data,
+        perhaps only part of the way, and mustn't be saved."""
+        self.data = data
+        self._applying = True
+        try:
+            yield data
+        finally:
+            self._applying = False
+
+    def update(self, **changes):
+        """Change some settings (whole sections, for the nested ones, or
+        just some of a section's keys) and save them soon"""
+        if self._applying:
+            return
+        data = merged(self.data, changes)
+        if data == self.data:
+            return
+        self.data = data
+        if self._timer is not None:
+            self.loop.source_remove(self._timer)
+        self._timer = self.loop.timeout_add(self.delay_ms, self._save_soon)
+
+    def _save_soon(self):
+        self._timer = None
+        self._save()
+        return False
+
+    def _save(self):
+        if self._writer is None:
+            import concurrent.futures
+            # one thread, so saves land in the order they were made
+            self._writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="utm_no-settings")
+        self._last_save = self._writer.submit(self._write, json.dumps(self.data, indent=2))
+
+    def _write(self, contents):
+        try:
+            write_atomically(self.path, contents)
+            self.writes += 1
+            logging.debug(f"Saved settings to {self.path}")
+        except OSError as e:
+            logging.warning(f"Couldn't save settings to {self.path} ({e})")
+
+    def flush(self):
+        "Save now, if there's a save waiting, and wait until it's done"
+        if self._timer is not None:
+            self.loop.source_remove(self._timer)
+            self._timer = None
+            self._save()
+        if self._last_save is not None:
+            self._last_save.result()
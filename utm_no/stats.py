@@ -0,0 +1,184 @@
+"""Counters and timings for where the time goes: scanning, rewriting
+querystrings, waiting for the clipboard, looking up t.co links.
+
+Everything records into STATS, which does nothing (beyond checking a flag)
+until it's enabled: set UTM_NO_STATS=1 in the environment, or set
+STATS.enabled. The indicator turns it on itself, unless UTM_NO_STATS=0;
+it records per text and per lookup, never per character or per URL, so it
+costs next to nothing even then."""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Histogram:
+    """Latencies, in buckets which double in size: bucket n holds anything
+    under 2**n microseconds (and at least half that). Percentiles come out
+    as the top of the bucket they fall in, which is near enough."""
+
+    BUCKETS = 32  # the last one is anything over 2**31us, half an hour or so
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        microseconds = int(seconds * 1e6)
+        self.counts[min(microseconds.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        "The (top of the bucket of the) fraction'th latency, in seconds"
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count else 0,
+            "p50_ms": round(self.percentile(0.5) * 1000, 3),
+            "p90_ms": round(self.percentile(0.9) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            # "<1024us": n, for the buckets with anything in
+            "buckets": {f"<{2 ** bucket}us": count
+                        for bucket, count in enumerate(self.counts) if count},
+        }
+
+
+class Stats:
+    """Named counters, and a latency histogram per named stage. Safe to
+    use from any thread. When it's not enabled, count() and stop() return
+    straight away and start() gives back None:
+
+        started = STATS.start()
+        ... the work ...
+        STATS.stop("scan", started)
+    """
+
+    def __init__(self, enabled=False, clock=time.perf_counter):
+        self.enabled = enabled
+        self.clock = clock
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.timers = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += n
+
+    def start(self):
+        return self.clock() if self.enabled else None
+
+    def stop(self, stage, started):
+        "Record how long stage took since started, which start() gave you"
+        if started is None:
+            return
+        self.record(stage, self.clock() - started)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                timer = self.timers[stage] = Histogram()
+            timer.add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.timers.clear()
+
+    def snapshot(self):
+        "Everything so far, as a dict which json.dumps is happy with"
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "since": self.started,
+                "seconds": round(time.time() - self.started, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "timers": {stage: timer.as_dict()
+                           for stage, timer in sorted(self.timers.items())},
+            }
+
+
+def report(snapshot):
+    "A snapshot as lines of text, for people to read"
+    if not snapshot["enabled"]:
+        return "Statistics are turned off (UTM_NO_STATS=0)."
+    lines = [f"Over the last {snapshot['seconds'] / 60:.0f} minutes:"]
+    lines += [f"{name}: {count}" for name, count in snapshot["counters"].items()]
+    if snapshot["timers"]:
+        lines.append("")
+        lines.append("Times (count, median, 99th percentile, slowest):")
+    for stage, timer in snapshot["timers"].items():
+        lines.append(f"{stage}: {timer['count']}, {timer['p50_ms']:g}ms, "
+                     f"{timer['p99_ms']:g}ms, {timer['max_ms']:g}ms")
+    return "\n".join(lines)
+
+
+def dump(path, snapshot):
+    "Write a snapshot out as JSON"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as fp:
+        json.dump(snapshot, fp, indent=2)
+    logging.info(f"Wrote statistics to {path}")
+
+
+class Profiler:
+    """cProfile, for the bits of work call() is asked to do: set
+    UTM_NO_PROFILE to a filename and the indicator profiles its clipboard
+    processing and writes the pstats there (read them with python3 -m
+    pstats) on SIGUSR1 and on the way out. Only one call is profiled at a
+    time; anything that overlaps it just runs."""
+
+    def __init__(self, path):
+        import cProfile
+        self.path = path
+        self.profile = cProfile.Profile()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        path = os.environ.get("UTM_NO_PROFILE")
+        return cls(path) if path else None
+
+    def call(self, fn, *args, **kwargs):
+        if not self._lock.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        try:
+            self.profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.profile.disable()
+        finally:
+            self._lock.release()
+
+    def dump(self):
+        with self._lock:
+            self.profile.dump_stats(self.path)
+        logging.info(f"Wrote profile to {self.path}")
+
+
+STATS = Stats(enabled=os.environ.get("UTM_NO_STATS") == "1")
@@ -2,10 +2,15 @@
 
 import re
 import urllib.parse
-import unittest
-import requests
+import threading
 import logging
 import os
+import sys
+import collections
+import itertools
+
+from .redirect_cache import RedirectCache
+from .stats import STATS
 
 LOGLEVEL = os.environ.get('LOGLEVEL', 'WARNING').upper()
 logging.basicConfig(level=LOGLEVEL)
@@ -21,8 +26,82 @@ STRIP_URL_QUERY_ELEMENTS_STARTS = [
     "srcid", "stm_", "trk_", "twclid", "utm_", "vero_", "utm-"
 ]
 
+
+class PrefixMatcher:
+    """Answers "does this key start with any of these prefixes?" in one
+    lookup per distinct prefix length, rather than one startswith() per
+    prefix. There are only ever a handful of distinct lengths, so the cost
+    stays flat however long the prefix list grows."""
+    def __init__(self, prefixes):
+        self.prefixes = frozenset(prefixes)
+        self.lengths = sorted(set(len(p) for p in self.prefixes))
+
+    def match(self, key):
+        prefixes = self.prefixes
+        for length in self.lengths:
+            if length > len(key):
+                return False
+            if key[:length] in prefixes:
+                return True
+        return False
+
+
+def build_prefilter(prefixes, rules=None):
+    """A cheap regex which finds anything that might be a tracking parameter:
+    a ?, & or ; followed by a prohibited prefix, or by a key with a %-escape
+    in it (which parse_qs would unquote before we check it). Text where this
+    doesn't match can't have anything for fix_url to strip.
+    Site rules (see rules.py) can strip any key at all, so with those it's
+    any querystring; and if they cut bits out of paths, anything at all."""
+    if rules is not None:
+        return re.compile(r"[.:]" if rules.has_raw_rules else r"[?&;]")
+    alternation = "|".join(
+        re.escape(p) for p in sorted(prefixes, key=len, reverse=True))
+    if not alternation:
+        return re.compile(r"[?&;][^=&;#\s%]*%")
+    return re.compile(r"[?&;](?:(?:%s)|[^=&;#\s%%]*%%)" % alternation)
+
+
+TCO_PREFILTER = re.compile(r"t\.co")
+
+STRIP_MATCHER = PrefixMatcher(STRIP_URL_QUERY_ELEMENTS_STARTS)
+STRIP_PREFILTER = build_prefilter(STRIP_URL_QUERY_ELEMENTS_STARTS)
+RULES = None  # a rules.RuleSet of site-specific rules, if there are any
+RULES_VERSION = 0  # goes up whenever the rules change
+
+
+def set_strip_prefixes(prefixes):
+    """Replace the list of prohibited querystring prefixes.
+    Use this rather than editing STRIP_URL_QUERY_ELEMENTS_STARTS in place,
+    so the compiled matcher and prefilter are rebuilt."""
+    global STRIP_URL_QUERY_ELEMENTS_STARTS, STRIP_MATCHER, STRIP_PREFILTER, RULES_VERSION
+    RULES_VERSION += 1
+    STRIP_URL_QUERY_ELEMENTS_STARTS = list(prefixes)
+    STRIP_MATCHER = PrefixMatcher(STRIP_URL_QUERY_ELEMENTS_STARTS)
+    STRIP_PREFILTER = build_prefilter(STRIP_URL_QUERY_ELEMENTS_STARTS, RULES)
+
+
+def set_rules(ruleset):
+    """Use ruleset (a rules.RuleSet, perhaps from rules.load) for
+    site-specific rules as well as the prefixes; None for none."""
+    global RULES, STRIP_PREFILTER, RULES_VERSION
+    RULES_VERSION += 1
+    RULES = ruleset
+    STRIP_PREFILTER = build_prefilter(STRIP_URL_QUERY_ELEMENTS_STARTS, RULES)
+
+
+PREFILTER_STATS = {"checked": 0, "skipped": 0}
+
+
+def might_need_fixing(text, handle_tco=False):
+    """False if there is definitely nothing in text for fix_text to do."""
+    if STRIP_PREFILTER.search(text):
+        return True
+    return bool(handle_tco and TCO_PREFILTER.search(text))
+
+
 # https://stackoverflow.com/a/44645567/1418014
-URL_REGEX = re.compile(r"""
+_URL_PATTERN = r"""
     (
         (?:
             (?:https|http)?
@@ -59,251 +138,712 @@ URL_REGEX = re.compile(r"""
             (?!@)
         )
     )
-""", re.VERBOSE)
-
-REDIRECT_CACHE = {}
+"""
+
+
+def __getattr__(name):
+    # URL_REGEX is only used to check the scanner against, so it's not
+    # compiled unless someone asks for it
+    if name == "URL_REGEX":
+        globals()[name] = re.compile(_URL_PATTERN, re.VERBOSE)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# URL_REGEX nests quantified groups, and on long runs of brackets or
+# non-space characters (minified JS, base64, stack traces) it can backtrack
+# for a very long time. The scanner below finds the same URLs as URL_REGEX
+# for anything that looks like a link, but it never looks at a character
+# more than a fixed number of times, so it is linear in the length of the
+# text. URL_REGEX is kept as the reference definition.
+#
+# It mirrors the three alternatives in URL_REGEX:
+#   - a scheme URL: optional http/https, a colon, then a slash or [a-z0-9%],
+#     then a body
+#   - a bare domain ending .com/.org/.uk followed by a slash and a body
+#   - a bare domain ending .com/.uk/.ac with no body
+# A body is everything up to whitespace or <>{}[], with balanced (brackets)
+# allowed, less any trailing punctuation.
+
+_URL_TRIGGER = re.compile(r"[.:]")
+_DOMAIN_RUN = re.compile(r"[a-z0-9.\-]+")
+_DOMAIN_CHAIN = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+_BARE_TLD = re.compile(r"\.(?:com|uk|ac)(?![a-z0-9])")
+_BODY_PLAIN = re.compile(r"[^\s()<>{}\[\]]*")
+_PAREN_OR_SPACE = re.compile(r"[()\s]")
+_CLOSE_OR_SPACE = re.compile(r"[)\s]")
+_RUN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789.-")
+_AFTER_COLON = frozenset("abcdefghijklmnopqrstuvwxyz0123456789%/")
+_TRAILING_PUNCTUATION = frozenset("`!;:'\".,?«»“”‘’")
+
+
+class _Scanner:
+    def __init__(self, text):
+        self.text = text
+        self.groups = {}  # ( index -> index of its closing ), or -1
+        self.close_from = self.close_at = -1
+
+    def next_close(self, pos):
+        """Index of the next ) or whitespace at or after pos. Remembered,
+        so that asking again from anywhere up to the answer costs nothing."""
+        if not self.close_from <= pos <= self.close_at:
+            mo = _CLOSE_OR_SPACE.search(self.text, pos)
+            self.close_from = pos
+            self.close_at = mo.start() if mo else len(self.text)
+        return self.close_at
+
+    def group_end(self, start):
+        """Index of the ) ending a (bracketed group) at start, or -1.
+        Same as URL_REGEX: either (a(b)c) or (anything-but-space)."""
+        if start in self.groups:
+            return self.groups[start]
+        text = self.text
+        end = -1
+        inner = _PAREN_OR_SPACE.search(text, start + 1)
+        if inner and inner.group() == "(":
+            inner_end = _PAREN_OR_SPACE.search(text, inner.end())
+            if inner_end and inner_end.group() == ")" and inner_end.start() > inner.end():
+                outer_end = _PAREN_OR_SPACE.search(text, inner_end.end())
+                if outer_end and outer_end.group() == ")":
+                    end = outer_end.start()
+        if end < 0 and text[start + 1:start + 2].strip():
+            found = self.next_close(start + 2)
+            if found < len(text) and text[found] == ")":
+                end = found
+        self.groups[start] = end
+        return end
+
+    def body_end(self, start):
+        "Where a URL body beginning at start ends, or -1 if it's too short"
+        text = self.text
+        pos = start
+        while True:
+            pos = _BODY_PLAIN.match(text, pos).end()
+            if pos < len(text) and text[pos] == "(":
+                end = self.group_end(pos)
+                if end >= 0:
+                    pos = end + 1
+                    continue
+            break
+        while pos > start and text[pos - 1] in _TRAILING_PUNCTUATION:
+            pos -= 1
+        # URL_REGEX wants at least one body character and then a final one
+        return pos if pos - start >= 2 else -1
+
+    def scheme_url_end(self, colon):
+        if self.text[colon + 1:colon + 2] not in _AFTER_COLON:
+            return -1
+        return self.body_end(colon + 2)
+
+    def bare_domain(self, start, end):
+        "The leftmost bare domain (foo.example.com) between start and end"
+        text = self.text
+        for chain in _DOMAIN_CHAIN.finditer(text, start, end):
+            first = chain.start()
+            if first > 0 and text[first - 1] == "@":
+                # not the domain part of an email address, but (like
+                # URL_REGEX) we'll have the rest of the label
+                first += 1
+                if text[first] in ".-":
+                    first += 1
+                if first >= chain.end():
+                    continue
+            tlds = list(_BARE_TLD.finditer(text, first + 1, chain.end()))
+            for tld in reversed(tlds):
+                after = tld.end()
+                following = text[after:after + 1]
+                if after == chain.end() and (following.isalnum() or following == "_"):
+                    continue  # no word boundary after the TLD
+                if following == "@":
+                    continue
+                if following == "/" and text[after + 1:after + 2] != "@":
+                    after += 1
+                return first, after
+        return None
+
+    def domain_run(self, start, end):
+        "The leftmost URL starting in the run of domain characters start:end"
+        text = self.text
+        following = text[end:end + 1]
+        if following == "/":
+            for tld in (".com", ".org", ".uk"):
+                if text.endswith(tld, start, end) and end - start > len(tld):
+                    body = self.body_end(end + 1)
+                    if body >= 0:
+                        return start, body
+                    break
+        span = self.bare_domain(start, end)
+        if span:
+            return span
+        if following == ":":
+            for scheme in ("https", "http"):
+                if text.endswith(scheme, start, end):
+                    body = self.scheme_url_end(end)
+                    if body >= 0:
+                        return end - len(scheme), body
+                    break
+        return None
+
+    def spans(self):
+        text = self.text
+        pos = 0
+        while True:
+            mo = _URL_TRIGGER.search(text, pos)
+            if mo is None:
+                return
+            trigger = mo.start()
+            if mo.group() == ".":
+                start = trigger
+                while start > pos and text[start - 1] in _RUN_CHARS:
+                    start -= 1
+                end = _DOMAIN_RUN.match(text, trigger).end()
+                span = self.domain_run(start, end)
+                if span is None:
+                    pos = end
+                    continue
+            else:
+                start = trigger
+                for scheme in ("https", "http"):
+                    if trigger - len(scheme) >= pos and text.endswith(scheme, pos, trigger):
+                        start = trigger - len(scheme)
+                        break
+                end = self.scheme_url_end(trigger)
+                if end < 0:
+                    pos = trigger + 1
+                    continue
+                span = (start, end)
+            yield span
+            pos = span[1]
+
+
+def iter_url_spans(text):
+    """Yields (start, end) for each URL in text, in order; the same URLs
+    that URL_REGEX.finditer would find, in linear time."""
+    return _Scanner(text).spans()
+
+
+def find_urls(text):
+    "All the URLs in text, as a list of strings, like URL_REGEX.findall"
+    return [text[start:end] for start, end in iter_url_spans(text)]
+
+
+class ScanResult:
+    """Everything we want to know about the URLs in some text, from one walk
+    over it. Hand this to fix_text (and ask it about t.co links and so on)
+    rather than having each of them scan the text again."""
+    def __init__(self, text):
+        self.text = text
+        self._spans = None
+        self._urls = None
+        self._splits = None
+
+    @property
+    def spans(self):
+        "(start, end) of each URL, found the first time they're wanted"
+        if self._spans is None:
+            text = self.text
+            self._spans = list(iter_url_spans(text)) if isinstance(text, str) else []
+        return self._spans
+
+    @property
+    def urls(self):
+        if self._urls is None:
+            self._urls = [self.text[start:end] for start, end in self.spans]
+        return self._urls
+
+    @property
+    def splits(self):
+        "urlsplit() of each URL, worked out the first time they're wanted"
+        if self._splits is None:
+            self._splits = [urllib.parse.urlsplit(u) for u in self.urls]
+        return self._splits
+
+    @property
+    def has_tco(self):
+        if not isinstance(self.text, str) or "t.co" not in self.text:
+            return False
+        return any(split.netloc == "t.co" for split in self.splits)
+
+    @property
+    def is_single_url(self):
+        "True if the text, bar surrounding whitespace, is exactly one URL"
+        if len(self.spans) != 1:
+            return False
+        start, end = self.spans[0]
+        return not self.text[:start].strip() and not self.text[end:].strip()
+
+
+def scan(text):
+    return ScanResult(text)
+
+
+# the indicator points this at a file in the user's cache dir
+REDIRECT_CACHE = RedirectCache()
 
 
 def follow_redirects(url):
-    if url in REDIRECT_CACHE:
-        logging.debug(f"URL {url} -> {REDIRECT_CACHE[url]} (cached)")
-        return REDIRECT_CACHE[url]
-    response = requests.get(url)
-    REDIRECT_CACHE[url] = response.url
-    logging.debug(f"URL {url} -> {REDIRECT_CACHE[url]}")
-    return response.url
-
-
-def fix_url(url, handle_tco=False):
+    """Where url ends up. A URL which failed to look up recently comes back
+    unchanged; a lookup which fails now raises."""
+    cached = REDIRECT_CACHE.get(url)
+    if cached is RedirectCache.FAILED:
+        STATS.count("redirect cache hits (failed)")
+        logging.debug(f"URL {url} failed recently, so not looking it up")
+        return url
+    if cached is not None:
+        STATS.count("redirect cache hits")
+        logging.debug(f"URL {url} -> {cached} (cached)")
+        return cached
+    STATS.count("network lookups")
+    started = STATS.start()
+    try:
+        destination = walk_redirects(url)
+    except Exception:
+        STATS.count("network lookups failed")
+        REDIRECT_CACHE.put_failure(url)
+        raise
+    finally:
+        STATS.stop("t.co lookup", started)
+    REDIRECT_CACHE.put(url, destination)
+    logging.debug(f"URL {url} -> {destination}")
+    return destination
+
+
+SHORTENER_HOSTS = {"t.co"}
+MAX_REDIRECTS = 10
+LOOKUP_TIMEOUT = (3.05, 5)  # (connect, read) seconds
+_lookup_session = None
+# so that lookups starting together make _lookup_session (and
+# _lookup_executor) just the once
+_lookup_lock = threading.Lock()
+
+
+def lookup_session():
+    """One requests Session for all lookups, so connections to t.co are
+    kept alive and reused rather than set up afresh every time.
+    requests is imported here, not at the top, because it's slow to import
+    and most people never turn t.co lookups on."""
+    global _lookup_session
+    if _lookup_session is None:
+        with _lookup_lock:
+            if _lookup_session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=4, pool_maxsize=LOOKUP_THREADS)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _lookup_session = session  # only once it's ready to use
+    return _lookup_session
+
+
+def walk_redirects(url, shorteners=None):
+    """Follows the Location headers from url by hand, with HEAD requests so
+    no page is ever downloaded, and stops as soon as a redirect points
+    somewhere which isn't a shortener (by default, t.co): we want to know
+    where the link goes, not to go there."""
+    if shorteners is None:
+        shorteners = SHORTENER_HOSTS
+    session = lookup_session()
+    for hop in range(MAX_REDIRECTS):
+        response = session.head(url, allow_redirects=False, timeout=LOOKUP_TIMEOUT)
+        if response.status_code in (405, 501):
+            # no HEAD here; a GET we don't read the body of will do
+            response = session.get(url, allow_redirects=False, stream=True,
+                                   timeout=LOOKUP_TIMEOUT)
+        response.close()
+        location = response.headers.get("Location")
+        if not response.is_redirect or not location:
+            return url
+        url = urllib.parse.urljoin(url, location)
+        if urllib.parse.urlsplit(url).hostname not in shorteners:
+            return url
+    logging.debug(f"Gave up following redirects after {MAX_REDIRECTS} hops at {url}")
+    return url
+
+
+LOOKUP_THREADS = 8
+_lookup_executor = None
+
+
+def lookup_executor():
+    "The thread pool that redirect lookups run in, made when first needed"
+    global _lookup_executor
+    if _lookup_executor is None:
+        with _lookup_lock:
+            if _lookup_executor is None:
+                import concurrent.futures
+                _lookup_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=LOOKUP_THREADS, thread_name_prefix="utm_no-lookup")
+    return _lookup_executor
+
+
+def _follow_redirects_or_not(url):
+    try:
+        return follow_redirects(url)
+    except Exception as e:
+        logging.warning(f"Couldn't look up {url} ({e}), so leaving it alone")
+        return url
+
+
+def resolve_redirects(urls):
+    """Follows the redirects for all of urls at once, in parallel, and
+    returns a dict of url -> where it ends up. A URL which couldn't be
+    looked up maps to itself. Still blocks until they're all done, so call
+    it from a worker thread, not the GTK main loop."""
+    todo = list(dict.fromkeys(urls))
+    if len(todo) < 2:
+        return {url: _follow_redirects_or_not(url) for url in todo}
+    return dict(zip(todo, lookup_executor().map(_follow_redirects_or_not, todo)))
+
+
+_QUERY_PAIR = re.compile(r"[^&;]+")
+
+
+def strip_query(query, matcher=None):
+    """Cuts the key=value pairs with a prohibited key out of a raw
+    querystring. Everything else, including the order and %-encoding of the
+    pairs we keep, is copied through exactly as it was.
+    Returns the very same query object if nothing was cut."""
+    matcher = matcher or STRIP_MATCHER
+    kept = []
+    removed = False
+    for mo in _QUERY_PAIR.finditer(query):
+        key = mo.group().partition("=")[0]
+        if "%" in key or "+" in key:
+            key = urllib.parse.unquote_plus(key)
+        if matcher.match(key):
+            removed = True
+        else:
+            kept.append(mo)
+    if not removed:
+        return query
+    # each kept pair keeps the separator that was before it, except the first
+    return "".join(
+        (query[mo.start() - 1] if index else "") + mo.group()
+        for index, mo in enumerate(kept))
+
+
+def fix_url(url, handle_tco=False, split=None, redirects=None):
     """Removes all querystring params with a prohibited prefix.
     Call this with actual URLs only.
-    Must return text unchanged if there is no replacing to be done."""
-    parsed = urllib.parse.urlsplit(url)
-    qs = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
-    qs_keys = qs.keys()
-    ok_qs_keys = [
-        k for k in qs_keys
-        if not any([k.startswith(b) for b in STRIP_URL_QUERY_ELEMENTS_STARTS])
-    ]
-    if len(ok_qs_keys) == len(qs_keys):
-        endurl = url  # if removed nothing, change nothing
-    else:
-        nqs = dict([(k, qs[k]) for k in ok_qs_keys])
-        parsed = parsed._replace(query=urllib.parse.urlencode(nqs, doseq=True))
-        endurl = urllib.parse.urlunsplit(parsed)
-    if handle_tco and parsed.netloc == "t.co":
-        logging.debug(f"Looking up t.co URL {endurl} to get ultimate endpoint")
-        endurl = follow_redirects(endurl)
+    Must return text unchanged if there is no replacing to be done.
+    Pass split if you already have urlsplit(url) to hand, and redirects if
+    t.co links have already been looked up with resolve_redirects."""
+    raw_rules = RULES is not None and RULES.has_raw_rules
+    if not url or ("?" not in url and not raw_rules and not (handle_tco and "t.co" in url)):
+        return url  # no querystring and no t.co lookup, so nothing to do
+    endurl = url  # if removed nothing, change nothing
+    if raw_rules:
+        cut = RULES.apply_raw_rules(url)
+        if cut != url:
+            endurl = cut
+    # the query is whatever's between the first ? and the #fragment, just as
+    # urlsplit would have it; we only cut bits out, we don't re-encode
+    query_start = endurl.find("?")
+    fragment_start = endurl.find("#")
+    if query_start >= 0 and (fragment_start < 0 or query_start < fragment_start):
+        query_end = fragment_start if fragment_start >= 0 else len(endurl)
+        query = endurl[query_start + 1:query_end]
+        matcher = RULES.matcher_for(endurl, STRIP_MATCHER) if RULES else None
+        new_query = strip_query(query, matcher)
+        if new_query is not query:
+            endurl = (endurl[:query_start] + ("?" if new_query else "") +
+                      new_query + endurl[query_end:])
+    if handle_tco and (split or urllib.parse.urlsplit(url)).netloc == "t.co":
+        if redirects is not None and endurl in redirects:
+            destination = redirects[endurl]
+        else:
+            logging.debug(f"Looking up t.co URL {endurl} to get ultimate endpoint")
+            destination = follow_redirects(endurl)
+        if destination != endurl:
+            # where it goes has as much tracking on it as anything else
+            endurl = fix_url(destination)
     return endurl
 
 
-def fix_match_object(mo, handle_tco=False):
-    return fix_url(mo.group(0), handle_tco)
-
-
-def fix_text(text, handle_tco=False):
+FIX_URLS_BATCH = 10000  # URLs at a time, for fix_urls(lazy=True)
+FIX_URLS_REMEMBER = 100000  # and how many answers it keeps for duplicates
+
+
+def _fix_unique(urls, handle_tco):
+    "fix_url for each of urls (no duplicates, please), as a dict url -> fixed"
+    fixed = {url: fix_url(url) for url in urls}
+    if handle_tco:
+        tco = [f for f in fixed.values()
+               if "t.co" in f and urllib.parse.urlsplit(f).netloc == "t.co"]
+        if tco:
+            redirects = resolve_redirects(tco)
+            fixed = {url: fix_url(redirects[f]) if f in redirects else f
+                     for url, f in fixed.items()}
+    return fixed
+
+
+def fix_urls(urls, handle_tco=False, lazy=False):
+    """fix_url for lots of URLs: the same as [fix_url(u, handle_tco) for u
+    in urls], but each different URL is only fixed once, and the t.co
+    lookups are all done together, in parallel.
+    Returns a list, in the same order as urls; or if lazy, a generator
+    which goes through urls a batch at a time, for when there are more of
+    them than you want in memory at once (or urls is itself a generator)."""
+    if lazy:
+        return _fix_urls_lazily(urls, handle_tco)
+    urls = list(urls)
+    fixed = _fix_unique(dict.fromkeys(urls), handle_tco)
+    return [fixed[url] for url in urls]
+
+
+def _fix_urls_lazily(urls, handle_tco):
+    done = {}
+    urls = iter(urls)
+    while True:
+        batch = list(itertools.islice(urls, FIX_URLS_BATCH))
+        if not batch:
+            return
+        if len(done) > FIX_URLS_REMEMBER:
+            done.clear()
+        done.update(_fix_unique(
+            [url for url in dict.fromkeys(batch) if url not in done], handle_tco))
+        for url in batch:
+            yield done[url]
+
+
+def fix_text(text, handle_tco=False, scanned=None, unresolved=None):
     """Fixes all URLs within text.
-    If handle_tco is True, will also blockingly(!) resolve t.co links
+    If handle_tco is True, will also blockingly(!) resolve t.co links, all
+    at once in parallel, so call it from a worker thread in that case.
+    Returns the very same text object if there was nothing to fix.
+    Pass scanned if you already have scan(text) to hand; otherwise very
+    long texts are done a chunk at a time, as fix_text_stream does.
+    Pass a list as unresolved to have the t.co links which couldn't be
+    looked up added to it.
     """
-    return URL_REGEX.sub(lambda mo: fix_match_object(mo, handle_tco), text)
+    if scanned is None and len(text) > 2 * STREAM_CHUNK_SIZE:
+        steps = fix_text_steps(text, handle_tco, STREAM_CHUNK_SIZE, unresolved)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as done:
+                return done.value
+    return _fix_text(text, handle_tco, scanned, unresolved)
+
+
+STEP_CHUNK_SIZE = 32 * 1024
+
+
+def fix_text_steps(text, handle_tco=False, chunk_size=STEP_CHUNK_SIZE, unresolved=None):
+    """fix_text(text) as a generator, which does a chunk of the text and
+    then yields, so the caller can do other things in between (such as run
+    the GTK main loop). What it returns, at StopIteration, is the fixed
+    text; the very same text object if there was nothing to fix."""
+    pieces = []
+    changed = False
+    for piece in iter_text_chunks(text, chunk_size):
+        fixed = _fix_text(piece, handle_tco, unresolved=unresolved)
+        changed = changed or fixed is not piece
+        pieces.append(fixed)
+        yield
+    return "".join(pieces) if changed else text
+
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+_CUTTABLE_SPACE = " \n\t\r"
+
+
+def iter_text_chunks(source, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields the text of source (a string, a text-mode file-like object, or
+    any iterable of strings) in pieces of about chunk_size characters.
+    No URL has whitespace in it, so each piece is cut just after some
+    whitespace, and no URL is ever split between two pieces. A stretch with
+    no whitespace at all can't be cut, so it's held on to until some turns
+    up: memory use is about chunk_size plus the longest such stretch."""
+    if isinstance(source, str):
+        reads = (source[i:i + chunk_size] for i in range(0, len(source), chunk_size))
+    elif hasattr(source, "read"):
+        reads = iter(lambda: source.read(chunk_size), "")
+    else:
+        reads = source
+    held = []  # text read but not yet handed out; none of it has a space
+    for chunk in reads:
+        cut = max(chunk.rfind(space) for space in _CUTTABLE_SPACE) + 1
+        if not cut:
+            if chunk:
+                held.append(chunk)
+            continue
+        held.append(chunk[:cut])
+        yield held[0] if len(held) == 1 else "".join(held)
+        held = [chunk[cut:]] if cut < len(chunk) else []
+    if held:
+        yield "".join(held)
+
+
+def fix_text_stream(source, handle_tco=False, chunk_size=STREAM_CHUNK_SIZE):
+    """fix_text for text too big to want all of in memory at once: reads
+    source (anything iter_text_chunks takes) a chunk at a time and yields
+    the fixed chunks. Joined together, they're exactly fix_text(all of it).
+    e.g. out.writelines(fix_text_stream(open("huge.log")))"""
+    for piece in iter_text_chunks(source, chunk_size):
+        yield _fix_text(piece, handle_tco)
+
+
+def _fix_text(text, handle_tco=False, scanned=None, unresolved=None):
+    PREFILTER_STATS["checked"] += 1
+    STATS.count("texts fixed")
+    if not might_need_fixing(text, handle_tco):
+        PREFILTER_STATS["skipped"] += 1
+        STATS.count("texts skipped by prefilter")
+        logging.debug(
+            f"Prefilter skipped text; hit rate {PREFILTER_STATS['skipped']}/"
+            f"{PREFILTER_STATS['checked']} "
+            f"({PREFILTER_STATS['skipped'] / PREFILTER_STATS['checked']:.0%})")
+        return text
+    if scanned is None:
+        started = STATS.start()
+        scanned = scan(text)
+        STATS.stop("scan", started)
+    STATS.count("urls seen", len(scanned.spans))
+    redirects = None
+    if handle_tco and scanned.has_tco:
+        started = STATS.start()
+        redirects = resolve_redirects(
+            fix_url(url) for url, split in zip(scanned.urls, scanned.splits)
+            if split.netloc == "t.co")
+        STATS.stop("t.co lookups (all of a text)", started)
+        if unresolved is not None:
+            # a lookup which failed (or failed recently) leaves the link as it was
+            unresolved.extend(url for url, destination in redirects.items()
+                              if destination == url)
+    started = STATS.start()
+    raw_rules = RULES is not None and RULES.has_raw_rules
+    pieces = []
+    done_up_to = 0
+    for index, (start, end) in enumerate(scanned.spans):
+        url = scanned.urls[index]
+        if "?" not in url and not raw_rules and not (handle_tco and "t.co" in url):
+            continue
+        fixed = fix_url(url, handle_tco, split=scanned.splits[index],
+                        redirects=redirects)
+        if fixed != url:
+            pieces.append(text[done_up_to:start])
+            pieces.append(fixed)
+            done_up_to = end
+    STATS.count("urls changed", len(pieces) // 2)
+    if not pieces:
+        STATS.stop("rewrite", started)
+        return text
+    pieces.append(text[done_up_to:])
+    fixed_text = "".join(pieces)
+    STATS.stop("rewrite", started)
+    return fixed_text
+
+
+class FixTextMemo:
+    """Remembers what fix_text made of recent texts, so the same clipboard
+    contents (re-copied, re-announced, or the echo of our own set_text)
+    aren't scanned again. Entries are keyed on the text itself, the
+    handle_tco flag and RULES_VERSION; outputs which are the same as their
+    input aren't kept separately. The least recently used entries go once
+    there are more than max_entries or the texts and outputs held add up
+    to more than max_bytes."""
+
+    UNCHANGED = object()
+
+    def __init__(self, max_entries=128, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (result, size)
+        self._lock = threading.Lock()
+
+    def _key(self, text, handle_tco):
+        # the text, not just its hash, so texts whose hashes collide can't
+        # be given each other's results; the dict only compares the texts
+        # themselves when the hashes match
+        return (text, bool(handle_tco), RULES_VERSION)
+
+    def get(self, text, handle_tco=False):
+        "What fix_text(text, handle_tco) came to, or None if we don't know"
+        key = self._key(text, handle_tco)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                STATS.count("memo misses")
+                return None
+            self.hits += 1
+            STATS.count("memo hits")
+            self._entries.move_to_end(key)
+        return text if entry[0] is self.UNCHANGED else entry[0]
+
+    def peek(self, text, handle_tco=False):
+        """get, without counting a hit or a miss or making the entry any
+        more recently used: for asking in passing, as the PRIMARY watcher
+        does of every selection, whether a text is already done"""
+        with self._lock:
+            entry = self._entries.get(self._key(text, handle_tco))
+        if entry is None:
+            return None
+        return text if entry[0] is self.UNCHANGED else entry[0]
+
+    def put(self, text, handle_tco, result):
+        with self._lock:
+            if result == text:
+                self._store(self._key(text, handle_tco), self.UNCHANGED, sys.getsizeof(text))
+                return
+            self._store(self._key(text, handle_tco), result,
+                        sys.getsizeof(text) + sys.getsizeof(result))
+            # the output is clean already (fix_url cleans where t.co links go,
+            # too), so when it comes back round (as it will, the moment we put
+            # it on the clipboard) there's nothing to do; unless a t.co link
+            # led to another one too many hops on, which would be looked up
+            if handle_tco and contains_tco(result):
+                return
+            self._store(self._key(result, handle_tco), self.UNCHANGED, sys.getsizeof(result))
+
+    def _store(self, key, result, size):
+        old = self._entries.pop(key, None)
+        if old:
+            self.bytes -= old[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (result, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def fix_text(self, text, handle_tco=False, scanned=None):
+        "fix_text, but only if we haven't already done this text"
+        result = self.get(text, handle_tco)
+        if result is not None:
+            return result
+        unresolved = []
+        result = fix_text(text, handle_tco, scanned, unresolved)
+        if unresolved:
+            # a t.co lookup failed; don't remember that for good, so the
+            # next copy tries again
+            return result
+        self.put(text, handle_tco, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+FIX_TEXT_MEMO = FixTextMemo()
 
 
 def is_url(s):
     "Only true if the passed s is exactly a URL and nothing else, no whitespace"
     if type(s) is not str:
         return False
-    return bool(URL_REGEX.match(s))
+    first = next(iter_url_spans(s), None)
+    return first is not None and first[0] == 0
 
 
 def contains_tco(text):
-    urls_in_text = URL_REGEX.findall(text)
-    return any([urllib.parse.urlparse(u).netloc == "t.co" for u in urls_in_text])
-
-
-class TestIsUrl(unittest.TestCase):
-    def test_nope(self):
-        self.assertFalse(is_url(None))
-        self.assertFalse(is_url("lol"))
-        self.assertFalse(is_url(9))
-        self.assertFalse(is_url("http"))
-        self.assertFalse(is_url("pants://example.com"))
-        self.assertFalse(is_url("hppp://example.com"))
-
-    def test_yep(self):
-        self.assertTrue(is_url("http://example.com"))
-        self.assertTrue(is_url("https://example.com"))
-        self.assertTrue(is_url("https://example.com?lol=1"))
-        self.assertTrue(is_url("https://kryogenix.org/days"))
-        self.assertTrue(is_url("http://example.com/a/b?utm_source=haha"))
-        self.assertTrue(is_url("https://google.com"))
-        self.assertTrue(is_url("https://nope.museum?param=123#frag1"))
-        self.assertTrue(is_url("https://nope.museum:8000?param=123#frag1"))
-        self.assertTrue(is_url("https://a:b@nope.museum:8000?param=123#frag1"))
-
-class TestFixUrl(unittest.TestCase):
-    def test_simple(self):
-        self.assertEqual(fix_url("lol"), "lol")
-        self.assertEqual(fix_url(None), None)
-
-    def test_unchanged(self):
-        self.assertEqual(fix_url("https://kryogenix.org/"),
-                         "https://kryogenix.org/")
-        self.assertEqual(fix_url("http://kryogenix.org/"),
-                         "http://kryogenix.org/")
-        self.assertEqual(fix_url("https://kryogenix.org/?untouched"),
-                         "https://kryogenix.org/?untouched")
-        self.assertEqual(fix_url("https://kryogenix.org/?untouched=ok"),
-                         "https://kryogenix.org/?untouched=ok")
-        self.assertEqual(fix_url("https://kryogenix.org/?a=1&b=2"),
-                         "https://kryogenix.org/?a=1&b=2")
-
-    def test_changed(self):
-        self.assertEqual(fix_url("https://kryogenix.org/?utm_source=bye"),
-                         "https://kryogenix.org/")
-        self.assertEqual(fix_url("https://kryogenix.org/?utm_source=bye&a=1"),
-                         "https://kryogenix.org/?a=1")
-        self.assertEqual(fix_url("https://kryogenix.org/?utm_source=bye&utm_media=banner"),
-                         "https://kryogenix.org/")
-        self.assertEqual(fix_url("https://kryogenix.org/?srcid=12345"),
-                         "https://kryogenix.org/")
-        # TrackerZapper's amusing test :-)
-        self.assertEqual(fix_url("https://www.youtube.com/watch?v=dQw4w9WgXcQ&s=never&fbclid=gunna&gclid=give&gclsrc=you&utm_content=up&utm_term=never&utm_campaign=gunna&utm_medium=let&utm_source=you&utm_id=down&_ga=never&mc_cid=gunna&mc_eid=run&_bta_tid=around&_bta_c=and&trk_contact=desert&trk_msg=you&trk_module=never&trk_sid=gunna&gdfms=make&gdftrk=you&gdffi=cry&_ke=never&redirect_log_mongo_id=gunna&redirect_mongo_id=say&sb_referer_host=goodbye&mkwid=never&pcrid=gunna&ef_id=tell&s_kwcid=a&msclkid=lie&dm_i=and&epik=hurt&pk_campaign=you"),
-                         "https://www.youtube.com/watch?v=dQw4w9WgXcQ&s=never")
-
-    def test_tricks(self):
-        self.assertEqual(fix_url("https://kryogenix.org/utm_source=bye/?a=1"),
-                         "https://kryogenix.org/utm_source=bye/?a=1")
-
-
-class TestExtractUrl(unittest.TestCase):
-    def test_simple(self):
-        self.assertEqual(URL_REGEX.findall("https://kryogenix.org"),
-                         ["https://kryogenix.org"])
-        self.assertEqual(URL_REGEX.findall("Testing https://kryogenix.org for urls"),
-                         ["https://kryogenix.org"])
-
-    def test_complex_urls(self):
-        self.assertEqual(URL_REGEX.findall("""
-        This is https://a:b@kryogenix.org:80/lol?a=b#frag1 here
-        """),
-                         ["https://a:b@kryogenix.org:80/lol?a=b#frag1"])
-
-    def test_multiple_urls(self):
-        self.assertEqual(URL_REGEX.findall("""
-        You can go to https://kryogenix.org/days or
-        http://example.com/a/b?utm_source=haha
-        or https://google.com or https://nope.museum?param=123#frag1 or
-        any other place you fancy
-        """),
-                         [
-                         "https://kryogenix.org/days",
-                         "http://example.com/a/b?utm_source=haha",
-                         "https://google.com",
-                         "https://nope.museum?param=123#frag1"
-                         ])
-
-class TestFixText(unittest.TestCase):
-    def test_simple(self):
-        self.assertEqual(fix_text("""
-            here is unchanged text
-        """),
-                         """
-            here is unchanged text
-        """)
-        self.assertEqual(fix_text("""
-            here is unchanged text with an unchanged url https://kryogenix.org
-        """),
-                         """
-            here is unchanged text with an unchanged url https://kryogenix.org
-        """)
-        self.assertEqual(fix_text("""
-            here is unchanged multiline text
-            with an unchanged url
-            https://kryogenix.org
-            right here
-        """),
-                         """
-            here is unchanged multiline text
-            with an unchanged url
-            https://kryogenix.org
-            right here
-        """)
-
-    def test_changed(self):
-        self.assertEqual(fix_text("""
-            here is unchanged multiline text
-            with a changed url
-            https://kryogenix.org?utm_source=no
-            right here
-        """),
-                         """
-            here is unchanged multiline text
-            with a changed url
-            https://kryogenix.org
-            right here
-        """)
-        self.assertEqual(fix_text("""
-            here is unchanged multiline text
-            with a changed url
-            https://kryogenix.org?utm_source=no&a=1
-            right here
-        """),
-                         """
-            here is unchanged multiline text
-            with a changed url
-            https://kryogenix.org?a=1
-            right here
-        """)
-
-    def test_with_tco(self):
-        self.assertEqual(
-            fix_text(
-                "Go to https://t.co/pyzgkqT1xH?amp=1 for victory",
-                handle_tco=True
-            ),
-            "Go to https://www.ietf.org/id/draft-schoen-intarea-unicast-127-00.html for victory"
-        )
-        self.assertEqual(
-            fix_text(
-                "Go to https://kryogenix.org for victory",
-                handle_tco=True
-            ),
-            "Go to https://kryogenix.org for victory"
-        )
-        self.assertNotEqual(
-            fix_text(
-                "Go to https://kryogenix.org for victory",
-                handle_tco=True
-            ),
-            "Go to https://kryogenix.org/ for victory" # extra slash: redirect NOT followed
-        )
-
-
-class TestContainsTco(unittest.TestCase):
-    def test_simple_yes(self):
-        self.assertTrue(contains_tco("https://t.co/abcde"))
-        self.assertTrue(contains_tco("http://t.co/abcde"))
-        self.assertTrue(contains_tco("This text contains https://t.co/abcde and others"))
-        self.assertTrue(contains_tco("first: https://t.co/abcde, second: https://t.co/fghij, done"))
-        self.assertTrue(contains_tco("first:\nhttps://t.co/abcde,\nsecond: https://t.co/fghij,\ndone"))
-
-    def test_simple_no(self):
-        self.assertFalse(contains_tco(""))
-        self.assertFalse(contains_tco("Nope"))
-        self.assertFalse(contains_tco("This text contains https://kryogenix.org and others"))
-        self.assertFalse(contains_tco("https://at.co/123, https://no.t.co/123, t.co/123, all no"))
-
-
-class TestFollowRedirects(unittest.TestCase):
-    def test_examples(self):
-        self.assertEqual(
-            follow_redirects("https://t.co/pyzgkqT1xH?amp=1"),
-            "https://www.ietf.org/id/draft-schoen-intarea-unicast-127-00.html")
-        self.assertEqual(
-            follow_redirects("https://kryogenix.org"), "https://kryogenix.org/")
-        self.assertEqual(
-            follow_redirects("https://kryogenix.org/"), "https://kryogenix.org/")
-
-
-if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    if "t.co" not in text:
+        return False
+    return scan(text).has_tco